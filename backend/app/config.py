@@ -1,9 +1,10 @@
 from dotenv import load_dotenv
 from pathlib import Path
 import os 
+import multiprocessing
 from datetime import datetime
 from typing import Dict
-from jinja2 import Template
+from jinja2 import Environment, DictLoader, FileSystemBytecodeCache, Template
 
 
 env_path = Path(__file__).resolve().parents[1]/".env"
@@ -14,6 +15,65 @@ SUPABASE_KEY:str = os.getenv("SUPABASE_KEY")
 SUPABASE_SERVICE_KEY:str = os.getenv("SUPABASE_SERVICE_KEY")
 BUCKET_NAME: str = os.getenv("BUCKET_NAME")
 HF_API_TOKEN = os.getenv("HF_API_TOKEN")
+DISCOUNT_POLICY_CACHE_SIZE: int = int(os.getenv("DISCOUNT_POLICY_CACHE_SIZE", "32"))
+DISCOUNT_BATCH_FIN_ROWS: int = int(os.getenv("DISCOUNT_BATCH_FIN_ROWS", "64"))
+# Discount pipeline backend: "pandas" (default) or "duckdb" (optional dependency)
+DISCOUNT_ENGINE: str = os.getenv("DISCOUNT_ENGINE", "pandas").lower()
+# Run discount generation per hotel on a process pool (DISCOUNT_WORKERS processes)
+DISCOUNT_SHARD_BY_HOTEL: bool = os.getenv("DISCOUNT_SHARD_BY_HOTEL", "false").lower() in ("1", "true", "yes")
+DUCKDB_THREADS: int = int(os.getenv("DUCKDB_THREADS", str(os.cpu_count() or 1)))
+DUCKDB_MEMORY_LIMIT: str = os.getenv("DUCKDB_MEMORY_LIMIT", "2GB")
+DUCKDB_TEMP_DIR: str = os.getenv("DUCKDB_TEMP_DIR", str(Path(__file__).resolve().parents[1] / ".duckdb_tmp"))
+OFFER_INSERT_CHUNK_SIZE: int = int(os.getenv("OFFER_INSERT_CHUNK_SIZE", "500"))
+OFFER_INSERT_WORKERS: int = int(os.getenv("OFFER_INSERT_WORKERS", "4"))
+OFFER_EXPORT_PAGE_SIZE: int = int(os.getenv("OFFER_EXPORT_PAGE_SIZE", "1000"))
+OFFER_CUBE_PAGE_SIZE: int = int(os.getenv("OFFER_CUBE_PAGE_SIZE", "1000"))
+# Seconds a worker serves its in-memory offer cube before re-checking the stored version
+OFFER_CUBE_REVALIDATE_S: float = float(os.getenv("OFFER_CUBE_REVALIDATE_S", "5"))
+DISCOUNT_WORKERS: int = int(os.getenv("DISCOUNT_WORKERS", str(os.cpu_count() or 1)))
+# Start method for discount worker processes; fork would copy the server's threads and locks
+DISCOUNT_MP_START_METHOD: str = os.getenv(
+    "DISCOUNT_MP_START_METHOD",
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn",
+)
+DISCOUNT_SUMMARY_CACHE_SIZE: int = int(os.getenv("DISCOUNT_SUMMARY_CACHE_SIZE", "256"))
+# Share of bookings per (hotel, segment) stratum used by the discount preview
+DISCOUNT_PREVIEW_FRACTION: float = float(os.getenv("DISCOUNT_PREVIEW_FRACTION", "0.1"))
+DISCOUNT_PREVIEW_MIN_PER_STRATUM: int = int(os.getenv("DISCOUNT_PREVIEW_MIN_PER_STRATUM", "30"))
+# Email plan completions (OpenRouter)
+EMAIL_LLM_BASE_URL: str = os.getenv("EMAIL_LLM_BASE_URL", "https://openrouter.ai/api/v1")
+EMAIL_LLM_MODEL: str = os.getenv("EMAIL_LLM_MODEL", "meta-llama/llama-3-8b-instruct")
+EMAIL_LLM_TEMPERATURE: float = float(os.getenv("EMAIL_LLM_TEMPERATURE", "0.7"))
+EMAIL_LLM_MAX_TOKENS: int = int(os.getenv("EMAIL_LLM_MAX_TOKENS", "380"))
+# Requests in flight at once, and the provider's request rate limit (0 = unlimited)
+EMAIL_LLM_CONCURRENCY: int = int(os.getenv("EMAIL_LLM_CONCURRENCY", "16"))
+EMAIL_LLM_REQUESTS_PER_MINUTE: float = float(os.getenv("EMAIL_LLM_REQUESTS_PER_MINUTE", "200"))
+EMAIL_LLM_BURST: int = int(os.getenv("EMAIL_LLM_BURST", "10"))
+EMAIL_LLM_MAX_RETRIES: int = int(os.getenv("EMAIL_LLM_MAX_RETRIES", "5"))
+EMAIL_LLM_BACKOFF_BASE: float = float(os.getenv("EMAIL_LLM_BACKOFF_BASE", "0.5"))
+EMAIL_LLM_BACKOFF_MAX: float = float(os.getenv("EMAIL_LLM_BACKOFF_MAX", "30"))
+# Offers packed into one completion (1 = one offer per request)
+EMAIL_LLM_BATCH_SIZE: int = int(os.getenv("EMAIL_LLM_BATCH_SIZE", "1"))
+# Upper bound for a requested batch_size (max_tokens grows with the batch)
+EMAIL_LLM_BATCH_SIZE_MAX: int = int(os.getenv("EMAIL_LLM_BATCH_SIZE_MAX", "20"))
+# Persistent cache of generated email plans (SQLite), least recently used evicted first
+EMAIL_PLAN_CACHE_ENABLED: bool = os.getenv("EMAIL_PLAN_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+EMAIL_PLAN_CACHE_PATH: str = os.getenv("EMAIL_PLAN_CACHE_PATH", str(Path(__file__).resolve().parents[1] / ".email_plan_cache" / "plans.sqlite3"))
+EMAIL_PLAN_CACHE_MAX_ENTRIES: int = int(os.getenv("EMAIL_PLAN_CACHE_MAX_ENTRIES", "50000"))
+# "offer": one plan per offer; "cohort": one plan (or a few variants) per cohort of alike offers
+EMAIL_GENERATION_MODE: str = os.getenv("EMAIL_GENERATION_MODE", "offer").lower()
+EMAIL_COHORT_DISCOUNT_STEP: int = int(os.getenv("EMAIL_COHORT_DISCOUNT_STEP", "5"))
+EMAIL_COHORT_VARIANTS: int = int(os.getenv("EMAIL_COHORT_VARIANTS", "1"))
+# Offers planned, rendered and saved per checkpoint of an email generation run
+EMAIL_CHECKPOINT_SIZE: int = int(os.getenv("EMAIL_CHECKPOINT_SIZE", "100"))
+# Smaller checkpoints for the streaming generate-email endpoint, so emails arrive early
+EMAIL_STREAM_CHUNK_SIZE: int = int(os.getenv("EMAIL_STREAM_CHUNK_SIZE", "16"))
+# In-process LRUs of decompressed shared email bodies and of rendered campaign previews
+EMAIL_BODY_CACHE_SIZE: int = int(os.getenv("EMAIL_BODY_CACHE_SIZE", "256"))
+EMAIL_PREVIEW_CACHE_SIZE: int = int(os.getenv("EMAIL_PREVIEW_CACHE_SIZE", "512"))
+# Campaign cards per page of the campaign listing (default and upper bound)
+CAMPAIGN_PAGE_SIZE: int = int(os.getenv("CAMPAIGN_PAGE_SIZE", "50"))
+CAMPAIGN_PAGE_SIZE_MAX: int = int(os.getenv("CAMPAIGN_PAGE_SIZE_MAX", "200"))
 SEG_NUMERICAL_COLUMNS = [
     "lead_time", "stays_in_weekend_nights", "stays_in_week_nights", "adults", "children", "babies",
     "is_canceled", "is_repeated_guest", "previous_cancellations", "previous_bookings_not_canceled",
@@ -129,6 +189,27 @@ ROOM_LETTER_TIER: Dict[str, Dict[str, str]] = {
 PROMPTS: dict[str, str] = {}
 TEMPLATES: dict[str, Template] = {}
 
+# Email templates are compiled once by a shared environment; the compiled bytecode is
+# kept on disk (keyed by name and source checksum) so restarts and workers skip the compile
+EMAIL_TEMPLATE_BYTECODE_DIR: str = os.getenv("EMAIL_TEMPLATE_BYTECODE_DIR", str(Path(__file__).resolve().parents[1] / ".jinja_cache"))
+TEMPLATE_SOURCES: dict[str, str] = {}
+
+
+def _template_bytecode_cache() -> FileSystemBytecodeCache | None:
+    try:
+        Path(EMAIL_TEMPLATE_BYTECODE_DIR).mkdir(parents=True, exist_ok=True)
+        return FileSystemBytecodeCache(EMAIL_TEMPLATE_BYTECODE_DIR)
+    except OSError as e:
+        print(f"[WARN] Template bytecode cache unavailable: {e}")
+        return None
+
+
+TEMPLATE_ENV = Environment(
+    loader=DictLoader(TEMPLATE_SOURCES),
+    bytecode_cache=_template_bytecode_cache(),
+    auto_reload=False,  # sources only change through load_prompts_and_templates
+)
+
 def load_prompts_and_templates(supabase):
     global PROMPTS, TEMPLATES
     p_res = supabase.table("system_prompts").select("*").execute()
@@ -136,8 +217,10 @@ def load_prompts_and_templates(supabase):
         PROMPTS[row["name"]] = row["content"]
 
     t_res = supabase.table("email_templates").select("*").execute()
-    for row in t_res.data or []:
-        TEMPLATES[row["name"]] = Template(row["content"])
+    TEMPLATE_SOURCES.update({row["name"]: row["content"] for row in t_res.data or []})
+    TEMPLATE_ENV.cache.clear()  # drop any compiled copy of a replaced source
+    for name in TEMPLATE_SOURCES:
+        TEMPLATES[name] = TEMPLATE_ENV.get_template(name)  # compile now, not on the first email
 
 # ----- human-friendly naming -----
 ROOM_TIER_FRIENDLY = {
@@ -209,6 +292,9 @@ PERK_COST_COLS = {
     "meeting_room": "meeting_room_cost"
 }
 
+# Perk order used when a segment config has no perk_priority
+DEFAULT_PERK_PRIORITY = ["bar_credit", "gym", "kids_club", "spa", "swimming_pool", "work_desk", "meeting_room"]
+
 AMENITY_USAGE_COLS = {
     "spa": "is_spa_used",
     "gym": "is_gym_used",
@@ -218,4 +304,16 @@ AMENITY_USAGE_COLS = {
     "work_desk": "is_work_desk_used",
     "meeting_room": "is_meeting_room_used",
     "gaming_room": "is_gaming_room_used"  # not a perk, signal only
+}
+
+# Amenity flag -> name used in offers' amenities_used_before and guest profiles
+AMENITY_USED_NAMES = {
+    "is_spa_used": "spa",
+    "is_gym_used": "gym",
+    "is_kids_club_used": "kids_club",
+    "is_bar_used": "bar",
+    "is_swimming_pool_used": "swimming_pool",
+    "is_work_desk_used": "work_desk",
+    "is_meeting_room_used": "meeting_room",
+    "is_gaming_room_used": "gaming_room"
 }
\ No newline at end of file
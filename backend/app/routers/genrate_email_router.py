@@ -1,7 +1,10 @@
 from fastapi import APIRouter,Query,Form
-from app.services.genrate_email import generate_emails ,fetch_campaign_stats,fetch_email_preview
+from fastapi.responses import StreamingResponse
+from app.services.campaign_stats import fetch_campaign_counts
+from app.services.campaign_listing import list_campaigns
+from app.services.genrate_email import generate_emails ,stream_generate_emails ,fetch_campaign_stats,fetch_email_preview
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 router = APIRouter()
 
@@ -9,6 +12,9 @@ class CampaignGenerateRequest(BaseModel):
     email: str
     year: int
     months: List[int]  # list of integers
+    bypass_cache: bool = False  # regenerate plans even when the prompt is cached
+    mode: Optional[str] = None  # "offer" or "cohort"; defaults to EMAIL_GENERATION_MODE
+    batch_size: Optional[int] = None  # offers per completion; defaults to EMAIL_LLM_BATCH_SIZE
     
 class GetCampaignPreview(BaseModel):
     campaign_id:str
@@ -18,14 +24,55 @@ def generate_email(req: CampaignGenerateRequest):
     email= req.email
     months = req.months
     year = req.year
-    response = generate_emails(email,months,year)
+    response = generate_emails(email,months,year,use_cache=not req.bypass_cache,mode=req.mode,batch_size=req.batch_size)
     return response
 
+@router.post("/generate-email/stream")
+def generate_email_stream(req: CampaignGenerateRequest, format: str = Query("ndjson")):
+    # Emits each email as soon as its chunk is rendered; see stream_generate_emails for the events
+    if format not in ("ndjson", "sse"):
+        return {"success": False, "message": f"Unsupported stream format: {format}. Use 'ndjson' or 'sse'."}
+    stream = stream_generate_emails(
+        req.email, req.months, req.year,
+        use_cache=not req.bypass_cache, mode=req.mode, batch_size=req.batch_size, fmt=format,
+    )
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream" if format == "sse" else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @router.post("/get-email-campaigns")
 def get_campaigns_and_filters( email: str = Form(...)):
     response = fetch_campaign_stats(email)
     return response
 
+@router.post("/get-campaign-stats")
+def get_campaign_stats(email: str = Form(...)):
+    # Counts only (years → months → totals), read from the write-time counters
+    response = fetch_campaign_counts(email)
+    return response
+
+@router.get("/campaigns")
+def list_campaigns_router(
+    email: str = Query(...),
+    year: Optional[int] = Query(None),
+    month: Optional[int] = Query(None),
+    status: Optional[str] = Query(None),
+    hotel: Optional[str] = Query(None),
+    segment: Optional[str] = Query(None),
+    fields: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: Optional[int] = Query(None),
+):
+    """One page of campaign cards; pass the returned next_cursor to get the next page."""
+    response = list_campaigns(
+        email, year=year, month=month, status=status, hotel=hotel, segment=segment,
+        fields=[f.strip() for f in fields.split(",") if f.strip()] if fields else None,
+        cursor=cursor, limit=limit,
+    )
+    return response
+
 @router.post("/get-email-preview")
 def get_email_preview_router(req:GetCampaignPreview):
     response = fetch_email_preview(req.campaign_id)
@@ -3,6 +3,7 @@ from fastapi import File,UploadFile
 import io
 from app.db.supabase_client import supabase
 from app.config import AMENITY_COLUMNS
+from app.services.guest_profiles import sync_guest_profiles
 import numpy as np
 
 
@@ -171,10 +172,18 @@ def upload_data_to_db(df: pd.DataFrame, email: str) -> dict:
                 "message": f"Error inserting records: {insert_response.error.message}"
             }
 
+        # Step 6: Refresh guest profiles from the new active bookings
+        try:
+            profiles = sync_guest_profiles(user_id, pd.DataFrame(insert_response.data))
+        except Exception as e:
+            print(f"[WARN] Guest profile refresh failed for {user_id}: {e}")
+            profiles = None
+
         return {
             "success": True,
             "message": "Booking history file uploaded successfully",
-            "inserted_rows": len(insert_response.data)
+            "inserted_rows": len(insert_response.data),
+            "guest_profiles": profiles,
         }
 
     except Exception as e:
@@ -0,0 +1,123 @@
+"""
+Paginated listing of a tenant's campaign cards (one per offer of the active set).
+
+Pages are keyset-paginated on the offer id: the opaque cursor carries the last
+id served, so every page is one indexed range read however deep the client
+goes. Filters (year, month, status, hotel, segment) run in the database and
+`fields` limits both the selected columns and the card keys returned.
+"""
+import base64
+import json
+
+from app.config import CAMPAIGN_PAGE_SIZE, CAMPAIGN_PAGE_SIZE_MAX, MONTH_NAMES
+from app.db.supabase_client import supabase
+from app.services.offer_sets import get_active_offer_set_id
+
+# card field -> column of the offer, or of its email campaign (prefixed "ec.")
+CARD_FIELDS = {
+    "offer_id": "id",
+    "hotel": "hotel",
+    "room_type": "room_type",
+    "business_label": "business_label",
+    "booking_segment": "booking_segment",
+    "discount_pct": "discount_pct",
+    "offer_type": "offer_type",
+    "target_year": "target_year",
+    "target_month": "target_month",
+    "campaign_id": "ec.id",
+    "status": "ec.status",
+    "subject": "ec.subject",
+    "preheader": "ec.preheader",
+    "created_at": "ec.created_at",
+}
+DEFAULT_CARD_FIELDS = [
+    "offer_id", "campaign_id", "hotel", "business_label", "discount_pct",
+    "status", "subject", "preheader", "created_at",
+]
+CAMPAIGN_STATUSES = ("pending", "generated", "launched")
+
+
+def encode_cursor(last_id) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"after": last_id}).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))["after"]
+
+
+def list_campaigns(email: str, year: int | None = None, month: int | None = None, status: str | None = None,
+                   hotel: str | None = None, segment: str | None = None, fields: list[str] | None = None,
+                   cursor: str | None = None, limit: int | None = None) -> dict:
+    fields = fields or DEFAULT_CARD_FIELDS
+    unknown = [f for f in fields if f not in CARD_FIELDS]
+    if unknown:
+        return {"success": False, "message": f"Unknown fields: {unknown}. Use any of {sorted(CARD_FIELDS)}."}
+    if status is not None and status not in CAMPAIGN_STATUSES:
+        return {"success": False, "message": f"Unknown status: {status}. Use one of {list(CAMPAIGN_STATUSES)}."}
+    if month is not None and not 1 <= month <= 12:
+        return {"success": False, "message": "month must be between 1 and 12"}
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except (ValueError, KeyError, TypeError):
+        return {"success": False, "message": "Invalid cursor"}
+    limit = min(max(1, limit or CAMPAIGN_PAGE_SIZE), CAMPAIGN_PAGE_SIZE_MAX)
+
+    try:
+        user_res = supabase.table("users").select("user_id").eq("email", email).execute()
+        if not user_res.data:
+            return {"success": False, "message": f"No user found with email: {email}"}
+        offer_set_id = get_active_offer_set_id(user_res.data[0]["user_id"])
+        if not offer_set_id:
+            return {"success": True, "items": [], "next_cursor": None, "limit": limit}
+
+        offer_cols = {"id"} | {CARD_FIELDS[f] for f in fields if not CARD_FIELDS[f].startswith("ec.")}
+        ec_cols = {"status"} | {CARD_FIELDS[f][3:] for f in fields if CARD_FIELDS[f].startswith("ec.")}
+        needs_campaign = status is not None or any(CARD_FIELDS[f].startswith("ec.") for f in fields)
+        # Generated/launched cards need a campaign, so those filters use an inner join
+        join = "!inner" if status in ("generated", "launched") else "!left"
+        select = ", ".join(sorted(offer_cols))
+        if needs_campaign:
+            select += f", email_campaigns{join} ({', '.join(sorted(ec_cols))})"
+
+        query = supabase.table("discount_offers").select(select).eq("offer_set_id", offer_set_id)
+        if year is not None:
+            query = query.eq("target_year", year)
+        if month is not None:
+            # Stored month names vary in case ("May", "may")
+            query = query.ilike("target_month", MONTH_NAMES[month - 1])
+        if hotel:
+            query = query.eq("hotel", hotel)
+        if segment:
+            # A cluster id, or a business label such as "Family Traveller"
+            query = query.eq("booking_segment", int(segment)) if segment.isdigit() else query.eq("business_label", segment)
+        if status in ("generated", "launched"):
+            query = query.eq("email_campaigns.status", status)
+        elif status == "pending":
+            query = query.is_("email_campaigns", "null")
+        if after is not None:
+            query = query.gt("id", after)
+
+        # One row past the page tells whether there is a next one
+        rows = query.order("id").limit(limit + 1).execute().data or []
+    except Exception as e:
+        return {"success": False, "message": f"Error listing campaigns: {str(e)}"}
+
+    items = []
+    for o in rows[:limit]:
+        ec_list = o.get("email_campaigns") or []
+        ec = ec_list[0] if ec_list else {}
+        card = {}
+        for f in fields:
+            col = CARD_FIELDS[f]
+            card[f] = ec.get(col[3:]) if col.startswith("ec.") else o.get(col)
+        if "status" in card:
+            card["status"] = card["status"] or "pending"
+        items.append(card)
+
+    has_more = len(rows) > limit
+    return {
+        "success": True,
+        "items": items,
+        "next_cursor": encode_cursor(rows[limit - 1]["id"]) if has_more else None,
+        "limit": limit,
+    }
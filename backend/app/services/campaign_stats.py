@@ -0,0 +1,111 @@
+"""
+Write-time campaign counters per (tenant, offer set, year, month).
+
+`campaign_stats` holds how many offers each month has and how many of them have
+a generated / launched email. Writers keep the counters current (a new offer set
+is counted once, saves and launches add deltas), so reading a tenant's stats is
+a handful of rows however many offers there are. The SQL functions behind the
+RPCs are in migrations/005_campaign_stats.sql.
+"""
+from app.config import MONTH_NAME_TO_NUM, MONTH_NAMES
+from app.db.supabase_client import supabase
+from app.services.offer_sets import get_active_offer_set_id
+
+
+def month_number(month) -> int | None:
+    if isinstance(month, str):
+        month = MONTH_NAME_TO_NUM.get(month.lower())
+    return month if isinstance(month, int) and 1 <= month <= 12 else None
+
+
+def period_of(year, month) -> tuple[int, int] | None:
+    month = month_number(month)
+    try:
+        return (int(year), month) if year and month else None
+    except (TypeError, ValueError):
+        return None
+
+
+def seed_campaign_stats(user_id, offer_set_id: str | None = None, only_if_missing: bool = False) -> dict:
+    """
+    Recount the (active) offer set and replace the tenant's counters with the result.
+    The recount runs in the database under the tenant's counter lock, so an increment
+    is never lost in between; `only_if_missing` keeps counters that already exist.
+    """
+    offer_set_id = offer_set_id or get_active_offer_set_id(user_id)
+    if not offer_set_id:
+        return {}
+    rows = supabase.rpc("reseed_campaign_stats", {
+        "p_user_id": user_id,
+        "p_offer_set_id": offer_set_id,
+        "p_only_if_missing": only_if_missing,
+    }).execute().data or []
+    return {(r["year"], r["month"]): r for r in rows}
+
+
+def refresh_campaign_stats(user_id) -> None:
+    """Write-time hook for offer set writes: a failed recount must not fail the write."""
+    try:
+        seed_campaign_stats(user_id)
+    except Exception as e:
+        print(f"[WARN] Campaign stats refresh failed for {user_id}: {e}")
+
+
+def bump_campaign_stats(user_id, deltas: dict) -> None:
+    """
+    Add `deltas` ((year, month) -> {generated, launched}) to the active set's counters
+    in one atomic database call. Counters are recounted if the increment fails.
+    """
+    deltas = {p: d for p, d in deltas.items() if p is not None and any(d.values())}
+    if not deltas:
+        return
+    try:
+        offer_set_id = get_active_offer_set_id(user_id)
+        supabase.rpc("increment_campaign_stats", {
+            "p_user_id": user_id,
+            "p_offer_set_id": offer_set_id,
+            "p_deltas": [{"year": y, "month": m, **d} for (y, m), d in deltas.items()],
+        }).execute()
+    except Exception as e:
+        print(f"[WARN] Campaign stats increment failed for {user_id}, recounting: {e}")
+        refresh_campaign_stats(user_id)
+
+
+def get_campaign_counts(user_id) -> dict:
+    """years -> months -> {total, generated, pending, launched} for the active offer set."""
+    offer_set_id = get_active_offer_set_id(user_id)
+    if not offer_set_id:
+        return {}
+    rows = (
+        supabase.table("campaign_stats")
+        .select("year, month, total, generated, launched")
+        .eq("user_id", user_id)
+        .eq("offer_set_id", offer_set_id)
+        .execute()
+    ).data
+    if rows:
+        counts = {(r["year"], r["month"]): r for r in rows}
+    else:
+        # First read after a new set went live: seeds unless a writer got there first
+        counts = seed_campaign_stats(user_id, offer_set_id, only_if_missing=True)
+
+    years = {}
+    for (year, month), c in sorted(counts.items()):
+        months = years.setdefault(year, {m: {"total": 0, "generated": 0, "pending": 0, "launched": 0} for m in range(1, 13)})
+        months[month] = {
+            "total": c["total"],
+            "generated": c["generated"],
+            "pending": c["total"] - c["generated"],
+            "launched": c["launched"],
+        }
+    return years
+
+
+def fetch_campaign_counts(user_email: str) -> dict:
+    user_res = supabase.table("users").select("user_id").eq("email", user_email).execute()
+    if not user_res.data:
+        return {"years": {}, "month_labels": {}}
+    return {
+        "years": get_campaign_counts(user_res.data[0]["user_id"]),
+        "month_labels": {i: MONTH_NAMES[i - 1] for i in range(1, 13)},
+    }
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping
+
+import numpy as np
+import pandas as pd
+
+from app.config import PERK_COST_COLS, DEFAULT_PERK_PRIORITY, DISCOUNT_POLICY_CACHE_SIZE
+from app.services.join_keys import JOIN_KEY_CODES
+
+SEASON_BANDS = ("low", "shoulder", "high")
+
+
+def season_band_from_financial_row(fin_row: pd.Series) -> str:
+    """
+    Prefer explicit 'booking_percent' if present, else use forecast as a proxy.
+    """
+    if "booking_percent" in fin_row:
+        val = fin_row["booking_percent"]
+    elif "forecast_booking_percent" in fin_row:
+        val = fin_row["forecast_booking_percent"]
+    else:
+        # fallback: neutral
+        return "shoulder"
+
+    try:
+        val = float(val)
+    except Exception:
+        return "shoulder"
+
+    if val < 50:
+        return "low"
+    elif val < 75:
+        return "shoulder"
+    else:
+        return "high"
+
+
+def occupancy_gap(fin_row: pd.Series) -> float:
+    tgt = fin_row.get("target_booking_percent", None)
+    fc = fin_row.get("forecast_booking_percent", None)
+    try:
+        return float(tgt) - float(fc)
+    except Exception:
+        return 0.0
+
+
+def perk_cost_matrix(fin: pd.DataFrame, perks: list[str]) -> np.ndarray:
+    """
+    Cost of each perk for each financial row, shape (len(fin), len(perks)).
+    Perks without a cost column are free.
+    """
+    costs = np.zeros((len(fin), len(perks)), dtype=float)
+    for j, perk in enumerate(perks):
+        col = PERK_COST_COLS.get(perk, "")
+        if col in fin.columns:
+            costs[:, j] = [float(v or 0) for v in fin[col].tolist()]
+    return costs
+
+
+def _frozen(arr: np.ndarray) -> np.ndarray:
+    arr.setflags(write=False)
+    return arr
+
+
+@dataclass(frozen=True)
+class SegmentPolicy:
+    """One manager segment config, parsed once."""
+    cluster_id: int
+    baseline: np.ndarray          # discount per season band, in SEASON_BANDS order
+    price_floor: float | None     # 'low' baseline applied to price-sensitive guests
+    boost_if_high_gap: float
+    max_perk_cost: float
+    perk_priority: tuple[str, ...]
+    perk_cols: np.ndarray         # positions of perk_priority in DiscountPolicy.perk_names
+
+
+@dataclass(frozen=True)
+class DiscountPolicy:
+    """
+    Segment configs compiled against one version of the financials.
+    Per-row arrays are aligned to the financials rows the policy was compiled from.
+    """
+    config_hash: str
+    financials_version: str
+    segments: tuple[SegmentPolicy, ...]
+    segment_index: Mapping[int, int]   # cluster_id -> position in `segments`
+    perk_names: tuple[str, ...]
+    perk_costs: np.ndarray             # (financial rows, perks)
+    season_bands: np.ndarray           # (financial rows,) band name
+    season_codes: np.ndarray           # (financial rows,) position in SEASON_BANDS
+    occ_gaps: np.ndarray               # (financial rows,)
+
+    def segment_positions(self, booking_segment: pd.Series) -> np.ndarray:
+        """Position in `segments` for each booking segment, -1 when no config applies."""
+        booking_segment = pd.to_numeric(booking_segment, errors="coerce")
+        has_segment = booking_segment.notna().to_numpy()
+        seg_pos = np.full(len(booking_segment), -1)
+        seg_pos[has_segment] = (
+            booking_segment[has_segment].astype(int).map(self.segment_index).fillna(-1).to_numpy().astype(int)
+        )
+        return seg_pos
+
+
+def config_hash(segments: list[dict]) -> str:
+    payload = json.dumps(segments, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def financials_version(financials: pd.DataFrame) -> str:
+    """
+    Content hash of the financials frame (values, column names and row order: the
+    policy's arrays are per financial row). Join key codes are left out, as they
+    shift whenever a hotel or room type is added.
+    """
+    financials = financials.drop(columns=[c for c in JOIN_KEY_CODES if c in financials.columns])
+    h = hashlib.sha256(json.dumps([str(c) for c in financials.columns]).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(financials, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def compile_segment(seg_conf: dict, perk_pos: dict[str, int]) -> SegmentPolicy:
+    baseline_map = seg_conf.get("baseline", {})
+    low = baseline_map.get("low")
+    priority = tuple(seg_conf.get("perk_priority", []) or DEFAULT_PERK_PRIORITY)
+    return SegmentPolicy(
+        cluster_id=int(seg_conf["cluster_id"]),
+        baseline=_frozen(np.array([float(baseline_map.get(b, 0) or 0) for b in SEASON_BANDS])),
+        price_floor=float(low) if low else None,
+        boost_if_high_gap=float(seg_conf.get("boost_if_high_gap", 0) or 0),
+        max_perk_cost=float(seg_conf.get("max_perk_cost", 0) or 0),
+        perk_priority=priority,
+        perk_cols=_frozen(np.array([perk_pos[p] for p in priority], dtype=int)),
+    )
+
+
+def compile_discount_policy(segments: list[dict], financials: pd.DataFrame) -> DiscountPolicy:
+    perk_names = []
+    for seg_conf in segments:
+        for perk in seg_conf.get("perk_priority", []) or DEFAULT_PERK_PRIORITY:
+            if perk not in perk_names:
+                perk_names.append(perk)
+    perk_pos = {p: j for j, p in enumerate(perk_names)}
+
+    compiled = tuple(compile_segment(s, perk_pos) for s in segments)
+    segment_index = {}
+    for i, seg in enumerate(compiled):
+        segment_index.setdefault(seg.cluster_id, i)  # first config wins
+
+    fin_rows = [fin_row for _, fin_row in financials.iterrows()]
+    season_bands = np.array([season_band_from_financial_row(r) for r in fin_rows], dtype=object)
+    band_pos = {b: i for i, b in enumerate(SEASON_BANDS)}
+
+    return DiscountPolicy(
+        config_hash=config_hash(segments),
+        financials_version=financials_version(financials),
+        segments=compiled,
+        segment_index=MappingProxyType(segment_index),
+        perk_names=tuple(perk_names),
+        perk_costs=_frozen(perk_cost_matrix(financials, perk_names)),
+        season_bands=_frozen(season_bands),
+        season_codes=_frozen(np.array([band_pos[b] for b in season_bands], dtype=int)),
+        occ_gaps=_frozen(np.array([occupancy_gap(r) for r in fin_rows], dtype=float)),
+    )
+
+
+_POLICY_CACHE: "OrderedDict[tuple[str, str], DiscountPolicy]" = OrderedDict()
+_POLICY_CACHE_LOCK = threading.Lock()
+
+
+def get_discount_policy(segments: list[dict], financials: pd.DataFrame) -> DiscountPolicy:
+    """
+    Compiled policy for (config, financials), served from an LRU cache so repeated
+    runs with the same config skip policy preparation.
+    """
+    key = (config_hash(segments), financials_version(financials))
+    with _POLICY_CACHE_LOCK:
+        policy = _POLICY_CACHE.get(key)
+        if policy is not None:
+            _POLICY_CACHE.move_to_end(key)
+            return policy
+
+    policy = compile_discount_policy(segments, financials)
+    with _POLICY_CACHE_LOCK:
+        _POLICY_CACHE[key] = policy
+        _POLICY_CACHE.move_to_end(key)
+        while len(_POLICY_CACHE) > DISCOUNT_POLICY_CACHE_SIZE:
+            _POLICY_CACHE.popitem(last=False)
+    return policy
@@ -0,0 +1,163 @@
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+from app.config import DISCOUNT_PREVIEW_FRACTION, DISCOUNT_PREVIEW_MIN_PER_STRATUM
+from app.services.discount_policy import get_discount_policy
+from app.services.discounts import load_inputs, add_features, iter_candidate_batches, BestOfferReducer
+from app.services.join_keys import HOTEL_CODE
+
+STRATA_COLS = [HOTEL_CODE, "booking_segment"]
+
+
+def stratified_booking_sample(bookings: pd.DataFrame,
+                              fraction: float = DISCOUNT_PREVIEW_FRACTION,
+                              min_per_stratum: int = DISCOUNT_PREVIEW_MIN_PER_STRATUM,
+                              seed: int = 0) -> pd.DataFrame:
+    """
+    Simple random sample of bookings within each (hotel, booking_segment) stratum.
+    Returns one row per sampled booking: its position in `bookings`, stratum id,
+    stratum size N_h and sample size n_h.
+    """
+    strata = bookings.groupby(STRATA_COLS, dropna=False, sort=True).ngroup().to_numpy()
+    sizes = np.bincount(strata)
+    take = np.minimum(sizes, np.maximum(min_per_stratum, np.ceil(fraction * sizes).astype(int)))
+
+    # Random order within each stratum; keep the first n_h of each
+    order = np.lexsort((np.random.default_rng(seed).random(len(strata)), strata))
+    rank = np.arange(len(order)) - np.searchsorted(strata[order], strata[order])
+    picked = np.sort(order[rank < take[strata[order]]])
+
+    return pd.DataFrame({
+        "booking_pos": picked,
+        "stratum": strata[picked],
+        "N_h": sizes[strata[picked]],
+        "n_h": take[strata[picked]],
+    })
+
+
+def best_target_per_guest(bookings: pd.DataFrame, financials: pd.DataFrame, segments: list[dict],
+                          only_critical: bool = False, gap_threshold: float = 10.0) -> pd.DataFrame:
+    """
+    Each guest's best target among `bookings`, chosen by the same reducer as a full run:
+    one (email, booking_pos, discount_pct) row per guest that gets an offer.
+    """
+    policy = get_discount_policy(segments, financials)
+    reducer = BestOfferReducer(bookings)
+    for batch, _, booking_pos in iter_candidate_batches(
+        bookings, financials, segments,
+        only_critical=only_critical, gap_threshold=gap_threshold, policy=policy
+    ):
+        reducer.update(batch.assign(booking_pos=booking_pos))
+    if reducer.best is None:
+        return pd.DataFrame(columns=["email", "booking_pos", "discount_pct"])
+    return reducer.best[["email", "booking_pos", "discount_pct"]]
+
+
+def _stratified_variance(values: pd.Series, sample: pd.DataFrame) -> float:
+    """Variance of the stratified estimate of sum(values) over all bookings."""
+    strata, idx = np.unique(sample["stratum"].to_numpy(), return_index=True)
+    code = np.searchsorted(strata, sample["stratum"].to_numpy())
+    v = values.to_numpy(dtype=float)
+    n = np.bincount(code).astype(float)
+    mean = np.bincount(code, weights=v) / n
+    ss = np.bincount(code, weights=(v - mean[code]) ** 2)
+    s2 = np.divide(ss, n - 1, out=np.zeros_like(ss), where=n > 1)  # 0 for a single sampled booking
+    N_h = sample["N_h"].to_numpy(dtype=float)[idx]
+    n_h = sample["n_h"].to_numpy(dtype=float)[idx]
+    return float((N_h ** 2 * (1 - n_h / N_h) * s2 / n_h).sum())
+
+
+def _interval(estimate: float, variance: float, z: float, digits: int) -> list[float]:
+    half = z * variance ** 0.5
+    return [round(estimate - half, digits), round(estimate + half, digits)]
+
+
+def preview_discount_outcomes(bookings: pd.DataFrame, financials: pd.DataFrame, segments: list[dict],
+                              fraction: float = DISCOUNT_PREVIEW_FRACTION,
+                              min_per_stratum: int = DISCOUNT_PREVIEW_MIN_PER_STRATUM,
+                              confidence: float = 0.95, seed: int = 0) -> dict:
+    """
+    Estimated offers and average discount per segment from a stratified sample of
+    bookings, with normal-approximation confidence intervals.
+
+    A full run sends one offer per guest, so `estimated_offers` estimates guests:
+    every booking of a sampled guest is evaluated to find the guest's best offer,
+    and each sampled booking counts for 1 / (the guest's number of bookings).
+    Offers are attributed to the segment of the booking they were picked from.
+    """
+    sample = stratified_booking_sample(bookings, fraction, min_per_stratum, seed).reset_index(drop=True)
+    sampled = bookings.iloc[sample["booking_pos"].to_numpy()].reset_index(drop=True)
+    guest_rows = bookings[bookings["email"].isin(sampled["email"].dropna().unique())]
+    best = best_target_per_guest(guest_rows, financials, segments)
+    best_segment = pd.to_numeric(guest_rows["booking_segment"], errors="coerce").to_numpy()[best["booking_pos"].to_numpy(dtype=int)]
+
+    sample["segment"] = pd.to_numeric(sampled["booking_segment"], errors="coerce").to_numpy()
+    discount = sampled["email"].map(best.set_index("email")["discount_pct"])
+    sample["offer_segment"] = sampled["email"].map(pd.Series(best_segment, index=best["email"].to_numpy())).to_numpy()
+    sample["discount_pct"] = discount.fillna(0.0).astype(float).to_numpy()
+    stays = sampled["email"].map(bookings["email"].value_counts())
+    sample["offer_share"] = (discount.notna() / stays).fillna(0.0).to_numpy(dtype=float)
+    sample["weight"] = sample["N_h"] / sample["n_h"]
+
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+
+    def _estimate(booked: pd.Series, offered: pd.Series) -> dict:
+        # Offers are a domain of the whole sample: a guest's bookings may sit in other strata
+        share = sample["offer_share"] * offered
+        offers = float((sample["weight"] * share).sum())
+        offers_var = _stratified_variance(share, sample)
+        rows = sample[booked]
+        block = {
+            "sampled_bookings": int(len(rows)),
+            "total_bookings": int(rows.drop_duplicates("stratum")["N_h"].sum()),
+            "estimated_offers": round(offers),
+            "offers_ci": _interval(offers, offers_var, z, 0),
+            "avg_discount_pct": None,
+            "avg_discount_ci": None,
+        }
+        if offers > 0:
+            # Ratio estimator; variance by linearisation
+            ratio = float((sample["weight"] * sample["discount_pct"] * share).sum()) / offers
+            residual = share * (sample["discount_pct"] - ratio)
+            ratio_var = _stratified_variance(residual, sample) / offers ** 2
+            block["avg_discount_pct"] = round(ratio, 2)
+            block["avg_discount_ci"] = _interval(ratio, ratio_var, z, 2)
+        return block
+
+    segments_preview = []
+    for seg in sample["segment"].drop_duplicates().sort_values(na_position="last"):
+        if pd.notnull(seg):
+            booked, offered = sample["segment"] == seg, sample["offer_segment"] == seg
+        else:
+            booked, offered = sample["segment"].isna(), sample["offer_segment"].isna()
+        segments_preview.append({"segment_id": int(seg) if pd.notnull(seg) else None, **_estimate(booked, offered)})
+
+    everything = pd.Series(True, index=sample.index)
+    return {
+        "success": True,
+        "confidence": confidence,
+        "sample_fraction": round(len(sample) / len(bookings), 4) if len(bookings) else 0.0,
+        "overall": _estimate(everything, everything),
+        "segments": segments_preview,
+    }
+
+
+def preview_discounts(email: str, discount_config: list[dict], fraction: float | None = None) -> dict:
+    """Quick estimate for a config before committing to a full generation run."""
+    try:
+        inputs = load_inputs(email)
+        if isinstance(inputs, dict):
+            return inputs
+        bookings, financials = inputs
+        if bookings.empty:
+            return {"success": False, "message": "No bookings found."}
+        bookings = add_features(bookings)
+        return preview_discount_outcomes(
+            bookings, financials, discount_config,
+            fraction=fraction or DISCOUNT_PREVIEW_FRACTION,
+        )
+
+    except Exception as e:
+        return {"success": False, "message": f"Error previewing discounts: {str(e)}"}
@@ -0,0 +1,126 @@
+import hashlib
+import json
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from app.db.supabase_client import supabase
+from app.services.discount_policy import config_hash
+from app.services.join_keys import JOIN_KEY_CODES
+
+# Offer fields compared to decide whether a regenerated offer changed
+OFFER_DIFF_FIELDS = [
+    "booking_id", "booking_segment_record_id", "email", "hotel", "room_type",
+    "booking_segment", "business_label", "target_month", "target_year",
+    "discount_pct", "offer_type", "perks", "amenities_used_before",
+]
+
+
+def bookings_version(bookings: pd.DataFrame) -> str:
+    """Content hash of the bookings, independent of row order and of the join key codes."""
+    cols = sorted(c for c in bookings.columns if c not in JOIN_KEY_CODES)
+    h = hashlib.sha256(json.dumps(cols).encode("utf-8"))
+    h.update(np.sort(pd.util.hash_pandas_object(bookings[cols], index=False).to_numpy()).tobytes())
+    return h.hexdigest()
+
+
+def cluster_hashes(segments: list[dict]) -> dict[str, str]:
+    """Config hash per cluster_id (first config for a cluster wins, like the offer engine)."""
+    hashes = {}
+    for seg in segments:
+        hashes.setdefault(str(int(seg["cluster_id"])), config_hash([seg]))
+    return hashes
+
+
+def period_key(hotel_norm, room_type, month, year) -> str:
+    return f"{hotel_norm}|{room_type}|{str(month).lower()}|{year}"
+
+
+def period_hashes(financials: pd.DataFrame) -> dict[str, str]:
+    """Content hash per (hotel, room_type, month, year) financial slice (join key codes left out)."""
+    content = financials.drop(columns=[c for c in JOIN_KEY_CODES if c in financials.columns])
+    row_hashes = pd.util.hash_pandas_object(content, index=False).to_numpy()
+    keys = [
+        period_key(h, r, m, y)
+        for h, r, m, y in zip(financials["hotel_norm"], financials["room_type"], financials["month"], financials["year"])
+    ]
+    grouped = {}
+    for key, row_hash in zip(keys, row_hashes.tolist()):
+        grouped.setdefault(key, []).append(row_hash)
+    return {
+        key: hashlib.sha256(np.array(sorted(hs), dtype=np.uint64).tobytes()).hexdigest()
+        for key, hs in grouped.items()
+    }
+
+
+def build_run_state(bookings: pd.DataFrame, financials: pd.DataFrame, segments: list[dict]) -> dict:
+    return {
+        "config": segments,
+        "cluster_hashes": cluster_hashes(segments),
+        "period_hashes": period_hashes(financials),
+        "bookings_version": bookings_version(bookings),
+    }
+
+
+def affected_emails(bookings: pd.DataFrame, prev_state: dict, state: dict) -> set:
+    """
+    Guests whose best offer may change between two runs: guests with a booking in a
+    segment whose config changed, or one that matches a changed financial slice.
+    A slice change also covers the other years of the same hotel+room_type+month,
+    since the earliest planned year decides which past stays qualify.
+    """
+    prev_clusters, clusters = prev_state.get("cluster_hashes", {}), state["cluster_hashes"]
+    changed_clusters = {
+        int(c) for c in set(prev_clusters) | set(clusters)
+        if prev_clusters.get(c) != clusters.get(c)
+    }
+
+    prev_periods, periods = prev_state.get("period_hashes", {}), state["period_hashes"]
+    changed_slices = {
+        tuple(k.rsplit("|", 3)[:3]) for k in set(prev_periods) | set(periods)
+        if prev_periods.get(k) != periods.get(k)
+    }
+
+    segment = pd.to_numeric(bookings["booking_segment"], errors="coerce")
+    in_changed_cluster = segment.isin(changed_clusters)
+    slice_keys = pd.Series(
+        list(zip(bookings["hotel_norm"], bookings["reserved_room_type"], bookings["arrival_date_month_lc"])),
+        index=bookings.index,
+    )
+    in_changed_slice = slice_keys.isin(changed_slices)
+
+    emails = bookings.loc[in_changed_cluster | in_changed_slice, "email"]
+    return set(emails.dropna())
+
+
+def offer_signature(offer: dict) -> str:
+    values = []
+    for field in OFFER_DIFF_FIELDS:
+        v = offer.get(field)
+        if isinstance(v, np.ndarray):
+            v = v.tolist()
+        if isinstance(v, np.generic):
+            v = v.item()
+        if field == "discount_pct" and v is not None:
+            v = float(v)
+        if field in ("booking_id", "booking_segment_record_id", "booking_segment", "target_year") and v is not None:
+            v = str(v)
+        values.append(v)
+    return json.dumps(values, default=str)
+
+
+def fetch_previous_run(user_id) -> dict | None:
+    res = supabase.table("discount_runs").select("*").eq("user_id", user_id).limit(1).execute()
+    return res.data[0] if res.data else None
+
+
+def save_run_state(user_id, state: dict) -> None:
+    supabase.table("discount_runs").upsert({
+        "user_id": user_id,
+        "config": state["config"],
+        "cluster_hashes": state["cluster_hashes"],
+        "period_hashes": state["period_hashes"],
+        "bookings_version": state["bookings_version"],
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }, on_conflict="user_id").execute()
@@ -0,0 +1,72 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from app.config import DISCOUNT_MP_START_METHOD, DISCOUNT_WORKERS
+from app.services.join_keys import HOTEL_CODE, MISSING
+from app.services.discounts import (
+    iter_candidate_batches, build_roomtype_preference, BestOfferReducer, prepare_email_ready_output
+)
+
+# Read-only inputs shared by every hotel partition in a worker process
+_SHARD_INPUTS: dict = {}
+
+
+def _init_worker(bookings: pd.DataFrame, financials: pd.DataFrame, pref: pd.DataFrame,
+                 segments: list[dict], only_critical: bool, gap_threshold: float):
+    _SHARD_INPUTS.update(
+        bookings=bookings, financials=financials, pref=pref, segments=segments,
+        only_critical=only_critical, gap_threshold=gap_threshold,
+    )
+
+
+def _best_offers_for_hotel(hotel_code: int) -> pd.DataFrame | None:
+    """Per-customer best offers among one hotel's candidates (reducer state, with candidate_seq)."""
+    bookings, financials = _SHARD_INPUTS["bookings"], _SHARD_INPUTS["financials"]
+    book_pos = np.flatnonzero(bookings[HOTEL_CODE].to_numpy() == hotel_code)
+    fin_pos = np.flatnonzero(financials[HOTEL_CODE].to_numpy() == hotel_code)
+
+    # rt_freq comes from the guest's full history, not just this hotel
+    reducer = BestOfferReducer(bookings, pref=_SHARD_INPUTS["pref"])
+    for batch, row_src, booking_pos in iter_candidate_batches(
+        bookings.iloc[book_pos],
+        financials.iloc[fin_pos],
+        _SHARD_INPUTS["segments"],
+        only_critical=_SHARD_INPUTS["only_critical"],
+        gap_threshold=_SHARD_INPUTS["gap_threshold"],
+    ):
+        # Global candidate order (financial row, then booking) for cross-hotel ties
+        reducer.update(batch, seq=fin_pos[row_src] * len(bookings) + book_pos[booking_pos])
+    return reducer.best
+
+
+def best_offers_sharded(bookings: pd.DataFrame,
+                        financials: pd.DataFrame,
+                        segments: list[dict],
+                        only_critical: bool = True,
+                        gap_threshold: float = 10.0,
+                        pref: pd.DataFrame | None = None) -> pd.DataFrame:
+    """
+    Hotel-partitioned `best_offers`: matching and offer logic run per hotel on a process
+    pool, and the per-hotel best offers are merged into one best offer per customer.
+    """
+    pref = build_roomtype_preference(bookings) if pref is None else pref
+    hotels = sorted(set(financials[HOTEL_CODE].tolist()) - {MISSING})
+
+    merged = BestOfferReducer(bookings, pref=pref)
+    workers = max(1, min(DISCOUNT_WORKERS, len(hotels)))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context(DISCOUNT_MP_START_METHOD),
+        initializer=_init_worker,
+        initargs=(bookings, financials, pref, segments, only_critical, gap_threshold),
+    ) as pool:
+        for best in pool.map(_best_offers_for_hotel, hotels):
+            merged.merge(best)
+
+    final_best = merged.result()
+    if final_best.empty:
+        return final_best
+    return prepare_email_ready_output(final_best)
@@ -0,0 +1,71 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from app.config import DISCOUNT_MP_START_METHOD, DISCOUNT_WORKERS
+from app.services.discounts import (
+    load_inputs, add_features, iter_target_batches, build_roomtype_preference,
+    BestOfferReducer, prepare_email_ready_output
+)
+from app.services.discount_summary import summarise_discount_offers
+
+# Read-only inputs shared by every simulation in a worker process
+_SIM_INPUTS: dict = {}
+
+
+def _init_worker(bookings: pd.DataFrame, financials: pd.DataFrame, pref: pd.DataFrame):
+    _SIM_INPUTS["bookings"] = bookings
+    _SIM_INPUTS["financials"] = financials
+    _SIM_INPUTS["pref"] = pref
+
+
+def _simulate_one(config: list[dict]) -> dict:
+    bookings = _SIM_INPUTS["bookings"]
+    financials = _SIM_INPUTS["financials"]
+
+    reducer = BestOfferReducer(bookings, pref=_SIM_INPUTS["pref"])
+    for batch in iter_target_batches(bookings, financials, config, only_critical=False, gap_threshold=10.0):
+        reducer.update(batch)
+
+    final_best = reducer.result()
+    if final_best.empty:
+        return {"success": False, "message": "No discount offers generated."}
+
+    # Shape like discount_offers rows, so the summary matches /discounts/summary
+    offers = prepare_email_ready_output(final_best).rename(columns={"id": "booking_id"})
+    return summarise_discount_offers(offers, financials.copy())
+
+
+def simulate_discount_configs(email: str, configs: list[list[dict]]) -> dict:
+    """
+    What-if run of several discount configs: bookings and financials are loaded once,
+    every config is evaluated in parallel on a process pool, and nothing is saved.
+    """
+    try:
+        inputs = load_inputs(email)
+        if isinstance(inputs, dict):
+            return inputs
+        bookings, financials = inputs
+        bookings = add_features(bookings)
+        pref = build_roomtype_preference(bookings)
+
+        workers = max(1, min(DISCOUNT_WORKERS, len(configs)))
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context(DISCOUNT_MP_START_METHOD),
+            initializer=_init_worker,
+            initargs=(bookings, financials, pref),
+        ) as pool:
+            summaries = list(pool.map(_simulate_one, configs))
+
+        return {
+            "success": True,
+            "results": [
+                {"config_index": i, "summary": summary}
+                for i, summary in enumerate(summaries)
+            ],
+        }
+
+    except Exception as e:
+        return {"success": False, "message": f"Error simulating discount configs: {str(e)}"}
@@ -0,0 +1,306 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from itertools import chain
+from uuid import uuid4
+
+import numpy as np
+import pandas as pd
+from fastapi.encoders import jsonable_encoder
+
+from app.config import DISCOUNT_SUMMARY_CACHE_SIZE
+from app.db.supabase_client import supabase
+from app.services.offer_sets import get_active_offer_set_id
+
+SUMMARY_KEY_COLS = [
+    "booking_id",           # safe if present; pandas will handle NaN→'nan'
+    "email_norm",
+    "hotel_norm",
+    "room_type",
+    "target_month",
+    "target_year",
+    "discount_pct",
+    "offer_type",
+]
+
+
+def _ensure_list(x):
+    if isinstance(x, list):
+        return x
+    if pd.isna(x):
+        return []
+    # Handle JSON-stringified lists or scalars
+    try:
+        v = json.loads(x)
+        return v if isinstance(v, list) else [v]
+    except Exception:
+        return [x]
+
+
+def _level_stats(df: pd.DataFrame, keys: list[str]) -> tuple[pd.DataFrame, np.ndarray]:
+    """
+    Offer count and mean prices per group of `keys`, groups in sorted order, plus
+    each row's group code. Rows are sorted once; means are taken over contiguous
+    slices so they match Series.mean() on the group exactly.
+    """
+    codes = df.groupby(keys, dropna=False, sort=True).ngroup().to_numpy()
+    order = np.argsort(codes, kind="stable")
+    starts = np.searchsorted(codes[order], np.arange(codes.max() + 1 if len(codes) else 0))
+
+    stats = df[keys].iloc[order[starts]].reset_index(drop=True)
+    stats["offers_count"] = np.diff(np.append(starts, len(codes)))
+    for col, name in [("discount_pct", "avg_discount_pct"), ("base_adr", "avg_base_adr"),
+                      ("post_discount_adr", "avg_post_discount_adr")]:
+        if not len(starts):
+            stats[name] = np.zeros(0)
+            continue
+        values = df[col].to_numpy(dtype=float)[order]
+        present = ~np.isnan(values)
+        sums = np.array([chunk.sum() for chunk in np.split(np.where(present, values, 0.0), starts[1:])])
+        counts = np.add.reduceat(present.astype(int), starts)
+        stats[name] = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    return stats, codes
+
+
+def _stats_block(row) -> dict:
+    return {
+        "offers_count": int(row.offers_count),
+        "avg_discount_pct": round(float(row.avg_discount_pct), 2),
+        "avg_base_adr": round(float(row.avg_base_adr), 2) if pd.notnull(row.avg_base_adr) else None,
+        "avg_post_discount_adr": round(float(row.avg_post_discount_adr), 2) if pd.notnull(row.avg_post_discount_adr) else None,
+    }
+
+
+def _most_common_perks(perks: pd.Series, seg_code: np.ndarray, n_segments: int) -> list[list]:
+    """Perks per segment by frequency, ties in first-seen order (like Counter.most_common)."""
+    result = [[] for _ in range(n_segments)]
+    lengths = perks.map(len).to_numpy()
+    if not lengths.sum():
+        return result
+    flat = pd.DataFrame({
+        "seg": np.repeat(seg_code, lengths),
+        "perk": list(chain.from_iterable(perks)),
+    })
+    flat["pos"] = np.arange(len(flat))
+    counts = (
+        flat.groupby(["seg", "perk"], dropna=False, sort=False)
+        .agg(n=("pos", "size"), first=("pos", "min"))
+        .reset_index()
+        .sort_values(["seg", "n", "first"], ascending=[True, False, True])
+    )
+    for seg, perk in zip(counts["seg"].tolist(), counts["perk"].tolist()):
+        result[seg].append(perk)
+    return result
+
+
+def prepare_offer_prices(offers_raw: pd.DataFrame, fin_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Deduplicated offers with base_adr (from the financials), post_discount_adr
+    and perks as lists. `offers_raw` has discount_offers columns; `fin_df` is
+    the tenant's financials.
+    """
+    # ---- Normalize & build a stable offer key (dedupe BEFORE any merge)
+    # Normalize email/hotel/room_type to reduce accidental dupes
+    offers_raw["email_norm"] = offers_raw["email"].astype(str).str.strip().str.lower()
+    offers_raw["hotel_norm"] = offers_raw["hotel"].astype(str).str.strip().str.lower()
+    offers_raw["room_type"]  = offers_raw["room_type"].astype(str).str.strip()
+
+    # Ensure all key cols exist
+    for c in SUMMARY_KEY_COLS:
+        if c not in offers_raw.columns:
+            offers_raw[c] = np.nan
+
+    # Hash the business key columns instead of joining them into strings row by row
+    offers_raw["offer_key"] = pd.util.hash_pandas_object(offers_raw[SUMMARY_KEY_COLS].astype(str), index=False).to_numpy()
+
+    # Dedup to unique offers
+    offers = offers_raw.drop_duplicates(subset=["offer_key"]).reset_index(drop=True)
+
+    # 1) Deduplicate financials to a single ADR per (hotel, room, month, year)
+    if not fin_df.empty:
+        fin_df["hotel_norm"] = fin_df["hotel_name"].astype(str).str.strip().str.lower()
+        fin_df["room_type"] = fin_df["room_type"].astype(str).str.strip()
+
+        # Prefer the most recent record if created_at exists; otherwise first occurrence
+        sort_cols = ["hotel_norm", "room_type", "year", "month"]
+        if "created_at" in fin_df.columns:
+            fin_df = fin_df.sort_values(sort_cols + ["created_at"], ascending=[True, True, True, True, False])
+        else:
+            fin_df = fin_df.sort_values(sort_cols, ascending=[True, True, True, True])
+
+        fin_dedup = (
+            fin_df
+            .drop_duplicates(subset=["hotel_norm", "room_type", "month", "year"], keep="first")
+            [["hotel_norm", "room_type", "month", "year", "adr"]]
+            .rename(columns={"adr": "base_adr"})
+        )
+    else:
+        fin_dedup = pd.DataFrame(columns=["hotel_norm", "room_type", "month", "year", "base_adr"])
+
+    # 2) Merge ADR (this will NOT multiply rows thanks to fin_dedup)
+    offers_adr = offers.merge(
+        fin_dedup,
+        left_on=["hotel_norm", "room_type", "target_month", "target_year"],
+        right_on=["hotel_norm", "room_type", "month", "year"],
+        how="left"
+    )
+
+    # 3) Compute post-discount ADR on whole columns
+    offers_adr["discount_pct"] = pd.to_numeric(offers_adr["discount_pct"], errors="coerce").fillna(0.0)
+    offers_adr["base_adr"] = pd.to_numeric(offers_adr["base_adr"], errors="coerce").astype(float)
+    post = (offers_adr["base_adr"] * (1 - offers_adr["discount_pct"] / 100.0)).to_numpy()
+    # round() per distinct value keeps Python's rounding exactly
+    post_values, post_idx = np.unique(post, return_inverse=True)
+    offers_adr["post_discount_adr"] = np.array([round(v, 2) for v in post_values.tolist()], dtype=float)[post_idx]
+
+    if "perks" in offers_adr.columns:
+        offers_adr["perks"] = offers_adr["perks"].map(_ensure_list)
+    else:
+        offers_adr["perks"] = [[] for _ in range(len(offers_adr))]
+    return offers_adr
+
+
+def summarise_discount_offers(offers_raw: pd.DataFrame, fin_df: pd.DataFrame) -> dict:
+    """
+    Aggregated summary of discount offers (overall → segment → room → month)
+    with robust deduplication to prevent inflated counts after joins.
+    """
+    offers_adr = prepare_offer_prices(offers_raw, fin_df)
+
+    # 4) Build the summary using the DEDUPED offers_adr
+    overall = {
+        "total_offers": int(len(offers_adr)),  # deduped count
+        "avg_discount_pct": round(float(offers_adr["discount_pct"].mean()), 2) if len(offers_adr) else 0.0,
+        "avg_base_adr": round(float(offers_adr["base_adr"].mean()), 2) if offers_adr["base_adr"].notnull().any() else None,
+        "avg_post_discount_adr": round(float(offers_adr["post_discount_adr"].mean()), 2) if offers_adr["post_discount_adr"].notnull().any() else None,
+    }
+
+    # Segment → Room → Month breakdowns; one grouped aggregation per level
+    seg_keys = ["booking_segment", "business_label"]
+    seg_stats, offers_adr["seg_code"] = _level_stats(offers_adr, seg_keys)
+    room_stats, offers_adr["room_code"] = _level_stats(offers_adr, seg_keys + ["room_type", "seg_code"])
+    month_stats, _ = _level_stats(offers_adr, seg_keys + ["room_type", "room_code", "target_month", "target_year"])
+    perks_by_seg = _most_common_perks(offers_adr["perks"], offers_adr["seg_code"].to_numpy(), len(seg_stats))
+
+    months_by_room = [[] for _ in range(len(room_stats))]
+    for row in month_stats.itertuples(index=False):
+        months_by_room[row.room_code].append({
+            "month": row.target_month,
+            "year": int(row.target_year) if pd.notnull(row.target_year) else None,
+            **_stats_block(row),
+        })
+
+    rooms_by_seg = [[] for _ in range(len(seg_stats))]
+    for room_code, row in enumerate(room_stats.itertuples(index=False)):
+        rooms_by_seg[row.seg_code].append({
+            "room_type": row.room_type,
+            **_stats_block(row),
+            "months": months_by_room[room_code],
+        })
+
+    segments_summary = []
+    for seg_code, row in enumerate(seg_stats.itertuples(index=False)):
+        segments_summary.append({
+            "segment_id": int(row.booking_segment) if pd.notnull(row.booking_segment) else None,
+            "business_label": row.business_label,
+            **_stats_block(row),
+            "most_common_perks": perks_by_seg[seg_code],
+            "rooms": rooms_by_seg[seg_code],
+        })
+
+    return {
+        "success": True,
+        "overall": overall,
+        "segments": segments_summary
+    }
+
+
+
+# (user_id, offer_set_id, financials version) -> (summary, etag); offer sets are immutable
+# once active and base ADRs change only with a new financials version
+_SUMMARY_CACHE: "OrderedDict[tuple, tuple[dict, str]]" = OrderedDict()
+_SUMMARY_CACHE_LOCK = threading.Lock()
+
+
+def summary_etag(summary: dict) -> str:
+    payload = json.dumps(summary, sort_keys=True, default=str, separators=(",", ":"))
+    return '"' + hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def get_financials_version(user_id) -> str | None:
+    res = supabase.table("financials_versions").select("version").eq("user_id", user_id).limit(1).execute()
+    return res.data[0]["version"] if res.data else None
+
+
+def bump_financials_version(user_id) -> None:
+    """
+    Write-time hook for financials uploads: a new version retires the tenant's cached
+    summaries in every worker. A failed bump must not fail the upload.
+    """
+    try:
+        supabase.table("financials_versions").upsert({
+            "user_id": user_id,
+            "version": str(uuid4()),
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }, on_conflict="user_id").execute()
+    except Exception as e:
+        print(f"[WARN] Financials version bump failed for {user_id}: {e}")
+
+
+def build_discount_summary(user_id, offer_set_id: str) -> dict:
+    offers_res = supabase.table("discount_offers").select("*").eq("offer_set_id", offer_set_id).execute()
+    if not offers_res.data:
+        return {"success": False, "message": "No active discount offers found."}
+    offers_raw = pd.DataFrame(offers_res.data)
+
+    # Fetch financials for base ADR
+    fin_res = supabase.table("financials").select("*").eq("user_id", user_id).execute()
+    fin_df = pd.DataFrame(fin_res.data) if fin_res.data else pd.DataFrame()
+
+    # JSON-safe (cast NumPy → native)
+    return jsonable_encoder(
+        summarise_discount_offers(offers_raw, fin_df),
+        custom_encoder={
+            np.int64: int,
+            np.int32: int,
+            np.float64: float,
+            np.float32: float
+        }
+    )
+
+
+def get_discount_summary(email: str) -> tuple[dict, str | None]:
+    """
+    Summary of the tenant's active offer set and its ETag, cached per (user_id,
+    offer_set_id, financials version); both are read from the database, so every
+    worker sees a new set or upload. The ETag is None when there is nothing to summarise.
+    """
+    user_res = supabase.table("users").select("user_id").eq("email", email).execute()
+    if not user_res.data:
+        return {"success": False, "message": f"No user found with email: {email}"}, None
+    user_id = user_res.data[0]["user_id"]
+
+    offer_set_id = get_active_offer_set_id(user_id)
+    if not offer_set_id:
+        return {"success": False, "message": "No active discount offers found."}, None
+
+    key = (user_id, offer_set_id, get_financials_version(user_id))
+    with _SUMMARY_CACHE_LOCK:
+        cached = _SUMMARY_CACHE.get(key)
+        if cached is not None:
+            _SUMMARY_CACHE.move_to_end(key)
+            return cached
+
+    summary = build_discount_summary(user_id, offer_set_id)
+    if not summary.get("success"):
+        return summary, None
+
+    entry = (summary, summary_etag(summary))
+    with _SUMMARY_CACHE_LOCK:
+        _SUMMARY_CACHE[key] = entry
+        _SUMMARY_CACHE.move_to_end(key)
+        while len(_SUMMARY_CACHE) > DISCOUNT_SUMMARY_CACHE_SIZE:
+            _SUMMARY_CACHE.popitem(last=False)
+    return entry
@@ -1,9 +1,17 @@
 import pandas as pd
-import json
-from datetime import datetime
+import numpy as np
 from app.db.supabase_client import supabase
 
-from app.config import MONTH_TO_NUM,REQUIRED_BOOKING_COLS, PERK_COST_COLS, AMENITY_USAGE_COLS
+from app.config import REQUIRED_BOOKING_COLS, AMENITY_USAGE_COLS, DISCOUNT_BATCH_FIN_ROWS, DISCOUNT_ENGINE, DISCOUNT_SHARD_BY_HOTEL
+from app.services.discount_policy import DiscountPolicy, SegmentPolicy, get_discount_policy
+from app.services.offer_sets import get_active_offer_set_id, write_offer_set
+from app.services.offer_cube import refresh_offer_cube
+from app.services.campaign_stats import refresh_campaign_stats
+from app.services.guest_profiles import amenity_names
+from app.services.join_keys import encode_join_keys, period_codes, HOTEL_CODE, MONTH_CODE, MISSING
+from app.services.discount_runs import (
+    build_run_state, affected_emails, offer_signature, fetch_previous_run, save_run_state
+)
 
 def load_inputs(email):
     try:
@@ -16,12 +24,15 @@ def load_inputs(email):
 
         
         #Step 2: make all previous booking history as inactive
-        response = supabase.table("financials").select("*").eq("user_id",user_id).eq("is_active", True).execute()
+        # Fixed row order, so content hashes and candidate tie-breaks don't vary between loads
+        response = supabase.table("financials").select("*").eq("user_id",user_id).eq("is_active", True).order("id").execute()
 
         financials = pd.DataFrame(response.data)
         financials.drop(columns=["id", "user_id",'is_active', 'created_at', 'updated_at'], inplace=True)
         response = supabase.rpc("get_booking_segments", {"p_user_id": user_id}).execute()
         bookings = pd.DataFrame(response.data)
+        if "id" in bookings.columns:
+            bookings = bookings.sort_values("id", kind="stable").reset_index(drop=True)
         print(response)
 
         # ---- Validate bookings
@@ -29,21 +40,14 @@ def load_inputs(email):
         if missing:
             raise ValueError(f"Bookings missing columns: {sorted(missing)}")
 
-        # ---- Normalize keys used for joins
-        bookings["hotel_norm"] = bookings["hotel"].str.lower().str.strip()
-        financials["hotel_norm"] = financials["hotel_name"].str.lower().str.strip()
-
-        # Normalize room types on both sides (string, trimmed)
-        bookings["reserved_room_type"] = bookings["reserved_room_type"].astype(str).str.strip()
-        financials["room_type"] = financials["room_type"].astype(str).str.strip()
-
         # adr -> numeric
         bookings["adr"] = pd.to_numeric(bookings["adr"], errors="coerce")
 
-        # month lower-case in bookings for logic
-        bookings["arrival_date_month_lc"] = bookings["arrival_date_month"].astype(str).str.lower()
-        if not bookings["arrival_date_month_lc"].isin(MONTH_TO_NUM.keys()).all():
-            bad = bookings.loc[~bookings["arrival_date_month_lc"].isin(MONTH_TO_NUM.keys()), "arrival_date_month"].unique()
+        # ---- Integer join keys (hotel, room type, month) from one shared dictionary;
+        # also sets the normalised hotel_norm / room type / month label columns
+        encode_join_keys(bookings, financials)
+        if (bookings[MONTH_CODE] == MISSING).any():
+            bad = bookings.loc[bookings[MONTH_CODE] == MISSING, "arrival_date_month"].unique()
             raise ValueError(f"Unexpected month names in bookings: {bad.tolist()}")
 
         # ---- Financials soft checks (warn only)
@@ -82,172 +86,259 @@ def add_features(bookings: pd.DataFrame) -> pd.DataFrame:
     return bookings
 
 
-def month_num(m_lc: str) -> int:
-    return MONTH_TO_NUM[m_lc]
+def planned_period_cutoffs(financials: pd.DataFrame) -> pd.DataFrame:
+    """Earliest planned year per (hotel, room type, month) period code in the financials."""
+    periods = pd.DataFrame({
+        "period": period_codes(financials),
+        "year": financials["year"].to_numpy(),
+    })
+    periods = periods[(periods["period"] != MISSING) & periods["year"].notna()]
+    return (
+        periods.groupby("period", as_index=False)["year"].min()
+        .rename(columns={"year": "cutoff_year"})
+    )
+
+
+def booking_match_keys(bookings: pd.DataFrame) -> pd.DataFrame:
+    """Period code and stay year of every booking, by position."""
+    return pd.DataFrame({
+        "booking_pos": np.arange(len(bookings)),
+        "period": period_codes(bookings),
+        "arrival_date_year": bookings["arrival_date_year"].to_numpy(),
+    })
 
 
-def match_customers_for_month(
-    bookings: pd.DataFrame,
-    hotel_norm: str,
-    month_name: str,
-    room_type: str,
-    financials: pd.DataFrame
+def match_customers_for_periods(
+    booking_keys: pd.DataFrame,
+    fin: pd.DataFrame,
+    cutoffs: pd.DataFrame
 ) -> pd.DataFrame:
     """
-    Pick past guests who stayed in the same month at this hotel *and* in the same room type,
-    and assign the earliest *future* month-year for that hotel+room_type from financials.
+    Set-based matching for every financial row in `fin` at once.
+
+    Past guests match a financial row when they stayed at the same hotel, in the same
+    month *and* room type, before the earliest planned year for that hotel+room_type+month
+    (`cutoffs`). Returns (fin_pos, booking_pos) positional pairs ordered by financial
+    row, then booking, i.e. the order the per-row matching produced.
     """
-    m_lc = month_name.lower()
-    m_num = month_num(m_lc)
-
-    # Financial periods available for this hotel + room_type
-    avail = financials[
-        (financials["hotel_norm"] == hotel_norm) &
-        (financials["room_type"] == room_type)
-    ][["month", "year"]].drop_duplicates()
-
-    if avail.empty:
-        return pd.DataFrame()  # no plan for this room type at this hotel
-
-    # Attach numeric month for matching
-    avail["month_num"] = avail["month"].str.lower().map(month_num)
-    same_month = avail[avail["month_num"] == m_num]
-    if same_month.empty:
-        return pd.DataFrame()  # no plan for this month for that room type
-
-    # Earliest available (year, then month)
-    same_month = same_month.sort_values(["year", "month_num"])
-    target_period = same_month.iloc[0]
-    target_month, target_year = target_period["month"], int(target_period["year"])
-
-    # Build booking helpers
-    df = bookings.copy()
-    df["stay_month_num"] = df["arrival_date_month_lc"].map(month_num)
-    df["stay_date"] = pd.to_datetime({
-        "year": df["arrival_date_year"].astype(int),
-        "month": df["stay_month_num"],
-        "day": 1
+    fin_keys = pd.DataFrame({
+        "fin_pos": np.arange(len(fin)),
+        "period": period_codes(fin),
     })
+    fin_keys = fin_keys[fin_keys["period"] != MISSING].merge(cutoffs, on="period", how="inner")
 
-    # Past guests at same hotel + month + same room type, before target year
-    candidates = df[
-        (df["hotel_norm"] == hotel_norm) &
-        (df["stay_month_num"] == m_num) &
-        (df["reserved_room_type"] == room_type) &
-        (df["arrival_date_year"] < target_year)
-    ].copy()
+    # Single int join on the period code, then keep stays before the target year
+    pairs = fin_keys.merge(booking_keys, on="period", how="inner")
+    pairs = pairs[pairs["arrival_date_year"] < pairs["cutoff_year"]]
+    pairs = pairs.sort_values(["fin_pos", "booking_pos"], kind="stable")
+    return pairs[["fin_pos", "booking_pos"]].reset_index(drop=True)
 
-    if candidates.empty:
-        return pd.DataFrame()
 
-    candidates["target_month"] = target_month
-    candidates["target_year"] = target_year
-    return candidates
+def amenity_used_matrix(rows: pd.DataFrame, perks: list[str]) -> np.ndarray:
+    """Whether each guest used each perk's amenity before, shape (len(rows), len(perks))."""
+    used = np.zeros((len(rows), len(perks)), dtype=bool)
+    for j, perk in enumerate(perks):
+        col = AMENITY_USAGE_COLS.get(perk)
+        if col and col in rows.columns:
+            used[:, j] = pd.to_numeric(rows[col]).fillna(0).to_numpy().astype(int) == 1
+    return used
 
 
-def season_band_from_financial_row(fin_row: pd.Series) -> str:
+def choose_perks(used: np.ndarray, costs: np.ndarray, priority: list[str], max_cost: float):
     """
-    Prefer explicit 'booking_percent' if present, else use forecast as a proxy.
+    Greedy budgeted perk selection for many guests at once.
+
+    `used` and `costs` are (rows, len(priority)) arrays aligned to the manager's priority list.
+    Perks the guest used before go first, then the rest, each in priority order; a perk is
+    added while the running total stays within `max_cost`. Returns (perk lists, total cost).
     """
-    if "booking_percent" in fin_row:
-        val = fin_row["booking_percent"]
-    elif "forecast_booking_percent" in fin_row:
-        val = fin_row["forecast_booking_percent"]
-    else:
-        # fallback: neutral
-        return "shoulder"
+    n, n_perks = used.shape
+    total = np.zeros(n, dtype=float)
+    if n_perks == 0:
+        return [[] for _ in range(n)], total
+
+    # Per-guest perk order depends only on the used-amenity bitmask
+    bits = 1 << np.arange(n_perks, dtype=np.int64)
+    used_mask = (used * bits).sum(axis=1)
+    masks, mask_idx = np.unique(used_mask, return_inverse=True)
+    orders = np.array([
+        [j for j in range(n_perks) if m & (1 << j)] + [j for j in range(n_perks) if not m & (1 << j)]
+        for m in masks
+    ])
+    order = orders[mask_idx]
+
+    rows = np.arange(n)
+    chosen_mask = np.zeros(n, dtype=np.int64)
+    for step in range(n_perks):
+        c = costs[rows, order[:, step]]
+        ok = (total + c <= max_cost) & (c >= 0)
+        total = np.where(ok, total + c, total)
+        chosen_mask |= np.where(ok, 1 << step, 0)
+
+    # Decode (perk order, chosen steps) → perk names once per distinct combination
+    keys, key_idx = np.unique(mask_idx * (1 << n_perks) + chosen_mask, return_inverse=True)
+    decoded = [
+        [priority[j] for step, j in enumerate(orders[k >> n_perks]) if (k & ((1 << n_perks) - 1)) >> step & 1]
+        for k in keys.tolist()
+    ]
+    return [list(decoded[i]) for i in key_idx], total
 
-    try:
-        val = float(val)
-    except Exception:
-        return "shoulder"
 
-    if val < 50:
-        return "low"
-    elif val < 75:
-        return "shoulder"
-    else:
-        return "high"
+def apply_offer_logic(rows: pd.DataFrame, seg: SegmentPolicy, policy: DiscountPolicy, fin_src: np.ndarray) -> pd.DataFrame:
+    """
+    Discount and perks for all candidate rows of one segment.
+    `fin_src` gives each row's financial row position in the compiled policy.
+    """
+    # Baseline by season band (low/shoulder/high)
+    base = seg.baseline[policy.season_codes[fin_src]]
 
+    # Occupancy gap boost
+    base = np.where(policy.occ_gaps[fin_src] > 10, base + seg.boost_if_high_gap, base)
 
-def occupancy_gap(fin_row: pd.Series) -> float:
-    tgt = fin_row.get("target_booking_percent", None)
-    fc = fin_row.get("forecast_booking_percent", None)
-    try:
-        return float(tgt) - float(fc)
-    except Exception:
-        return 0.0
+    # Floor for price sensitive segments
+    if seg.price_floor is not None:
+        price_sensitive = pd.to_numeric(rows["is_price_sensitive"]).fillna(0).to_numpy().astype(int) == 1
+        base = np.where(price_sensitive, np.maximum(base, seg.price_floor), base)
 
+    # Loyalty tweak: small discount reduction in favour of perk
+    repeated = pd.to_numeric(rows["is_repeated_guest"]).fillna(0).to_numpy().astype(int) == 1
+    base = np.where(repeated & (base > 0.05), base - 0.02, base)
 
-def choose_perks(row: pd.Series, seg_conf: dict, fin_row: pd.Series) -> list[str]:
-    # Allowed perks only from manager's list
-    priority = seg_conf.get("perk_priority", [])
-    if not priority:
-        priority = ["bar_credit", "gym", "kids_club", "spa", "swimming_pool", "work_desk", "meeting_room"]
+    # Perk selection
+    perks, perk_total = choose_perks(
+        amenity_used_matrix(rows, seg.perk_priority),
+        policy.perk_costs[fin_src][:, seg.perk_cols],
+        seg.perk_priority,
+        seg.max_perk_cost,
+    )
 
-    # Build cost map for allowed perks only
-    cost_map = {
-        perk: float(fin_row.get(PERK_COST_COLS.get(perk, ""), 0) or 0)
-        for perk in priority
-    }
+    # ADR vs perk cost guardrail (if costs provided)
+    adr_val = pd.to_numeric(rows["adr"]).fillna(0).to_numpy() if "adr" in rows.columns else np.zeros(len(rows))
+    base = np.where((adr_val * base > 0.8 * perk_total) & (perk_total > 0), 0.0, base)
 
-    # Identify perks guest has used before (and are in allowed list)
-    used_perks = [
-        perk for perk in priority
-        if AMENITY_USAGE_COLS.get(perk) and int(row.get(AMENITY_USAGE_COLS[perk], 0)) == 1
-    ]
+    # round() per distinct value keeps Python's rounding exactly
+    pct_values, pct_idx = np.unique(base * 100, return_inverse=True)
+    return pd.DataFrame({
+        "discount_pct": np.array([round(v, 1) for v in pct_values.tolist()], dtype=float)[pct_idx],
+        "offer_type": np.where(base > 0, "Discount", "Perk").astype(object),
+        "perks": perks,
+    }, index=rows.index)
 
-    # Remaining allowed perks guest hasn’t used yet
-    unused_perks = [perk for perk in priority if perk not in used_perks]
 
-    # Final order = used perks first, then unused perks (both restricted to manager's allowed list)
-    perk_order = used_perks + unused_perks
+def compute_offers(matched: pd.DataFrame, policy: DiscountPolicy, fin_src: np.ndarray) -> pd.DataFrame:
+    """
+    Columnar offer engine: `discount_pct`, `offer_type` and `perks` for every matched row.
+    `fin_src` gives each row's financial row position in the compiled policy.
+    """
+    discount_pct = np.zeros(len(matched), dtype=float)
+    offer_type = np.full(len(matched), "None", dtype=object)
+    perks = [[] for _ in range(len(matched))]
+
+    seg_pos = policy.segment_positions(matched["booking_segment"])
+    for i in np.unique(seg_pos[seg_pos >= 0]):
+        sel = np.flatnonzero(seg_pos == i)
+        seg_offers = apply_offer_logic(matched.iloc[sel], policy.segments[i], policy, fin_src[sel])
+        discount_pct[sel] = seg_offers["discount_pct"].to_numpy()
+        offer_type[sel] = seg_offers["offer_type"].to_numpy()
+        for k, p in zip(sel, seg_offers["perks"]):
+            perks[k] = p
+
+    return pd.DataFrame(
+        {"discount_pct": discount_pct, "offer_type": offer_type, "perks": perks},
+        index=matched.index,
+    )
 
-    # Add perks while staying under budget
-    max_cost = float(seg_conf.get("max_perk_cost", 0) or 0)
-    chosen, total = [], 0.0
-    for perk in perk_order:
-        c = cost_map.get(perk, 0)
-        if total + c <= max_cost and c >= 0:
-            chosen.append(perk)
-            total += c
 
-    return chosen
+def booking_helpers(bookings: pd.DataFrame) -> pd.DataFrame:
+    """Copy of the bookings with numeric stay month and stay date."""
+    df = bookings.copy()
+    df["stay_month_num"] = df[MONTH_CODE]
+    df["stay_date"] = pd.to_datetime({
+        "year": df["arrival_date_year"].astype(int),
+        "month": df["stay_month_num"],
+        "day": 1
+    })
+    return df
 
 
+def build_candidates(df: pd.DataFrame, fin: pd.DataFrame, fin_pos: np.ndarray, booking_pos: np.ndarray,
+                     row_src: np.ndarray, policy: DiscountPolicy) -> pd.DataFrame:
+    """
+    Candidate rows for matched (financial row, booking) pairs: the booking plus the target
+    period attributes. `fin_pos` indexes `fin`, `row_src` the financials the policy was built on.
+    """
+    matched = df.iloc[booking_pos].reset_index(drop=True)
+    matched["target_month"] = fin["month"].to_numpy()[fin_pos]
+    matched["target_year"] = fin["year"].to_numpy()[fin_pos].astype(int)  # month-year coming from fin row
+    matched["target_month_num"] = fin[MONTH_CODE].to_numpy()[fin_pos]
+    # month-level attrs come precomputed from the policy
+    matched["season_band"] = policy.season_bands[row_src]
+    matched["occ_gap"] = policy.occ_gaps[row_src]
+    # Ensure the email-ready 'room_type' equals the plan's room type (and matches guest history)
+    matched["room_type"] = matched["reserved_room_type"]  # they match by construction
+    return matched
+
+
+def iter_candidate_batches(bookings: pd.DataFrame,
+                           financials: pd.DataFrame,
+                           segments: list[dict],
+                           only_critical: bool = True,
+                           gap_threshold: float = 10.0,
+                           policy: DiscountPolicy | None = None,
+                           batch_size: int = DISCOUNT_BATCH_FIN_ROWS):
+    """
+    Yield (candidates, financial row positions, booking positions) in batches of
+    `batch_size` financial rows. Positions index `financials` and `bookings`.
+    """
+    # Segment configs compiled against these financials (cached across runs)
+    policy = policy or get_discount_policy(segments, financials)
 
-def apply_offer_logic(row: pd.Series, seg_conf: dict, fin_row: pd.Series) -> pd.Series:
-    # Baseline by season band (low/shoulder/high)
-    season = row.get("season_band", "shoulder")
-    baseline_map = seg_conf.get("baseline", {})
-    base = float(baseline_map.get(season, 0) or 0)
+    fin = financials.copy()
+    fin["occ_gap"] = fin["target_booking_percent"] - fin["forecast_booking_percent"]
+    fin_src = np.arange(len(fin))
+    if only_critical:
+        critical = (fin["occ_gap"] > gap_threshold).to_numpy()
+        fin, fin_src = fin[critical], fin_src[critical]
+    fin = fin.reset_index(drop=True)
 
-    # Occupancy gap boost
-    if float(row.get("occ_gap", 0) or 0) > 10:
-        base += float(seg_conf.get("boost_if_high_gap", 0) or 0)
+    # Booking helpers, built once for all financial rows
+    df = booking_helpers(bookings)
+    booking_keys = booking_match_keys(df)
+    cutoffs = planned_period_cutoffs(financials)
 
-    # Floor for price sensitive segments
-    if int(row.get("is_price_sensitive", 0)) == 1:
-        base = max(base, float(baseline_map.get("low", base) or base))
+    for start in range(0, len(fin), batch_size):
+        chunk = fin.iloc[start:start + batch_size]
 
-    # Loyalty tweak: small discount reduction in favour of perk
-    if int(row.get("is_repeated_guest", 0)) == 1 and base > 0.05:
-        base -= 0.02
+        # Only match customers whose past stay month + room type fits a financial row
+        pairs = match_customers_for_periods(booking_keys, chunk, cutoffs)
+        if pairs.empty:
+            continue
 
-    # Perk selection
-    perks = choose_perks(row, seg_conf, fin_row)
+        fin_pos = pairs["fin_pos"].to_numpy()
+        row_src = fin_src[start + fin_pos]
+        matched = build_candidates(df, chunk, fin_pos, pairs["booking_pos"].to_numpy(), row_src, policy)
 
-    # ADR vs perk cost guardrail (if costs provided)
-    adr_val = float(row.get("adr", 0) or 0)
-    perk_total = sum(float(fin_row.get(PERK_COST_COLS.get(p, ""), 0) or 0) for p in perks)
-    if adr_val * base > 0.8 * perk_total and perk_total > 0:
-        base = 0.0  # prefer perks only
-
-    return pd.Series({
-        "discount_pct": round(base * 100, 1),
-        "offer_type": "Discount" if base > 0 else "Perk",
-        "perks": perks
-    })
+        # attach offers for all rows at once
+        offers = compute_offers(matched, policy, row_src)
+        yield pd.concat([matched, offers], axis=1), row_src, pairs["booking_pos"].to_numpy()
+
+
+def iter_target_batches(bookings: pd.DataFrame,
+                        financials: pd.DataFrame,
+                        segments: list[dict],
+                        only_critical: bool = True,
+                        gap_threshold: float = 10.0,
+                        policy: DiscountPolicy | None = None,
+                        batch_size: int = DISCOUNT_BATCH_FIN_ROWS):
+    """
+    Yield candidate offers in batches of `batch_size` financial rows, in the same
+    row order `generate_targets` returns them.
+    """
+    for batch, _, _ in iter_candidate_batches(
+        bookings, financials, segments,
+        only_critical=only_critical, gap_threshold=gap_threshold, policy=policy, batch_size=batch_size
+    ):
+        yield batch
 
 
 def generate_targets(bookings: pd.DataFrame,
@@ -255,52 +346,13 @@ def generate_targets(bookings: pd.DataFrame,
                      segments: list[dict],
                      target_year: int,
                      only_critical: bool = True,
-                     gap_threshold: float = 10.0) -> pd.DataFrame:
-
-    fin = financials.copy()
-    fin["occ_gap"] = fin["target_booking_percent"] - fin["forecast_booking_percent"]
-    if only_critical:
-        fin = fin[fin["occ_gap"] > gap_threshold]
-
-    out_frames = []
-    for _, fin_row in fin.iterrows():
-        hotel_norm = fin_row["hotel_norm"]
-        month_name = fin_row["month"]
-        room_type = fin_row["room_type"]  # <-- use room type
-        season_band = season_band_from_financial_row(fin_row)
-        occ_gap_val = occupancy_gap(fin_row)
-
-        # Only match customers whose past stay month + room type fits this financial row
-        matched = match_customers_for_month(
-            bookings=bookings,
-            hotel_norm=hotel_norm,
-            month_name=month_name,
-            room_type=room_type,
-            financials=financials
-        )
-        if matched.empty:
-            continue
-
-        # annotate month-level attrs
-        matched = matched.copy()
-        matched["season_band"] = season_band
-        matched["occ_gap"] = occ_gap_val
-        matched["target_month"] = month_name
-        matched["target_year"] = int(fin_row["year"])  # month-year coming from fin row
-        # Ensure the email-ready 'room_type' equals the plan's room type (and matches guest history)
-        matched["room_type"] = matched["reserved_room_type"]  # they match by construction
-
-        # attach offer per row
-        def _offer(row):
-            seg_conf = next((s for s in segments if int(s["cluster_id"]) == int(row["booking_segment"])), None)
-            if not seg_conf:
-                return pd.Series({"discount_pct": 0, "offer_type": "None", "perks": []})
-            return apply_offer_logic(row, seg_conf, fin_row)
-
-        offers = matched.apply(_offer, axis=1)
-        enriched = pd.concat([matched, offers], axis=1)
-        out_frames.append(enriched)
+                     gap_threshold: float = 10.0,
+                     policy: DiscountPolicy | None = None) -> pd.DataFrame:
 
+    out_frames = list(iter_target_batches(
+        bookings, financials, segments,
+        only_critical=only_critical, gap_threshold=gap_threshold, policy=policy
+    ))
     if not out_frames:
         return pd.DataFrame()
 
@@ -310,6 +362,9 @@ def build_roomtype_preference(bookings: pd.DataFrame) -> pd.DataFrame:
     """
     For each guest (email), count how many times they stayed in each room type
     so we can prefer their most-used type when deduping.
+    Built from the run's own bookings, not guest_profiles.room_type_stays: the
+    profiles count active booking_history rows, which need not be the rows
+    get_booking_segments returns, so the tie-breaks could differ.
     """
     pref = (
         bookings.groupby(["email", "reserved_room_type"], as_index=False)
@@ -321,59 +376,79 @@ def build_roomtype_preference(bookings: pd.DataFrame) -> pd.DataFrame:
     pref["reserved_room_type"] = pref["reserved_room_type"].astype(str).str.strip()
     return pref
 
-def pick_best_month_per_customer(df: pd.DataFrame, bookings: pd.DataFrame) -> pd.DataFrame:
+
+class BestOfferReducer:
     """
-    Deduplicate to one offer per customer (email), preferring:
+    Keeps one running best offer per customer (email) while candidate batches stream in,
+    so memory scales with the number of guests rather than candidates × months.
+
+    Preference order:
       1) Larger occupancy gap (occ_gap DESC)
       2) Earlier target (year ASC, month ASC)
       3) Guest’s most-used room type historically (rt_freq DESC)
-      4) As a tiny final tie-break: higher ADR (if present), else stable order
+      4) Higher ADR (if present), then earliest candidate
     """
-    if df.empty:
-        return df
-
-    # Month to num
-    month_to_num = {m: i for i, m in enumerate(
-        ["January","February","March","April","May","June",
-         "July","August","September","October","November","December"], 1)
-    }
 
-    d = df.copy()
-    d["target_month_num"] = d["target_month"].map(month_to_num)
-
-    # Build preference from bookings and merge on (email, room_type)
-    pref = build_roomtype_preference(bookings)
-    # In results, `room_type` equals the guest's `reserved_room_type` by construction.
-    d = d.merge(
-        pref[["email", "reserved_room_type", "rt_freq"]],
-        left_on=["email", "room_type"],
-        right_on=["email", "reserved_room_type"],
-        how="left"
-    )
-    d["rt_freq"] = d["rt_freq"].fillna(0)
-
-    # Sorting priority:
-    #   occ_gap DESC → bigger gap first
-    #   target_year ASC → earlier year first
-    #   target_month_num ASC → earlier month first
-    #   rt_freq DESC → guest’s most-used room type first
-    #   adr DESC (optional micro tie-break if present)
-    sort_cols = ["email", "occ_gap", "target_year", "target_month_num", "rt_freq"]
-    ascending = [True, False, True, True, False]
+    def __init__(self, bookings: pd.DataFrame, pref: pd.DataFrame | None = None):
+        pref = build_roomtype_preference(bookings) if pref is None else pref
+        self.rt_freq = pref.set_index(["email", "reserved_room_type"])["rt_freq"]
+        self.best = None
+        self.seen = 0
+
+    def update(self, batch: pd.DataFrame, seq: np.ndarray | None = None) -> None:
+        """
+        Fold a batch of candidates into the running best. `seq` orders candidates across
+        batches for final ties; by default batches are assumed to arrive in order.
+        """
+        if batch.empty:
+            return
+        d = batch[batch["email"].notna()].copy()
+        if seq is None:
+            seq = np.arange(self.seen, self.seen + len(batch))
+        d["candidate_seq"] = np.asarray(seq)[batch["email"].notna().to_numpy()]
+        self.seen += len(batch)
+
+        # In results, `room_type` equals the guest's `reserved_room_type` by construction.
+        keys = pd.MultiIndex.from_arrays([d["email"], d["room_type"]])
+        d["rt_freq"] = self.rt_freq.reindex(keys).fillna(0).to_numpy()
+
+        if self.best is not None:
+            d = pd.concat([self.best, d], ignore_index=True)
+
+        sort_cols = ["email", "occ_gap", "target_year", "target_month_num", "rt_freq"]
+        ascending = [True, False, True, True, False]
+        if "adr" in d.columns:
+            sort_cols.append("adr")
+            ascending.append(False)
+        sort_cols.append("candidate_seq")
+        ascending.append(True)
+
+        d = d.sort_values(by=sort_cols, ascending=ascending, kind="stable")
+        self.best = d.drop_duplicates(subset=["email"], keep="first")
+
+    def merge(self, best: pd.DataFrame | None) -> None:
+        """Fold in another reducer's `best` frame (e.g. from another partition)."""
+        if best is None:
+            return
+        best = best.drop(columns=["rt_freq"])
+        self.update(best.drop(columns=["candidate_seq"]), seq=best["candidate_seq"].to_numpy())
+
+    def result(self) -> pd.DataFrame:
+        if self.best is None:
+            return pd.DataFrame()
+        return self.best.drop(columns=["candidate_seq", "target_month_num", "rt_freq"]).reset_index(drop=True)
 
-    # If ADR exists, add it as a final tie-breaker (DESC)
-    if "adr" in d.columns:
-        sort_cols.append("adr")
-        ascending.append(False)
 
-    d = d.sort_values(by=sort_cols, ascending=ascending)
-
-    # Keep first per email
-    best = d.groupby("email", as_index=False).first()
+def pick_best_month_per_customer(df: pd.DataFrame, bookings: pd.DataFrame) -> pd.DataFrame:
+    """
+    Deduplicate to one offer per customer (email); see `BestOfferReducer` for the ordering.
+    """
+    if df.empty:
+        return df
 
-    # Clean up helper columns
-    drop_cols = [c for c in ["reserved_room_type_y", "target_month_num", "rt_freq"] if c in best.columns]
-    return best.drop(columns=drop_cols, errors="ignore")
+    reducer = BestOfferReducer(bookings)
+    reducer.update(df)
+    return reducer.result()
 
 
 def prepare_email_ready_output(df: pd.DataFrame) -> pd.DataFrame:
@@ -382,23 +457,8 @@ def prepare_email_ready_output(df: pd.DataFrame) -> pd.DataFrame:
         df = df.copy()
         df["room_type"] = df["reserved_room_type"]
 
-    # Map amenity usage columns to human-readable names
-    amenity_map = {
-        "is_spa_used": "spa",
-        "is_gym_used": "gym",
-        "is_kids_club_used": "kids_club",
-        "is_bar_used": "bar",
-        "is_swimming_pool_used": "swimming_pool",
-        "is_work_desk_used": "work_desk",
-        "is_meeting_room_used": "meeting_room",
-        "is_gaming_room_used": "gaming_room"
-    }
-
-    # Extract amenities used before for each customer
-    def extract_used_amenities(row):
-        return [name for col, name in amenity_map.items() if int(row.get(col, 0)) == 1]
-
-    df["amenities_used_before"] = df.apply(extract_used_amenities, axis=1)
+    # Amenities used on the booking, as human-readable names
+    df["amenities_used_before"] = amenity_names(df)
 
     
     # Columns to include in final output
@@ -419,36 +479,131 @@ def prepare_email_ready_output(df: pd.DataFrame) -> pd.DataFrame:
 
     return df[cols]
 
-def genrate_personalised_discounts(email, discountConfig):
-    bookings, financials = load_inputs(email)
-    segments = discountConfig
-    bookings = add_features(bookings)
-
-    result = generate_targets(
+def best_offers(bookings: pd.DataFrame, financials: pd.DataFrame, segments: list[dict],
+                pref: pd.DataFrame | None = None) -> pd.DataFrame:
+    """
+    Email-ready best offer per customer, streamed through the reducer.
+    `pref` is the room-type preference; built from `bookings` when None.
+    """
+    if DISCOUNT_ENGINE == "duckdb":
+        from app.services.discounts_sql import best_offers_sql
+        return best_offers_sql(bookings, financials, segments, only_critical=False, gap_threshold=10.0, pref=pref)
+    hotel_codes = financials[HOTEL_CODE]
+    if DISCOUNT_SHARD_BY_HOTEL and hotel_codes[hotel_codes != MISSING].nunique() > 1:
+        from app.services.discount_sharding import best_offers_sharded
+        return best_offers_sharded(bookings, financials, segments, only_critical=False, gap_threshold=10.0, pref=pref)
+
+    reducer = BestOfferReducer(bookings, pref=pref)
+    for batch in iter_target_batches(
         bookings=bookings,
         financials=financials,
         segments=segments,
-        target_year=2025,
         only_critical=False,
         gap_threshold=10.0
-    )
+    ):
+        reducer.update(batch)
+
+    final_best = reducer.result()
+    if final_best.empty:
+        return final_best
+    return prepare_email_ready_output(final_best)
 
-    if result.empty:
-        return {"success": False, "message": "No discount offers generated."}
 
-    final_best = pick_best_month_per_customer(result, bookings)
-    final_ready = prepare_email_ready_output(final_best)
+def genrate_personalised_discounts(email, discountConfig, incremental: bool = False):
+    bookings, financials = load_inputs(email)
+    segments = discountConfig
+    bookings = add_features(bookings)
 
-    # Optional: save a CSV for debugging
-    final_ready.to_csv("final_discount_targets2.csv", index=False)
-    print(f"Saved final_discount_targets.csv with {len(final_ready)} rows.")
+    user_res = supabase.table("users").select("user_id").eq("email", email).execute()
+    if not user_res.data:
+        return {"success": False, "message": f"No user found with email: {email}"}
+    user_id = user_res.data[0]["user_id"]
+
+    state = build_run_state(bookings, financials, segments)
+    if incremental:
+        prev = fetch_previous_run(user_id)
+        # New bookings can change any guest's offer, so they need a full run
+        if (prev and prev.get("bookings_version") == state["bookings_version"]
+                and get_active_offer_set_id(user_id)):
+            response = regenerate_changed_offers(user_id, bookings, financials, segments, prev, state)
+            if response.get("success"):
+                save_run_state(user_id, state)
+                refresh_offer_cube(user_id)
+                refresh_campaign_stats(user_id)
+            return response
+
+    final_ready = best_offers(bookings, financials, segments)
+    if final_ready.empty:
+        return {"success": False, "message": "No discount offers generated."}
 
     offers_list = final_ready.to_dict(orient="records")
 
     response = save_discount_offers_to_db(email, offers_list)
+    if response.get("success"):
+        save_run_state(user_id, state)
+        refresh_offer_cube(user_id)
+        refresh_campaign_stats(user_id)
     return response
 
 
+def regenerate_changed_offers(user_id, bookings, financials, segments, prev_state: dict, state: dict) -> dict:
+    """
+    Incremental regeneration: recompute offers only for guests touched by a changed
+    segment config or financial slice, and write only the offers that changed.
+    """
+    emails = affected_emails(bookings, prev_state, state)
+    if not emails:
+        return {"success": True, "mode": "incremental", "affected_guests": 0, "inserted_rows": 0, "replaced_rows": 0}
+
+    # Every booking of an affected guest, so rt_freq and the best-offer choice see the full history
+    new_ready = best_offers(bookings[bookings["email"].isin(emails)], financials, segments)
+    new_offers = new_ready.to_dict(orient="records") if not new_ready.empty else []
+
+    # Current offers for those guests in the active offer set
+    active_set_id = get_active_offer_set_id(user_id)
+    email_list = sorted(emails)
+    old_offers = []
+    for i in range(0, len(email_list), 200):
+        res = (
+            supabase.table("discount_offers")
+            .select("*")
+            .eq("offer_set_id", active_set_id)
+            .in_("email", email_list[i:i + 200])
+            .execute()
+        )
+        old_offers.extend(res.data or [])
+
+    old_by_sig = {}
+    for o in old_offers:
+        old_by_sig.setdefault(offer_signature(o), []).append(o["id"])
+
+    to_insert = []
+    for offer in new_offers:
+        sig = offer_signature({**offer, "booking_id": offer.get("id")})
+        if old_by_sig.get(sig):
+            old_by_sig[sig].pop()  # unchanged, carry the existing row over
+        else:
+            to_insert.append(offer)
+    to_replace = [oid for ids in old_by_sig.values() for oid in ids]
+
+    # New version = active set minus replaced rows, plus the changed offers
+    response = write_offer_set(
+        user_id,
+        build_offer_records(user_id, to_insert),
+        source_offer_set_id=active_set_id,
+        exclude_ids=to_replace,
+    )
+    if not response.get("success"):
+        return response
+
+    return {
+        **response,
+        "mode": "incremental",
+        "affected_guests": len(emails),
+        "replaced_rows": len(to_replace),
+    }
+
+
 def save_discount_config_to_db(email, discount_config):
     try:
         # Step 1: fetch user_id
@@ -503,6 +658,32 @@ def save_discount_config_to_db(email, discount_config):
             "message": f"Error saving discount configuration: {str(e)}"
         }
         
+def build_offer_records(user_id, discount_offers: list) -> list[dict]:
+    records = []
+    for offer in discount_offers:
+        records.append({
+            "booking_id": offer.get("id"),
+            "booking_segment_record_id": offer.get("booking_segment_record_id"),
+            "user_id": user_id,
+            "name": offer.get("name"),
+            "email": offer.get("email"),
+            "phone_number": offer.get("phone_number"),
+            "hotel": offer.get("hotel"),
+            "room_type": offer.get("room_type"),
+            "meal": offer.get("meal"),
+            "country": offer.get("country"),
+            "booking_segment": offer.get("booking_segment"),
+            "business_label": offer.get("business_label"),
+            "target_month": offer.get("target_month"),
+            "target_year": offer.get("target_year"),
+            "discount_pct": offer.get("discount_pct"),
+            "offer_type": offer.get("offer_type"),
+            "perks": offer.get("perks"),
+            "amenities_used_before": offer.get("amenities_used_before"),
+        })
+    return records
+
+
 def save_discount_offers_to_db(email: str, discount_offers: list):
     try:
         # Step 1: Fetch user_id from users table
@@ -512,41 +693,12 @@ def save_discount_offers_to_db(email: str, discount_offers: list):
 
         user_id = user_res.data[0]["user_id"]
 
-        # Step 2: Mark existing discount offers as inactive for this user
-        supabase.table("discount_offers").update({"is_active": False}).eq("user_id", user_id).execute()
+        # Step 2: Prepare new records
+        records = build_offer_records(user_id, discount_offers)
 
-        # Step 3: Prepare new records for insertion
-        records = []
-        for offer in discount_offers:
-            records.append({
-                "booking_id": offer.get("id"),
-                "booking_segment_record_id": offer.get("booking_segment_record_id"),
-                "user_id": user_id,
-                "name": offer.get("name"),
-                "email": offer.get("email"),
-                "phone_number": offer.get("phone_number"),
-                "hotel": offer.get("hotel"),
-                "room_type": offer.get("room_type"),
-                "meal": offer.get("meal"),
-                "country": offer.get("country"),
-                "booking_segment": offer.get("booking_segment"),
-                "business_label": offer.get("business_label"),
-                "target_month": offer.get("target_month"),
-                "target_year": offer.get("target_year"),
-                "discount_pct": offer.get("discount_pct"),
-                "offer_type": offer.get("offer_type"),
-                "perks": offer.get("perks"),
-                "amenities_used_before": offer.get("amenities_used_before"),
-                "is_active": True
-            })
-
-        # Step 4: Insert into discount_offers table
-        insert_res = supabase.table("discount_offers").insert(records).execute()
-
-        if insert_res.data:
-            return {"success": True, "inserted_rows": len(insert_res.data)}
-        else:
-            return {"success": False, "message": f"Insert failed: {insert_res.error}"}
+        # Step 3: Write them as a new offer set version and swap it in;
+        # the previous version stays active until the swap succeeds
+        return write_offer_set(user_id, records)
 
     except Exception as e:
         return {"success": False, "message": f"Error saving discount offers: {str(e)}"}
@@ -0,0 +1,133 @@
+"""
+Embedded SQL backend for the discount pipeline (DuckDB, optional dependency).
+
+Matching, the earliest-planned-year cutoff, the `only_critical`/`gap_threshold`
+prefilter and the per-customer top-1 run as one SQL query over Arrow snapshots
+of bookings and financials. The ranking does not depend on the offer, so offer
+rules are then applied only to each customer's winning candidate.
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from app.config import DUCKDB_THREADS, DUCKDB_MEMORY_LIMIT, DUCKDB_TEMP_DIR
+from app.services.discount_policy import DiscountPolicy, get_discount_policy
+from app.services.join_keys import period_codes, MONTH_CODE, MISSING
+from app.services.discounts import (
+    booking_helpers, build_candidates, build_roomtype_preference, compute_offers, prepare_email_ready_output
+)
+
+try:
+    import duckdb
+except ImportError:  # optional backend
+    duckdb = None
+
+
+BEST_OFFER_SQL = """
+WITH fin AS (
+    SELECT *
+    FROM fin_snapshot
+    WHERE NOT $only_critical OR occ_gap_raw > $gap_threshold
+),
+cutoffs AS (
+    SELECT period, min(year) AS cutoff_year
+    FROM period_snapshot
+    GROUP BY period
+),
+candidates AS (
+    SELECT
+        f.fin_src, b.booking_pos, b.email,
+        f.occ_gap, f.target_year, f.target_month_num,
+        coalesce(p.rt_freq, 0) AS rt_freq, b.adr
+    FROM fin f
+    JOIN cutoffs c
+      ON c.period = f.period
+    JOIN booking_snapshot b
+      ON b.period = f.period
+     AND b.arrival_date_year < c.cutoff_year
+    LEFT JOIN pref_snapshot p
+      ON p.email = b.email AND p.reserved_room_type = b.reserved_room_type
+    WHERE b.email IS NOT NULL
+)
+SELECT fin_src, booking_pos
+FROM candidates
+QUALIFY row_number() OVER (
+    PARTITION BY email
+    ORDER BY occ_gap DESC NULLS LAST,
+             target_year ASC NULLS LAST,
+             target_month_num ASC NULLS LAST,
+             rt_freq DESC NULLS LAST,
+             adr DESC NULLS LAST,
+             fin_src, booking_pos
+) = 1
+ORDER BY email
+"""
+
+
+def connect():
+    if duckdb is None:
+        raise RuntimeError("DISCOUNT_ENGINE=duckdb requires the 'duckdb' package to be installed.")
+    Path(DUCKDB_TEMP_DIR).mkdir(parents=True, exist_ok=True)
+    con = duckdb.connect()
+    con.execute(f"SET threads = {int(DUCKDB_THREADS)}")
+    con.execute(f"SET memory_limit = '{DUCKDB_MEMORY_LIMIT}'")
+    con.execute(f"SET temp_directory = '{DUCKDB_TEMP_DIR}'")  # spill large joins/sorts to disk
+    return con
+
+
+def _snapshots(df: pd.DataFrame, financials: pd.DataFrame, pref: pd.DataFrame, policy: DiscountPolicy) -> dict:
+    period = period_codes(financials)
+    fin_snapshot = pd.DataFrame({
+        "fin_src": np.arange(len(financials)),
+        "period": period,
+        "target_year": pd.to_numeric(financials["year"]).to_numpy(),
+        "target_month_num": financials[MONTH_CODE].to_numpy(),
+        "occ_gap_raw": (financials["target_booking_percent"] - financials["forecast_booking_percent"]).to_numpy(),
+        "occ_gap": policy.occ_gaps,
+    })[period != MISSING]
+    period_snapshot = fin_snapshot[["period", "target_year"]].rename(columns={"target_year": "year"}).dropna()
+    booking_snapshot = pd.DataFrame({
+        "booking_pos": np.arange(len(df)),
+        "email": df["email"].to_numpy(),
+        "period": period_codes(df),
+        "reserved_room_type": df["reserved_room_type"].to_numpy(),
+        "arrival_date_year": df["arrival_date_year"].to_numpy(),
+        "adr": pd.to_numeric(df["adr"]).to_numpy() if "adr" in df.columns else np.nan,
+    })
+    return {
+        "fin_snapshot": fin_snapshot,
+        "period_snapshot": period_snapshot,
+        "booking_snapshot": booking_snapshot,
+        "pref_snapshot": pref[["email", "reserved_room_type", "rt_freq"]],
+    }
+
+
+def best_offers_sql(bookings: pd.DataFrame,
+                    financials: pd.DataFrame,
+                    segments: list[dict],
+                    only_critical: bool = True,
+                    gap_threshold: float = 10.0,
+                    pref: pd.DataFrame | None = None) -> pd.DataFrame:
+    """DuckDB counterpart of `discounts.best_offers`: one email-ready best offer per customer."""
+    policy = get_discount_policy(segments, financials)
+    df = booking_helpers(bookings)
+    pref = build_roomtype_preference(bookings) if pref is None else pref
+
+    con = connect()
+    try:
+        for name, snapshot in _snapshots(df, financials, pref, policy).items():
+            con.register(name, snapshot)
+        winners = con.execute(
+            BEST_OFFER_SQL, {"only_critical": bool(only_critical), "gap_threshold": float(gap_threshold)}
+        ).df()
+    finally:
+        con.close()
+
+    if winners.empty:
+        return pd.DataFrame()
+
+    fin_src = winners["fin_src"].to_numpy()
+    matched = build_candidates(df, financials, fin_src, winners["booking_pos"].to_numpy(), fin_src, policy)
+    best = pd.concat([matched, compute_offers(matched, policy, fin_src)], axis=1)
+    return prepare_email_ready_output(best)
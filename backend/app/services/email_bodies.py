@@ -0,0 +1,131 @@
+"""
+Shared, compressed email bodies.
+
+A campaign's HTML and plain text are rendered with per-recipient placeholders
+({{first_name}}, {{coupon_code}}) and stored once per distinct content in
+`email_bodies`, keyed by SHA-256 and zlib-compressed. Each email_campaigns row
+keeps only the body hash and its own variables; the personalised HTML is rebuilt
+on demand with one placeholder pass.
+"""
+import base64
+import hashlib
+import json
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from app.config import EMAIL_BODY_CACHE_SIZE
+from app.db.supabase_client import supabase
+
+COUPON_PLACEHOLDER = "{{coupon_code}}"
+BODY_ENCODING = "zlib+base64"
+# Hashes per `in` filter when checking which bodies are already stored
+BODY_LOOKUP_CHUNK = 200
+
+_PLACEHOLDER = re.compile(r"\{\{\s*(first_name|coupon_code)\s*\}\}|\{(first_name)\}")
+
+# hash -> body; bodies are content-addressed, so a cached entry never goes stale
+_BODY_CACHE: "OrderedDict[str, dict]" = OrderedDict()
+_BODY_CACHE_LOCK = threading.Lock()
+
+
+def fill_placeholders(text: str | None, variables: dict) -> str:
+    """Replace the recipient placeholders in one scan; unknown ones are left as they are."""
+    return _PLACEHOLDER.sub(
+        lambda m: str(variables.get(m.group(1) or m.group(2), m.group(0))),
+        text or "",
+    )
+
+
+def body_hash(body: dict) -> str:
+    payload = json.dumps([body.get("html") or "", body.get("plain_text") or ""], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def compress_body(body: dict) -> str:
+    raw = json.dumps({"html": body.get("html") or "", "plain_text": body.get("plain_text") or ""}, ensure_ascii=False)
+    return base64.b64encode(zlib.compress(raw.encode("utf-8"), 9)).decode("ascii")
+
+
+def decompress_body(content: str) -> dict:
+    return json.loads(zlib.decompress(base64.b64decode(content)).decode("utf-8"))
+
+
+def _remember(key: str, body: dict) -> None:
+    with _BODY_CACHE_LOCK:
+        _BODY_CACHE[key] = body
+        _BODY_CACHE.move_to_end(key)
+        while len(_BODY_CACHE) > EMAIL_BODY_CACHE_SIZE:
+            _BODY_CACHE.popitem(last=False)
+
+
+def store_bodies(bodies: dict[str, dict]) -> dict:
+    """
+    Store the bodies (hash -> {html, plain_text}) not already in email_bodies.
+    Returns how many were new and their raw vs stored sizes in bytes.
+    """
+    hashes = list(bodies)
+    existing = set()
+    for i in range(0, len(hashes), BODY_LOOKUP_CHUNK):
+        res = supabase.table("email_bodies").select("hash").in_("hash", hashes[i:i + BODY_LOOKUP_CHUNK]).execute()
+        existing.update(r["hash"] for r in res.data or [])
+
+    now = datetime.now(timezone.utc).isoformat()
+    rows = []
+    for key in hashes:
+        if key in existing:
+            continue
+        content = compress_body(bodies[key])
+        raw_bytes = len((bodies[key].get("html") or "").encode("utf-8")) + len((bodies[key].get("plain_text") or "").encode("utf-8"))
+        rows.append({
+            "hash": key,
+            "content": content,
+            "encoding": BODY_ENCODING,
+            "size_bytes": raw_bytes,
+            "stored_bytes": len(content),
+            "created_at": now,
+        })
+    if rows:
+        # Another run may have stored the same body meanwhile; content is identical, so keep theirs
+        supabase.table("email_bodies").upsert(rows, on_conflict="hash", ignore_duplicates=True).execute()
+    for key, body in bodies.items():
+        _remember(key, body)
+    return {
+        "bodies": len(hashes),
+        "new": len(rows),
+        "size_bytes": sum(r["size_bytes"] for r in rows),
+        "stored_bytes": sum(r["stored_bytes"] for r in rows),
+    }
+
+
+def load_body(key: str) -> dict | None:
+    with _BODY_CACHE_LOCK:
+        body = _BODY_CACHE.get(key)
+        if body is not None:
+            _BODY_CACHE.move_to_end(key)
+            return body
+    res = supabase.table("email_bodies").select("content, encoding").eq("hash", key).limit(1).execute()
+    if not res.data:
+        return None
+    body = decompress_body(res.data[0]["content"])
+    _remember(key, body)
+    return body
+
+
+def render_campaign_body(row: dict) -> dict | None:
+    """
+    Personalised {html, plain_text} of an email_campaigns row: rebuilt from its shared
+    body when it has one, else the row's own columns (rows saved before bodies were shared).
+    """
+    if not row.get("body_hash"):
+        return {"html": row.get("html"), "plain_text": row.get("plain_text")}
+    body = load_body(row["body_hash"])
+    if body is None:
+        return None
+    variables = row.get("variables") or {}
+    return {
+        "html": fill_placeholders(body.get("html"), variables),
+        "plain_text": fill_placeholders(body.get("plain_text"), variables),
+    }
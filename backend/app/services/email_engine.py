@@ -0,0 +1,162 @@
+"""
+Async completion engine for email generation.
+
+Prompts are completed concurrently: a semaphore bounds the requests in flight,
+a token bucket keeps the request rate under the provider's limit, and 429/5xx
+and connection errors are retried with jittered exponential backoff. Results
+come back in prompt order, each with its latency and number of attempts.
+"""
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+
+import openai
+from openai import AsyncOpenAI
+
+from app.config import (
+    HF_API_TOKEN, EMAIL_LLM_BASE_URL, EMAIL_LLM_MODEL, EMAIL_LLM_TEMPERATURE, EMAIL_LLM_MAX_TOKENS,
+    EMAIL_LLM_CONCURRENCY, EMAIL_LLM_REQUESTS_PER_MINUTE, EMAIL_LLM_BURST,
+    EMAIL_LLM_MAX_RETRIES, EMAIL_LLM_BACKOFF_BASE, EMAIL_LLM_BACKOFF_MAX,
+)
+
+
+@dataclass
+class CompletionResult:
+    text: str | None = None
+    error: str | None = None
+    latency_ms: float = 0.0  # first request sent to final answer, including retries; not queueing
+    attempts: int = 0
+    cached: bool = False  # served without a completion of its own
+
+
+class TokenBucket:
+    """`rate` requests per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, float(capacity))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        # Waiters queue on the lock, so tokens are handed out in arrival order
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def drain(self) -> None:
+        """The provider said slow down: drop any banked burst."""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, openai.APIConnectionError):  # includes timeouts
+        return True
+    status = getattr(exc, "status_code", None)
+    return status == 429 or (status is not None and status >= 500)
+
+
+def _retry_after(exc: Exception) -> float | None:
+    response = getattr(exc, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base: float = EMAIL_LLM_BACKOFF_BASE, cap: float = EMAIL_LLM_BACKOFF_MAX) -> float:
+    """Full-jitter exponential backoff for the given (1-based) retry."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+async def _complete_one(client: AsyncOpenAI, prompt: str, semaphore: asyncio.Semaphore, bucket: TokenBucket,
+                        model: str, temperature: float, max_tokens: int, max_retries: int) -> CompletionResult:
+    result = CompletionResult()
+    start = None
+    while True:
+        result.attempts += 1
+        try:
+            async with semaphore:
+                await bucket.acquire()
+                start = start or time.perf_counter()
+                resp = await client.chat.completions.create(
+                    model=model,
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                )
+            result.text = (resp.choices[0].message.content or "").strip()
+            break
+        except Exception as e:
+            if not _is_retryable(e) or result.attempts > max_retries:
+                result.error = f"{type(e).__name__}: {e}"
+                break
+            if getattr(e, "status_code", None) == 429:
+                bucket.drain()
+            # Sleep outside the semaphore so other prompts keep the slots busy
+            await asyncio.sleep(max(backoff_delay(result.attempts), _retry_after(e) or 0.0))
+    result.latency_ms = round((time.perf_counter() - start) * 1000, 1) if start else 0.0
+    return result
+
+
+async def complete_prompts_async(prompts: list[str],
+                                 model: str = EMAIL_LLM_MODEL,
+                                 temperature: float = EMAIL_LLM_TEMPERATURE,
+                                 max_tokens: int = EMAIL_LLM_MAX_TOKENS,
+                                 concurrency: int = EMAIL_LLM_CONCURRENCY,
+                                 requests_per_minute: float = EMAIL_LLM_REQUESTS_PER_MINUTE,
+                                 burst: int = EMAIL_LLM_BURST,
+                                 max_retries: int = EMAIL_LLM_MAX_RETRIES) -> list[CompletionResult]:
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    bucket = TokenBucket(requests_per_minute / 60.0, burst)
+    # One client per run: its connection pool belongs to this event loop.
+    # Retries are ours, so the SDK's own are switched off.
+    async with AsyncOpenAI(base_url=EMAIL_LLM_BASE_URL, api_key=HF_API_TOKEN, max_retries=0) as client:
+        return await asyncio.gather(*(
+            _complete_one(client, p, semaphore, bucket, model, temperature, max_tokens, max_retries)
+            for p in prompts
+        ))
+
+
+def complete_prompts(prompts: list[str], **kwargs) -> list[CompletionResult]:
+    """Blocking entry point for sync callers (routes run in the threadpool, outside any loop)."""
+    if not prompts:
+        return []
+    return asyncio.run(complete_prompts_async(prompts, **kwargs))
+
+
+def generation_report(results: list[CompletionResult], elapsed_s: float, ids: list | None = None) -> dict:
+    """Run-level throughput and latency, plus each offer's latency, attempts and cache use."""
+    latencies = sorted(r.latency_ms for r in results if not r.cached and r.attempts)
+
+    def pct(q: float) -> float | None:
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else None
+
+    ids = ids if ids is not None else list(range(len(results)))
+    return {
+        "offers": len(results),
+        "completions": len(latencies),
+        "cache_hits": sum(r.cached for r in results),
+        "failed": sum(r.error is not None for r in results),
+        "retries": sum(max(0, r.attempts - 1) for r in results if not r.cached),
+        "elapsed_s": round(elapsed_s, 2),
+        "throughput_per_min": round(len(results) / elapsed_s * 60, 1) if elapsed_s > 0 else None,
+        "latency_ms": {"p50": pct(0.5), "p95": pct(0.95), "max": latencies[-1] if latencies else None},
+        "per_offer": [
+            {"offer_id": i, "latency_ms": r.latency_ms, "attempts": r.attempts, "cached": r.cached, "error": r.error}
+            for i, r in zip(ids, results)
+        ],
+    }
@@ -0,0 +1,115 @@
+"""
+Persistent, content-addressed cache of generated email plans.
+
+A plan is keyed by the SHA-256 of the fully formatted prompt plus the model and
+temperature, so any offer that formats to the same prompt reuses the plan. Plans
+live in a local SQLite file bounded to EMAIL_PLAN_CACHE_MAX_ENTRIES; the least
+recently used are evicted first.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from app.config import EMAIL_PLAN_CACHE_PATH, EMAIL_PLAN_CACHE_MAX_ENTRIES
+
+# SQLite's default limit on bound parameters is 999
+_KEY_CHUNK = 500
+
+
+def plan_cache_key(prompt: str, model: str, temperature: float) -> str:
+    payload = json.dumps([prompt, model, float(temperature)], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class EmailPlanCache:
+    def __init__(self, path: str = EMAIL_PLAN_CACHE_PATH, max_entries: int = EMAIL_PLAN_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._ready:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        con = sqlite3.connect(self.path, timeout=30)
+        if not self._ready:
+            con.execute("PRAGMA journal_mode=WAL")  # readers don't block the writer across workers
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS email_plans ("
+                " key TEXT PRIMARY KEY, plan TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            con.execute("CREATE INDEX IF NOT EXISTS email_plans_last_used ON email_plans (last_used)")
+            self._ready = True
+        return con
+
+    def get_many(self, keys: list[str]) -> dict[str, dict]:
+        """Cached plans for `keys` (missing keys are absent); hits are marked as recently used."""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            try:
+                con = self._connect()
+            except (sqlite3.Error, OSError) as e:
+                print(f"[WARN] Email plan cache unavailable: {e}")
+                return {}
+            try:
+                for i in range(0, len(keys), _KEY_CHUNK):
+                    chunk = keys[i:i + _KEY_CHUNK]
+                    marks = ",".join("?" * len(chunk))
+                    for key, plan in con.execute(f"SELECT key, plan FROM email_plans WHERE key IN ({marks})", chunk):
+                        found[key] = json.loads(plan)
+                    con.execute(f"UPDATE email_plans SET last_used = ? WHERE key IN ({marks})", [time.time(), *chunk])
+                con.commit()
+            except sqlite3.Error as e:
+                print(f"[WARN] Email plan cache read failed: {e}")
+            finally:
+                con.close()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, plans: dict[str, dict]) -> None:
+        if not plans:
+            return
+        now = time.time()
+        with self._lock:
+            try:
+                con = self._connect()
+            except (sqlite3.Error, OSError) as e:
+                print(f"[WARN] Email plan cache unavailable: {e}")
+                return
+            try:
+                con.executemany(
+                    "INSERT OR REPLACE INTO email_plans (key, plan, created_at, last_used) VALUES (?, ?, ?, ?)",
+                    [(k, json.dumps(p, ensure_ascii=False), now, now) for k, p in plans.items()],
+                )
+                con.execute(
+                    "DELETE FROM email_plans WHERE key IN ("
+                    " SELECT key FROM email_plans ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (max(0, self.max_entries),),
+                )
+                con.commit()
+            except sqlite3.Error as e:
+                print(f"[WARN] Email plan cache write failed: {e}")
+            finally:
+                con.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            try:
+                con = self._connect()
+                try:
+                    entries = con.execute("SELECT count(*) FROM email_plans").fetchone()[0]
+                finally:
+                    con.close()
+            except (sqlite3.Error, OSError):
+                entries = None
+            return {"hits": self.hits, "misses": self.misses, "entries": entries, "max_entries": self.max_entries}
+
+
+email_plan_cache = EmailPlanCache()
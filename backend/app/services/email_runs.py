@@ -0,0 +1,81 @@
+"""
+Email generation runs and their checkpoints.
+
+A run covers one (offer set, year, months) request. Emails are saved in
+checkpoints as they finish and the run's progress is recorded after each, so a
+run that dies halfway keeps its work: the next request for the same offers
+reopens the unfinished run and skips every offer that already has a campaign.
+"""
+from datetime import datetime, timezone
+from uuid import uuid4
+
+from app.db.supabase_client import supabase
+
+# Offer ids per `in` filter when looking up existing campaigns (keeps the URL short)
+CAMPAIGN_LOOKUP_CHUNK = 200
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def offers_with_campaigns(offer_ids: list) -> set:
+    """Ids among `offer_ids` that already have an email_campaigns row."""
+    ids = [i for i in dict.fromkeys(offer_ids) if i is not None]
+    found = set()
+    for i in range(0, len(ids), CAMPAIGN_LOOKUP_CHUNK):
+        res = (
+            supabase.table("email_campaigns")
+            .select("offer_id")
+            .in_("offer_id", ids[i:i + CAMPAIGN_LOOKUP_CHUNK])
+            .execute()
+        )
+        found.update(r["offer_id"] for r in res.data or [])
+    return found
+
+
+def start_email_run(user_id, offer_set_id, year: int, months: list[int] | None, total: int, skipped: int) -> dict:
+    """
+    Open a run for this request, reopening the latest unfinished one for the same
+    offer set, year and months if there is one. Returns {id, resumed}.
+    """
+    months = sorted(months or [])
+    res = (
+        supabase.table("email_generation_runs")
+        .select("id, months")
+        .eq("user_id", user_id)
+        .eq("offer_set_id", offer_set_id)
+        .eq("year", year)
+        .neq("status", "completed")
+        .order("created_at", desc=True)
+        .limit(5)
+        .execute()
+    )
+    previous = next((r for r in res.data or [] if sorted(r.get("months") or []) == months), None)
+    fields = {"status": "running", "total": total, "skipped": skipped, "done": 0, "failed": 0, "updated_at": _now()}
+    if previous:
+        supabase.table("email_generation_runs").update(fields).eq("id", previous["id"]).execute()
+        return {"id": previous["id"], "resumed": True}
+
+    run_id = str(uuid4())
+    supabase.table("email_generation_runs").insert({
+        "id": run_id,
+        "user_id": user_id,
+        "offer_set_id": offer_set_id,
+        "year": year,
+        "months": months,
+        "created_at": _now(),
+        **fields,
+    }).execute()
+    return {"id": run_id, "resumed": False}
+
+
+def checkpoint_email_run(run_id: str, done: int, failed: int, saved: int) -> None:
+    supabase.table("email_generation_runs").update({
+        "done": done, "failed": failed, "saved": saved, "updated_at": _now(),
+    }).eq("id", run_id).execute()
+
+
+def finish_email_run(run_id: str, status: str) -> None:
+    """`completed`, or `failed` / `interrupted` to have the next request resume it."""
+    supabase.table("email_generation_runs").update({"status": status, "updated_at": _now()}).eq("id", run_id).execute()
@@ -2,6 +2,8 @@ from fastapi import UploadFile
 import pandas as pd
 import io
 from app.db.supabase_client import supabase
+from app.services.discount_summary import bump_financials_version
+from app.services.offer_cube import refresh_offer_cube
 
 def load_data(file:UploadFile):
     filename = file.filename.lower()
@@ -43,6 +45,8 @@ def save_financial_data_to_db(fianacials,email):
                 "success": False,
                 "message": f"Error inserting financial data: {insert_response.error.message}"
             }
+        bump_financials_version(user_id)
+        refresh_offer_cube(user_id)
         return {
             "success": True,
             "message": "Booking history file uploaded successfully",
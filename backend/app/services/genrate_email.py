@@ -1,14 +1,35 @@
-import os, re, json, uuid
+import os, re, json, uuid, time, zlib, threading
+from collections import OrderedDict
 from typing import Dict, Any, List
 from openai import OpenAI
-from app.config import HF_API_TOKEN, ASSETS,ROOM_LETTER_TIER, AMENITY_LABELS, ROOM_TIER_FRIENDLY,MEAL_FRIENDLY,AMENITY_SLOGANS, SAFE_KEYS_OFFER, SAFE_KEYS_HISTORY, MONTH_NAME_TO_NUM, MONTH_NAMES,PROMPTS, TEMPLATES
+from fastapi.encoders import jsonable_encoder
+from app.config import HF_API_TOKEN, EMAIL_LLM_BASE_URL, EMAIL_LLM_MODEL, EMAIL_LLM_TEMPERATURE, EMAIL_LLM_MAX_TOKENS, EMAIL_LLM_BATCH_SIZE, EMAIL_LLM_BATCH_SIZE_MAX, EMAIL_PLAN_CACHE_ENABLED, EMAIL_GENERATION_MODE, EMAIL_COHORT_DISCOUNT_STEP, EMAIL_COHORT_VARIANTS, EMAIL_STREAM_CHUNK_SIZE, EMAIL_CHECKPOINT_SIZE, EMAIL_PREVIEW_CACHE_SIZE, ASSETS,ROOM_LETTER_TIER, AMENITY_LABELS, ROOM_TIER_FRIENDLY,MEAL_FRIENDLY,AMENITY_SLOGANS, SAFE_KEYS_OFFER, SAFE_KEYS_HISTORY, MONTH_NAME_TO_NUM, MONTH_NAMES,PROMPTS, TEMPLATES
 from app.db.supabase_client import supabase
+from app.services.offer_sets import get_active_offer_set_id
+from app.services.offer_cube import refresh_offer_cube
+from app.services.campaign_stats import bump_campaign_stats, get_campaign_counts, period_of, refresh_campaign_stats
+from app.services.guest_profiles import guest_histories
+from app.services.email_engine import CompletionResult, complete_prompts, generation_report
+from app.services.email_plan_cache import email_plan_cache, plan_cache_key
+from app.services.email_bodies import COUPON_PLACEHOLDER, body_hash, fill_placeholders, render_campaign_body, store_bodies
+from app.services.email_runs import offers_with_campaigns, start_email_run, checkpoint_email_run, finish_email_run
 
 client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
+    base_url=EMAIL_LLM_BASE_URL,
     api_key=HF_API_TOKEN  
 )
 
+# Used when the LLM fails or returns something unparseable, so one offer can't kill the run
+DEFAULT_EMAIL_PLAN = {
+    "subject": "Your Exclusive Hotel Offer",
+    "preheader": "A special rate picked for you",
+    "greeting": "Hi {{first_name}},",
+    "opening_line": "We’re excited to welcome you back.",
+    "offer_line": "Enjoy a limited‑time discount on your next stay.",
+    "perks_line": "",
+    "cta_text": "Book Now"
+}
+
 def get_discount_ofers(email: str, months: list[int] | None, year: int):
     """
     Fetch active discount_offers for a user, filtered by target_year and (optionally) months.
@@ -22,13 +43,16 @@ def get_discount_ofers(email: str, months: list[int] | None, year: int):
 
         user_id = user_res.data[0]["user_id"]
 
-        # 2) Build query (year + active); add month filter if provided
+        # 2) Build query (year + active offer set); add month filter if provided
+        offer_set_id = get_active_offer_set_id(user_id)
+        if not offer_set_id:
+            return {"success": True, "offers": [], "history": {}, "user_id": user_id}
+
         query = (
             supabase.table("discount_offers")
             .select("*")                     # <- use string, not {"*"}
-            .eq("user_id", user_id)
+            .eq("offer_set_id", offer_set_id)
             .eq("target_year", year)
-            .eq("is_active", True)
         )
 
         month_names = month_nums_to_names(months or [])
@@ -40,50 +64,175 @@ def get_discount_ofers(email: str, months: list[int] | None, year: int):
 
         # 3) If nothing, still return success w/ empty list (caller can handle)
         if not discount_offers:
-            return {"success": True, "offers": [], "history": []}
+            return {"success": True, "offers": [], "history": {}}
 
-        # 4) Fetch booking history for those with booking_id
-        booking_ids = [o["booking_id"] for o in discount_offers if o.get("booking_id")]
-        history_rows = []
-        if booking_ids:
-            hres = supabase.table("booking_history").select("*").in_("id", booking_ids).execute()
-            history_rows = hres.data or []
+        # 4) Guest context from the guest profiles, keyed by email
+        emails = [o["email"] for o in discount_offers if o.get("email")]
+        history = guest_histories(user_id, emails) if emails else {}
 
-        return {"success": True, "offers": discount_offers, "history": history_rows, "user_id": user_id}
+        return {"success": True, "offers": discount_offers, "history": history, "user_id": user_id,
+                "offer_set_id": offer_set_id}
 
     except Exception as e:
         return {"success": False, "message": f"Error fetching discount offers: {str(e)}"}
 
-def get_email_from_api(offer: Dict[str, Any]) -> Dict[str, str]:
-    """Call OpenRouter to generate a structured EmailPlan JSON (no PII)."""
-    history_context = build_history_context(offer.get("history"))
+EMAIL_PROMPT_FIELDS = ("segment", "hotel", "room_name", "stay", "discount_pct", "perks", "history")
 
-    # context values (numeric discount, array perks)
-    discount_pct = float(offer.get("discount_pct") or 0)
-    perks_list = offer.get("perks") or []
 
+def email_prompt_fields(offer: Dict[str, Any]) -> Dict[str, Any]:
+    """Values the `email_generation` prompt is formatted with, for one sanitised offer."""
+    return {
+        "segment": offer.get("business_label"),
+        "hotel": offer.get("hotel"),
+        "room_name": friendly_room_name(offer.get("room_type"), offer.get("hotel")),
+        "stay": f"{offer.get('target_month')} {offer.get('target_year')}",
+        "discount_pct": int(float(offer.get("discount_pct") or 0)),   # numeric, no %
+        "perks": offer.get("perks") or [],                           # array
+        "history": build_history_context(offer.get("history")),
+    }
+
+
+def email_prompt_template() -> str:
     base_prompt = PROMPTS.get("email_generation")
     if not base_prompt:
         raise ValueError("System prompt 'email_generation' not found in DB")
+    return base_prompt
+
+
+# Cohort plans are shared by guests with different discounts, so the figure is left as a
+# placeholder that personalize_plan fills with each guest's own discount
+DISCOUNT_PLACEHOLDER_HINT = (
+    "This copy is shared by guests with different discounts: wherever you state the discount, "
+    "write {{discount_pct}}% instead of the number (e.g. \"Save {{discount_pct}}% on your stay\") "
+    "and never spell the figure out."
+)
+
 
+def build_email_prompt(offer: Dict[str, Any], variant: int = 0) -> str:
+    """
+    EmailPlan prompt for one sanitised offer (no PII); variants > 0 ask for different wording.
+    Cohort representatives (`discount_placeholder`) ask for a {{discount_pct}} placeholder.
+    """
     # Expect the DB prompt to include optional history_heading/history_pitch and the rules we discussed
-    prompt = base_prompt.format(
-        segment=offer.get("business_label"),
-        hotel=offer.get("hotel"),
-        room_name=friendly_room_name(offer.get("room_type"), offer.get("hotel")),
-        stay=f"{offer.get('target_month')} {offer.get('target_year')}",
-        discount_pct=int(discount_pct),   # numeric, no %
-        perks=perks_list,                 # array
-        history=history_context,
-    )
+    prompt = email_prompt_template().format(**email_prompt_fields(offer))
+    if offer.get("discount_placeholder"):
+        prompt += f"\n\n{DISCOUNT_PLACEHOLDER_HINT}"
+    if variant:
+        prompt += f"\n\nThis is copy variant {variant + 1}: use a different angle and wording from other variants."
+    return prompt
 
-    resp = client.chat.completions.create(
-        model="meta-llama/llama-3-8b-instruct",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.7,
-        max_tokens=380
+
+def build_batch_prompt(items: List[tuple[Dict[str, Any], int]]) -> str:
+    """
+    One prompt for several (offer, variant) items: the `email_generation` rules once,
+    then the offers as a JSON list, answered as a JSON array of EmailPlans by index.
+    """
+    rules = email_prompt_template().format(**{f: f"<the offer's {f}>" for f in EMAIL_PROMPT_FIELDS})
+    if any(offer.get("discount_placeholder") for offer, _ in items):
+        rules += f"\n\n{DISCOUNT_PLACEHOLDER_HINT}"
+    offers_json = json.dumps([
+        {"index": j, **email_prompt_fields(offer), **({"copy_variant": variant + 1} if variant else {})}
+        for j, (offer, variant) in enumerate(items)
+    ], ensure_ascii=False, default=str)
+    return (
+        f"{rules}\n\n"
+        f"Apply the rules above to each of the {len(items)} offers below, using that offer's own fields. "
+        "Offers with a copy_variant need wording different from other variants.\n"
+        "Return ONLY a JSON array with one EmailPlan object per offer; each object must include an "
+        "integer \"index\" field equal to the offer's index.\n\n"
+        f"Offers:\n{offers_json}"
     )
-    raw = resp.choices[0].message.content.strip()
+
+
+def split_batch_plans(raw: str | None, n: int) -> Dict[int, Dict[str, str]]:
+    """
+    Valid EmailPlans of a batch response by offer index. Items that are not objects,
+    have no usable index or subject, or repeat an index are dropped.
+    """
+    if not raw:
+        return {}
+    try:
+        data = json.loads(raw)
+    except Exception:
+        cleaned = re.sub(r"^```[a-zA-Z]*\s*|\s*```$", "", raw.strip(), flags=re.M)
+        match = re.search(r"\[.*\]", cleaned, flags=re.S)
+        try:
+            data = json.loads(match.group(0)) if match else None
+        except Exception:
+            data = None
+    if not isinstance(data, list):
+        return {}
+
+    plans = {}
+    for item in data:
+        if not isinstance(item, dict):
+            continue
+        try:
+            idx = int(item.get("index"))
+        except (TypeError, ValueError):
+            continue
+        plan = {k: v for k, v in item.items() if k != "index"}
+        if not 0 <= idx < n or idx in plans or not isinstance(plan.get("subject"), str) or not plan["subject"]:
+            continue
+        plans[idx] = plan
+    return plans
+
+
+def complete_email_plans(keys: List[str], prompts: Dict[str, str], items: Dict[str, tuple],
+                         batch_size: int = EMAIL_LLM_BATCH_SIZE) -> tuple[Dict[str, Dict[str, str]], Dict[str, CompletionResult], int, Dict[str, int]]:
+    """
+    Plans for the distinct prompts `keys`. With batch_size > 1 they are packed into
+    multi-offer completions first; offers missing from a batch answer, or malformed
+    in it, are retried on their own prompt. Returns (plans by key, outcome by key,
+    number of LLM requests, batch report). Batch requests are reported once, in the
+    batch report, not in the outcome of every offer they carried.
+    """
+    plans: Dict[str, Dict[str, str]] = {}
+    outcomes: Dict[str, CompletionResult] = {}
+    requests = 0
+    batch = {"requests": 0, "attempts": 0, "retries": 0, "failed": 0}
+
+    singles = keys
+    if batch_size > 1 and len(keys) > 1:
+        chunks = [keys[i:i + batch_size] for i in range(0, len(keys), batch_size)]
+        results = complete_prompts(
+            [build_batch_prompt([items[k] for k in chunk]) for chunk in chunks],
+            max_tokens=EMAIL_LLM_MAX_TOKENS * batch_size,
+        )
+        requests += len(chunks)
+        singles = []
+        for chunk, result in zip(chunks, results):
+            batch["requests"] += 1
+            batch["attempts"] += result.attempts
+            batch["retries"] += max(0, result.attempts - 1)
+            batch["failed"] += result.error is not None
+            answered = split_batch_plans(result.text, len(chunk)) if not result.error else {}
+            for j, key in enumerate(chunk):
+                outcomes[key] = CompletionResult(latency_ms=result.latency_ms)
+                if j in answered:
+                    plans[key] = answered[j]
+                else:
+                    singles.append(key)
+
+    results = complete_prompts([prompts[k] for k in singles])
+    requests += len(singles)
+    for key, result in zip(singles, results):
+        batched = outcomes.get(key)
+        if batched:  # the offer waited for its batch first
+            result.latency_ms = round(result.latency_ms + batched.latency_ms, 1)
+        outcomes[key] = result
+        try:
+            if result.error:
+                raise RuntimeError(result.error)
+            plans[key] = parse_email_plan(result.text)
+        except Exception as e:
+            # log upstream LLM/raw content problems, continue with defaults
+            print("LLM failure for prompt:", key[:12], e)
+            result.error = result.error or f"{type(e).__name__}: {e}"
+    return plans, outcomes, requests, batch
+
+
+def parse_email_plan(raw: str) -> Dict[str, str]:
     try:
         return json.loads(raw)
     except Exception as e:
@@ -92,11 +241,262 @@ def get_email_from_api(offer: Dict[str, Any]) -> Dict[str, str]:
         return json.loads(cleaned)
 
 
+def get_email_from_api(offer: Dict[str, Any], use_cache: bool = True) -> Dict[str, str]:
+    """Call OpenRouter to generate a structured EmailPlan JSON (no PII)."""
+    prompt = build_email_prompt(offer)
+    key = plan_cache_key(prompt, EMAIL_LLM_MODEL, EMAIL_LLM_TEMPERATURE)
+    if use_cache and EMAIL_PLAN_CACHE_ENABLED:
+        cached = email_plan_cache.get_many([key])
+        if key in cached:
+            return cached[key]
+
+    resp = client.chat.completions.create(
+        model=EMAIL_LLM_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=EMAIL_LLM_TEMPERATURE,
+        max_tokens=EMAIL_LLM_MAX_TOKENS
+    )
+    plan = parse_email_plan(resp.choices[0].message.content.strip())
+    if EMAIL_PLAN_CACHE_ENABLED:
+        email_plan_cache.put_many({key: plan})
+    return plan
+
+
+def generate_email_plans(offers: List[Dict[str, Any]], ids: List[Any] | None = None,
+                         use_cache: bool = True, variants: List[int] | None = None,
+                         batch_size: int | None = None) -> tuple[List[Dict[str, str]], Dict[str, Any]]:
+    """
+    EmailPlans for many sanitised offers. Plans come from the plan cache where the
+    formatted prompt was seen before; each remaining distinct prompt is completed
+    once, concurrently (see email_engine), `batch_size` offers per request, and
+    cached. `use_cache=False` bypasses the lookup (fresh plans still refresh the cache).
+
+    Returns the plans in offer order, with DEFAULT_EMAIL_PLAN for any offer that
+    failed, and the run's generation report (`ids` label the offers in it).
+    `variants` gives each offer's copy variant (see build_email_prompt).
+    """
+    ids = ids if ids is not None else [o.get("id") for o in offers]
+    variants = variants if variants is not None else [0] * len(offers)
+    batch_size = min(max(1, batch_size or EMAIL_LLM_BATCH_SIZE), EMAIL_LLM_BATCH_SIZE_MAX)
+    start = time.perf_counter()
+
+    keys: List[str | None] = [None] * len(offers)
+    prompts: Dict[str, str] = {}
+    items: Dict[str, tuple] = {}
+    outcomes: List[CompletionResult] = [CompletionResult() for _ in offers]
+    for i, offer in enumerate(offers):
+        try:
+            prompt = build_email_prompt(offer, variants[i])
+        except Exception as e:
+            print("LLM failure for offer:", ids[i], e)
+            outcomes[i].error = f"{type(e).__name__}: {e}"
+            continue
+        keys[i] = plan_cache_key(prompt, EMAIL_LLM_MODEL, EMAIL_LLM_TEMPERATURE)
+        prompts[keys[i]] = prompt
+        items[keys[i]] = (offer, variants[i])
+
+    cached = email_plan_cache.get_many(list(prompts)) if use_cache and EMAIL_PLAN_CACHE_ENABLED else {}
+    todo = [k for k in prompts if k not in cached]
+    fresh, completed, requests, batch = complete_email_plans(todo, prompts, items, batch_size)
+    if EMAIL_PLAN_CACHE_ENABLED:
+        email_plan_cache.put_many(fresh)
+
+    plans, owners = [], set()
+    for i, key in enumerate(keys):
+        if key in completed:
+            if key in owners:  # same prompt as an earlier offer: shares its completion
+                outcomes[i] = CompletionResult(error=completed[key].error, cached=True)
+            else:
+                outcomes[i] = completed[key]
+                owners.add(key)
+        elif key is not None:
+            outcomes[i].cached = True
+        plan = cached.get(key) or fresh.get(key)
+        plans.append(dict(plan) if plan is not None else dict(DEFAULT_EMAIL_PLAN))
+
+    report = generation_report(outcomes, time.perf_counter() - start, ids=ids)
+    report["requests"] = requests
+    report["batch_size"] = batch_size
+    report["batch"] = batch
+    report["cache"] = {
+        "enabled": EMAIL_PLAN_CACHE_ENABLED,
+        "bypassed": not use_cache,
+        **(email_plan_cache.stats() if EMAIL_PLAN_CACHE_ENABLED else {}),
+    }
+    return plans, report
+
+
+def discount_bucket(discount_pct) -> int:
+    """Cohort bucket of a discount: 0 for none, else EMAIL_COHORT_DISCOUNT_STEP-wide bands from 1."""
+    pct = int(float(discount_pct or 0))
+    if pct <= 0:
+        return 0
+    step = max(1, EMAIL_COHORT_DISCOUNT_STEP)
+    return 1 + (pct - 1) // step
+
+
+def cohort_key(offer: Dict[str, Any]) -> tuple:
+    """Offers with the same key get the same plan; only local personalization differs."""
+    return (
+        offer.get("business_label"),
+        offer.get("hotel"),
+        friendly_room_name(offer.get("room_type"), offer.get("hotel")),
+        offer.get("target_month"),
+        offer.get("target_year"),
+        discount_bucket(offer.get("discount_pct")),
+        tuple(sorted(str(p) for p in (offer.get("perks") or []))),
+    )
+
+
+def used_amenity_labels(history: Dict[str, Any]) -> List[str]:
+    return [
+        label for label, used in {
+            "Spa": history.get("is_spa_used"),
+            "Gym": history.get("is_gym_used"),
+            "Swimming Pool": history.get("is_swimming_pool_used"),
+            "Bar": history.get("is_bar_used"),
+            "Kids Club": history.get("is_kids_club_used"),
+            "Meeting Room": history.get("is_meeting_room_used"),
+        }.items() if used
+    ]
+
+
+_DISCOUNT_PLACEHOLDER = re.compile(r"\{\{\s*discount_pct\s*\}\}")
+_NUMBER_WORDS = (
+    "zero one two three four five six seven eight nine ten eleven twelve thirteen fourteen "
+    "fifteen sixteen seventeen eighteen nineteen"
+).split()
+_TENS_WORDS = "_ _ twenty thirty forty fifty sixty seventy eighty ninety".split()
+
+
+def number_words(n: int) -> str | None:
+    """English words for 0-99 ("fifteen", "twenty-five"), None outside that range."""
+    if not 0 <= n < 100:
+        return None
+    if n < 20:
+        return _NUMBER_WORDS[n]
+    return _TENS_WORDS[n // 10] + (f"-{_NUMBER_WORDS[n % 10]}" if n % 10 else "")
+
+
+def mentions_figure(text: str, pct: int) -> bool:
+    """Does `text` state `pct` anywhere, as digits ("15", "15 per cent") or in words?"""
+    if re.search(rf"(?<![\d.]){pct}(?![\d])", text):
+        return True
+    words = number_words(pct)
+    return bool(words and re.search(rf"\b{re.escape(words)}\b", text.replace("\u2011", "-"), re.IGNORECASE))
+
+
+def personalize_plan(plan: Dict[str, str], cohort_offer: Dict[str, Any], offer: Dict[str, Any]) -> Dict[str, str] | None:
+    """
+    A cohort plan adapted to one guest: the guest's own discount figure and, when the
+    guest has history, a history pitch from their last stay. {{first_name}} is left
+    for the render.
+
+    The figure goes into the {{discount_pct}} placeholders the cohort prompt asks for
+    (and replaces any "<n>%" the model wrote anyway). Returns None when the cohort's
+    own figure is still in the copy afterwards ("15 percent", "fifteen"), so the guest
+    gets a plan of their own instead of someone else's price.
+    """
+    cohort_plan, plan = plan, dict(plan)
+    cohort_pct, pct = int(float(cohort_offer.get("discount_pct") or 0)), int(float(offer.get("discount_pct") or 0))
+    figure = re.compile(rf"(?<!\d){cohort_pct}(\s?%)")
+    for k, v in plan.items():
+        if isinstance(v, str):
+            v = _DISCOUNT_PLACEHOLDER.sub(str(pct), v)
+            if cohort_pct != pct:
+                v = figure.sub(lambda m: f"{pct}{m.group(1)}", v)
+            plan[k] = v
+    if cohort_pct != pct:
+        # Check the copy as the model wrote it, minus what was just substituted
+        # (the guest's own figure may match the cohort figure's digits once filled in)
+        leftovers = [
+            figure.sub("", _DISCOUNT_PLACEHOLDER.sub("", v)) for v in cohort_plan.values() if isinstance(v, str)
+        ]
+        if any(mentions_figure(text, cohort_pct) for text in leftovers):
+            return None
+
+    history = offer.get("history") or {}
+    labels = used_amenity_labels(history)
+    if labels:
+        stay = " ".join(str(history[k]) for k in ("arrival_date_month", "arrival_date_year") if history.get(k))
+        enjoyed = humanize_labels(labels)
+        plan["history_heading"] = "Welcome back to the places you loved"
+        plan["history_pitch"] = (
+            f"You enjoyed our {enjoyed}{f' on your {stay} stay' if stay else ''}, and it’s all ready for you again."
+        )
+    return plan
+
+
+def humanize_labels(labels: List[str]) -> str:
+    if len(labels) <= 1:
+        return "".join(labels)
+    return f"{', '.join(labels[:-1])} and {labels[-1]}"
+
+
+def generate_cohort_plans(offers: List[Dict[str, Any]], ids: List[Any] | None = None,
+                          use_cache: bool = True,
+                          variants: int = EMAIL_COHORT_VARIANTS,
+                          batch_size: int | None = None) -> tuple[List[Dict[str, str]], Dict[str, Any]]:
+    """
+    Cohort mode: offers are grouped by `cohort_key`, one history-free plan is generated
+    per cohort and copy variant, and each guest's plan is personalized locally.
+    Guests are spread over a cohort's variants by a stable hash of their offer id.
+    """
+    ids = ids if ids is not None else [o.get("id") for o in offers]
+    variants = max(1, variants)
+
+    groups: Dict[tuple, int] = {}
+    rep_offers, rep_variants, rep_ids, assigned = [], [], [], []
+    for i, offer in enumerate(offers):
+        variant = zlib.crc32(str(ids[i]).encode("utf-8")) % variants if variants > 1 else 0
+        group = (cohort_key(offer), variant)
+        if group not in groups:
+            groups[group] = len(rep_offers)
+            rep_offers.append({**offer, "history": None, "discount_placeholder": True})
+            rep_variants.append(variant)
+            rep_ids.append(f"cohort-{len(rep_offers)}")
+        assigned.append(groups[group])
+
+    rep_plans, report = generate_email_plans(
+        rep_offers, ids=rep_ids, use_cache=use_cache, variants=rep_variants, batch_size=batch_size
+    )
+    plans = [personalize_plan(rep_plans[r], rep_offers[r], offer) for offer, r in zip(offers, assigned)]
+
+    # Guests whose discount couldn't be put into the cohort copy get a plan of their own
+    fallback = [i for i, plan in enumerate(plans) if plan is None]
+    if fallback:
+        own_plans, own_report = generate_email_plans(
+            [offers[i] for i in fallback], ids=[ids[i] for i in fallback], use_cache=use_cache, batch_size=batch_size
+        )
+        for i, plan in zip(fallback, own_plans):
+            plans[i] = plan
+        report = merge_generation_reports([report, own_report], report["elapsed_s"] + own_report["elapsed_s"])
+
+    report["mode"] = "cohort"
+    report["fallback_offers"] = len(fallback)
+    report["plans"] = len(rep_offers)
+    report["cohorts"] = len({key for key, _ in groups})
+    report["offers"] = len(offers)
+    report["cohort_of_offer"] = [{"offer_id": i, "cohort_id": rep_ids[r]} for i, r in zip(ids, assigned)]
+    return plans, report
+
+
+def new_coupon_code() -> str:
+    return str(uuid.uuid4())[:8].upper()
+
+
 def fine_tune_agent(plan: Dict[str, str]) -> Dict[str, str]:
     """Optional second pass to refine style."""
     return plan
 
-def render_html_with_email(plan: Dict[str, str], offer: Dict[str, Any]) -> Dict[str, Any]:
+def render_html_with_email(plan: Dict[str, str], offer: Dict[str, Any], first_name: str | None = None,
+                           coupon: str | None = None) -> Dict[str, Any]:
+    """
+    Render the email in one pass. With `first_name`, the guest's name goes into the
+    plan copy before rendering (and is passed to the template), so the output needs
+    no further substitution; without it, `{{first_name}}` placeholders are kept.
+    `coupon` defaults to a fresh code; pass COUPON_PLACEHOLDER for a shareable body.
+    """
     imgs = select_images_for_offer(offer)
     hero_img = offer.get("hero_image_url") or imgs["hero_image_url"]
     room_img = imgs["room_image_url"]
@@ -106,7 +506,7 @@ def render_html_with_email(plan: Dict[str, str], offer: Dict[str, Any]) -> Dict[
     history_amenity_imgs = imgs.get("history_amenity_images", [])  # NOT freebies
 
     # Links
-    coupon = str(uuid.uuid4())[:8].upper()
+    coupon = coupon or new_coupon_code()
     cta_url  = f"https://example.com/book?m={offer['target_month']}&y={offer['target_year']}&rt={offer['room_type']}&c={coupon}"
     unsub_url = f"https://example.com/unsub?u={offer.get('user_id','0')}"
     view_url  = f"https://example.com/view?m={offer['target_month']}&y={offer['target_year']}"
@@ -145,8 +545,10 @@ def render_html_with_email(plan: Dict[str, str], offer: Dict[str, Any]) -> Dict[
              else f"Plan your {month} {year} stay with us.")
         )
 
-    # Greeting must keep {{first_name}}
+    # Greeting must keep {{first_name}} (filled in just below when the guest is known)
     plan.setdefault("greeting", "Dear {{first_name}},")
+    if first_name is not None:
+        plan = {k: fill_placeholders(v, {"first_name": first_name}) if isinstance(v, str) else v for k, v in plan.items()}
 
     # Offer line: discount-first, else perks, else neutral — NEVER print 0%
     nights_text = plural_nights(offer.get("offer_days"))
@@ -221,6 +623,7 @@ def render_html_with_email(plan: Dict[str, str], offer: Dict[str, Any]) -> Dict[
 
     html = template.render(
         plan=plan,
+        first_name=first_name if first_name is not None else "{{first_name}}",
         cta_url=cta_url,
         unsub_url=unsub_url,
         view_url=view_url,
@@ -295,98 +698,283 @@ def genrate_offer_emails(offer):
         # log upstream LLM/raw content problems
         print("LLM failure for offer:", offer.get("id"), e)
         # continue with defaults so we don't kill the whole run
-        plan_email = {
-            "subject": "Your Exclusive Hotel Offer",
-            "preheader": "A special rate picked for you",
-            "greeting": "Hi {{first_name}},",
-            "opening_line": "We’re excited to welcome you back.",
-            "offer_line": "Enjoy a limited‑time discount on your next stay.",
-            "perks_line": "",
-            "cta_text": "Book Now"
-        }
+        plan_email = dict(DEFAULT_EMAIL_PLAN)
     return render_html_with_email(plan_email, offer)
 
 
-def generate_emails(email, months, year) -> Dict[str, Any]:
-    data = get_discount_ofers(email, months, year)
-    if not data.get("success"):
-        return data  
-
-    discount_offers = data["offers"]
-    history_list = data["history"]
-    user_id = data["user_id"]
-
-    history_lookup = {h["id"]: h for h in history_list}
-    results = []
+def sanitise_offers(discount_offers: List[Dict[str, Any]], history_lookup: Dict[str, Any]) -> List[Dict[str, Any]]:
+    sanitised = []
     for off in discount_offers:
         offer_sanitised = {k: off[k] for k in SAFE_KEYS_OFFER if k in off}
 
-        booking_id = off.get("booking_id")
-        if booking_id and booking_id in history_lookup:
-            hist = history_lookup[booking_id]
+        guest_email = off.get("email")
+        if guest_email and guest_email in history_lookup:
+            hist = history_lookup[guest_email]
             offer_sanitised["history"] = {k: hist[k] for k in SAFE_KEYS_HISTORY if k in hist}
+        sanitised.append(offer_sanitised)
+    return sanitised
 
-        try:
-            html_email = genrate_offer_emails(offer_sanitised)
-        except Exception as e:
-            html_email = {
-                "subject": "Error",
-                "html": "",
-                "plain_text": str(e),
-                "coupon_code": ""
-            }
 
-        first_name = (off.get("name") or "Guest").split()[0]
-
-        subject_with_name = name_in(html_email.get("subject", ""), first_name)
-        preheader_with_name = name_in(html_email.get("preheader", ""), first_name)
-        html_with_name = name_in(html_email.get("html", ""), first_name)
-        plain_with_name = name_in(html_email.get("plain_text", ""), first_name)
-        results.append({
-            "customer": off.get("name"),  
-            "offer_id": off.get("id"),
-            "email": {
-                **html_email,
-                "subject": subject_with_name,
-                "preheader": preheader_with_name,
-                "html": html_with_name,
-                "plain_text": plain_with_name,
-            }
-        })
+def plan_offer_emails(sanitised: List[Dict[str, Any]], ids: List[Any], use_cache: bool = True,
+                      mode: str | None = None, batch_size: int | None = None):
+    if (mode or EMAIL_GENERATION_MODE) == "cohort":
+        return generate_cohort_plans(sanitised, ids=ids, use_cache=use_cache, batch_size=batch_size)
+    return generate_email_plans(sanitised, ids=ids, use_cache=use_cache, batch_size=batch_size)
 
-    save_res = save_email_campaigns(user_id=user_id, emails=results)
-    response = fetch_campaign_stats(email)
-    return response
 
+def finish_offer_email(off: Dict[str, Any], offer_sanitised: Dict[str, Any], plan_email: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Render the guest's email in one pass with their `variables` (the personalised
+    `email`), and once with recipient placeholders for the shareable `body` that
+    save_email_campaigns stores; fill_placeholders(body, variables) gives back `email`.
+    """
+    variables = {"first_name": (off.get("name") or "Guest").split()[0], "coupon_code": new_coupon_code()}
+    start = time.perf_counter()
+    try:
+        html_email = render_html_with_email(plan_email, offer_sanitised, first_name=variables["first_name"],
+                                            coupon=variables["coupon_code"])
+        render_ms = round((time.perf_counter() - start) * 1000, 2)
+        shared = render_html_with_email(plan_email, offer_sanitised, coupon=COUPON_PLACEHOLDER)
+    except Exception as e:
+        html_email = shared = {
+            "subject": "Error",
+            "html": "",
+            "plain_text": str(e),
+            "coupon_code": ""
+        }
+        render_ms = round((time.perf_counter() - start) * 1000, 2)
+    return {
+        "customer": off.get("name"),  
+        "offer_id": off.get("id"),
+        "target_year": off.get("target_year"),
+        "target_month": off.get("target_month"),
+        "email": html_email,
+        "body": {"html": shared.get("html"), "plain_text": shared.get("plain_text")},
+        "variables": variables,
+        "render_ms": render_ms,
+    }
 
 
+def render_report(render_ms: List[float]) -> Dict[str, Any]:
+    timings = sorted(render_ms)
+    if not timings:
+        return {"emails": 0}
+    pct = lambda q: timings[min(len(timings) - 1, int(q * len(timings)))]
+    return {
+        "emails": len(timings),
+        "total_ms": round(sum(timings), 1),
+        "p50": pct(0.5),
+        "p95": pct(0.95),
+        "max": timings[-1],
+    }
 
-def fetch_campaign_stats(user_email: str):
+
+def merge_generation_reports(reports: List[Dict[str, Any]], elapsed_s: float) -> Dict[str, Any]:
+    """One report for a run generated in checkpoints: lists are concatenated, counts summed."""
+    merged: Dict[str, Any] = {}
+    for report in reports:
+        for k, v in report.items():
+            if isinstance(v, list):
+                merged.setdefault(k, []).extend(v)
+            elif isinstance(v, int) and not isinstance(v, bool) and k != "batch_size":
+                merged[k] = merged.get(k, 0) + v
+            elif k == "batch":
+                merged[k] = {f: merged.get(k, {}).get(f, 0) + n for f, n in v.items()}
+            else:
+                merged[k] = v
+    per_offer = merged.get("per_offer", [])
+    outcomes = [
+        CompletionResult(error=p["error"], latency_ms=p["latency_ms"], attempts=p["attempts"], cached=p["cached"])
+        for p in per_offer
+    ]
+    offers = merged.get("offers", 0)
+    merged.update(generation_report(outcomes, elapsed_s, ids=[p["offer_id"] for p in per_offer]))
+    merged["offers"] = offers
+    merged["throughput_per_min"] = round(offers / elapsed_s * 60, 1) if elapsed_s > 0 else None
+    return merged
+
+
+def failed_offer_ids(report: Dict[str, Any]) -> set:
+    """Offers whose plan fell back to DEFAULT_EMAIL_PLAN: their own call failed, or their cohort's did."""
+    failed = {p["offer_id"] for p in report.get("per_offer", []) if p.get("error") is not None}
+    failed |= {c["offer_id"] for c in report.get("cohort_of_offer", []) if c["cohort_id"] in failed}
+    return failed
+
+
+def run_email_generation(email, months, year, use_cache: bool = True, mode: str | None = None,
+                         batch_size: int | None = None, chunk_size: int | None = None):
+    """
+    Generate a user's campaign emails as a run of checkpoints, yielding (event, data):
+
+        start     {run_id, resumed, total, skipped, chunk_size}
+        email     {customer, offer_id, email}                      one per planned offer
+        failed    {customer, offer_id}                             one per offer whose plan failed
+        progress  {done, total, failed, saved, elapsed_s, eta_s}   after each checkpoint
+        error     {message}
+        done      campaign stats plus the run's "generation" report
+
+    Offers that already have a campaign are skipped, so rerunning after a crash
+    resumes where the last run stopped. Offers whose plan failed are not saved,
+    so the next run retries them. Each checkpoint (`chunk_size` offers) is
+    planned, rendered and saved before the next starts; the offer cube is
+    refreshed once, after the last save, even if the caller stops early.
+    """
+    data = get_discount_ofers(email, months, year)
+    if not data.get("success"):
+        yield "error", {"message": data.get("message")}
+        return
+
+    user_id = data.get("user_id")
+    discount_offers = data["offers"]
+    existing = offers_with_campaigns([off.get("id") for off in discount_offers]) if discount_offers else set()
+    discount_offers = [off for off in discount_offers if off.get("id") not in existing]
+    sanitised = sanitise_offers(discount_offers, data["history"])
+    chunk_size = max(1, chunk_size or EMAIL_CHECKPOINT_SIZE)
+    if (mode or EMAIL_GENERATION_MODE) == "cohort":
+        # Keep each cohort within as few checkpoints as possible
+        order = sorted(range(len(sanitised)), key=lambda i: repr(cohort_key(sanitised[i])))
+        discount_offers = [discount_offers[i] for i in order]
+        sanitised = [sanitised[i] for i in order]
+
+    total = len(discount_offers)
+    run = start_email_run(user_id, data.get("offer_set_id"), year, months, total, len(existing)) if total else None
+    start = time.perf_counter()
+    reports, render_ms = [], []
+    done = failed = saved = 0
+    status = "interrupted"
+    yield "start", {
+        "run_id": run and run["id"], "resumed": bool(run and run["resumed"]),
+        "total": total, "skipped": len(existing), "chunk_size": chunk_size,
+    }
+
+    try:
+        for lo in range(0, total, chunk_size):
+            offers_chunk = discount_offers[lo:lo + chunk_size]
+            sanitised_chunk = sanitised[lo:lo + chunk_size]
+            plans, report = plan_offer_emails(
+                sanitised_chunk, [off.get("id") for off in offers_chunk],
+                use_cache=use_cache, mode=mode, batch_size=batch_size,
+            )
+            reports.append(report)
+
+            failed_ids = failed_offer_ids(report)
+            results = []
+            for off, offer_sanitised, plan_email in zip(offers_chunk, sanitised_chunk, plans):
+                if off.get("id") in failed_ids:
+                    yield "failed", {"customer": off.get("name"), "offer_id": off.get("id")}
+                    continue
+                result = finish_offer_email(off, offer_sanitised, plan_email)
+                results.append(result)
+                render_ms.append(result["render_ms"])
+                yield "email", {k: v for k, v in result.items() if k != "body"}
+
+            if results:
+                save_res = save_email_campaigns(user_id=user_id, emails=results, refresh_cube=False)
+                if save_res.get("success"):
+                    saved += save_res.get("inserted", 0)
+                else:
+                    yield "error", {"message": save_res.get("message"), "offset": lo}
+
+            done += len(offers_chunk)
+            failed += len(failed_ids)
+            checkpoint_email_run(run["id"], done, failed, saved)
+            elapsed = time.perf_counter() - start
+            yield "progress", {
+                "done": done,
+                "total": total,
+                "failed": failed,
+                "saved": saved,
+                "elapsed_s": round(elapsed, 2),
+                "eta_s": round(elapsed / done * (total - done), 1),
+            }
+        # Failed and unsaved offers are regenerated by the next run, so only a clean run is complete
+        status = "completed" if failed == 0 and saved == total else "failed"
+    except Exception:
+        status = "failed"
+        raise
+    finally:
+        if run:
+            finish_email_run(run["id"], status)
+        if saved:
+            refresh_offer_cube(user_id)
+
+    # Counts only: cards are listed page by page (see campaign_listing)
+    response = fetch_campaign_stats(email, include_campaigns=False)
+    generation = merge_generation_reports(reports, time.perf_counter() - start) if reports else {"offers": 0}
+    generation.update({"run_id": run and run["id"], "skipped": len(existing), "saved": saved, "status": status})
+    generation["render_ms"] = render_report(render_ms)
+    response["generation"] = generation
+    yield "done", response
+
+
+def generate_emails(email, months, year, use_cache: bool = True, mode: str | None = None,
+                    batch_size: int | None = None) -> Dict[str, Any]:
+    errors = []
+    for event, data in run_email_generation(email, months, year, use_cache=use_cache, mode=mode, batch_size=batch_size):
+        if event == "error":
+            errors.append(data)
+        elif event == "done":
+            if errors:
+                data["generation"]["errors"] = errors
+            return data
+    return {"success": False, **errors[-1]} if errors else {"success": False, "message": "Email generation stopped early"}
+
+
+def stream_event(event: str, data: Dict[str, Any], fmt: str = "ndjson") -> str:
+    """One streamed event: an NDJSON line, or an SSE frame for `fmt="sse"`."""
+    payload = json.dumps(jsonable_encoder(data), ensure_ascii=False, separators=(",", ":"))
+    if fmt == "sse":
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f'{{"event":"{event}","data":{payload}}}\n'
+
+
+def stream_generate_emails(email, months, year, use_cache: bool = True, mode: str | None = None,
+                           batch_size: int | None = None, chunk_size: int | None = None,
+                           fmt: str = "ndjson"):
+    """
+    run_email_generation as NDJSON lines or SSE frames, with small checkpoints so emails arrive early.
+    The response has already started, so a failure ends the stream with an `error` event.
+    """
+    try:
+        for event, data in run_email_generation(email, months, year, use_cache=use_cache, mode=mode,
+                                                batch_size=batch_size, chunk_size=chunk_size or EMAIL_STREAM_CHUNK_SIZE):
+            yield stream_event(event, data, fmt)
+    except Exception as e:
+        print(f"[WARN] Email generation stream failed for {email}: {e}")
+        yield stream_event("error", {"message": f"Error generating emails: {str(e)}"}, fmt)
+
+
+def fetch_campaign_stats(user_email: str, include_campaigns: bool = True):
     """
     Return stats + minimal campaign card data:
     {
-      years → months → { total, generated, pending },
+      years → months → { total, generated, pending, launched },
       campaigns → { year → month → [cards] },
       month_labels
     }
+    Counts come from the write-time counters (see campaign_stats); only the cards
+    need the offers themselves, so `include_campaigns=False` skips that read.
     """
 
     user_res = supabase.table("users").select("user_id").eq("email", user_email).execute()
     if not user_res.data:
         return {"years": {}, "campaigns": {}, "month_labels": {}}
     user_id = user_res.data[0]["user_id"]
+    offer_set_id = get_active_offer_set_id(user_id)
+    if not offer_set_id:
+        return {"years": {}, "campaigns": {}, "month_labels": {}}
 
-    res = supabase.from_("discount_offers").select(
-        """
-        id, target_year, target_month, hotel, business_label, discount_pct,
-        email_campaigns!left (id, subject, preheader, status, created_at)
-        """
-    ).eq("user_id", user_id).eq("is_active", True).execute()
-
-    offers = res.data or []
-
-    stats = {}
+    stats = get_campaign_counts(user_id)
     campaigns_by_month = {}
+    offers = []
+    if include_campaigns:
+        res = supabase.from_("discount_offers").select(
+            """
+            id, target_year, target_month, hotel, business_label, discount_pct,
+            email_campaigns!left (id, subject, preheader, status, created_at)
+            """
+        ).eq("offer_set_id", offer_set_id).execute()
+        offers = res.data or []
 
     for o in offers:
         year = o.get("target_year")
@@ -399,17 +987,10 @@ def fetch_campaign_stats(user_email: str):
         if not isinstance(month, int) or not (1 <= month <= 12):
             continue
 
-        stats.setdefault(year, {m: {"total": 0, "generated": 0, "pending": 0} for m in range(1, 13)})
         campaigns_by_month.setdefault(year, {m: [] for m in range(1, 13)})
 
-        stats[year][month]["total"] += 1
-
         ec_list = o.get("email_campaigns") or []
         ec = ec_list[0] if ec_list else None
-        if ec:
-            stats[year][month]["generated"] += 1
-        else:
-            stats[year][month]["pending"] += 1
 
         campaigns_by_month[year][month].append({
             "offer_id": o["id"],
@@ -429,14 +1010,18 @@ def fetch_campaign_stats(user_email: str):
         "month_labels": {i: MONTH_NAMES[i - 1] for i in range(1, 13)},
     }
 
-    
-def save_email_campaigns(user_id: str, emails: List[Dict[str, Any]]) -> Dict[str, Any]:
+
+def save_email_campaigns(user_id: str, emails: List[Dict[str, Any]], refresh_cube: bool = True) -> Dict[str, Any]:
     """
     Save generated emails into email_campaigns table.
-    `emails` is a list of dicts with {offer_id, email: {...}}
+    `emails` is a list of dicts with {offer_id, email: {...}}, plus the shared `body`,
+    recipient `variables` and the offer's target_year/target_month from finish_offer_email. Bodies are stored once in
+    email_bodies (after the rows are saved) and rows keep only their hash; emails without a body keep their html.
+    `refresh_cube=False` leaves the offer cube refresh to the caller (chunked saves).
     """
     try:
         rows = []
+        bodies = {}
         for e in emails:
             offer_id = e.get("offer_id")
             email = e.get("email", {})
@@ -457,36 +1042,89 @@ def save_email_campaigns(user_id: str, emails: List[Dict[str, Any]]) -> Dict[str
                 "plain_text": email.get("plain_text"),
                 "status": "generated",
             }
+            if e.get("body"):
+                key = body_hash(e["body"])
+                bodies[key] = e["body"]
+                row.update({"html": None, "plain_text": None, "body_hash": key, "variables": e.get("variables") or {}})
             rows.append(row)
 
         if not rows:
             return {"success": False, "message": "No rows to insert"}
 
-        resp = supabase.table("email_campaigns").insert(rows).execute()
+        # One campaign per offer: a concurrent or repeated run keeps the campaign already saved
+        resp = (
+            supabase.table("email_campaigns")
+            .upsert(rows, on_conflict="offer_id", ignore_duplicates=True)
+            .execute()
+        )
 
         if resp.error:
             return {"success": False, "message": f"DB insert error: {resp.error}"}
 
-        return {"success": True, "inserted": len(rows)}
+        # Bodies go in after the rows, so a failed insert leaves no orphan bodies behind;
+        # rows whose bodies can't be stored are removed and regenerated by the next run
+        saved_rows = resp.data or []
+        try:
+            used = {r.get("body_hash") for r in saved_rows}
+            body_stats = store_bodies({k: v for k, v in bodies.items() if k in used}) if bodies else None
+        except Exception:
+            if saved_rows:
+                supabase.table("email_campaigns").delete().in_("id", [r["id"] for r in saved_rows]).execute()
+            raise
+
+        inserted = {r.get("offer_id") for r in saved_rows}
+        emails = [e for e in emails if e.get("offer_id") in inserted]
+        periods = [period_of(e.get("target_year"), e.get("target_month")) for e in emails]
+        if all(periods):
+            deltas = {}
+            for period in periods:
+                deltas.setdefault(period, {"generated": 0})["generated"] += 1
+            bump_campaign_stats(user_id, deltas)
+        else:
+            refresh_campaign_stats(user_id)
+
+        if refresh_cube:
+            refresh_offer_cube(user_id)
+        return {"success": True, "inserted": len(emails), "bodies": body_stats}
 
     except Exception as e:
         return {"success": False, "message": f"Error saving campaigns: {str(e)}"}
       
-      
+
+# campaign_id -> rendered html; a campaign's content never changes once saved
+_PREVIEW_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_PREVIEW_CACHE_LOCK = threading.Lock()
+
+
 def fetch_email_preview(campaign_id: str):
+    with _PREVIEW_CACHE_LOCK:
+        html = _PREVIEW_CACHE.get(campaign_id)
+        if html is not None:
+            _PREVIEW_CACHE.move_to_end(campaign_id)
+            return {"success": True, "html": html}
     try:
         response = (
             supabase.table("email_campaigns")
-            .select("html")
+            .select("html, plain_text, body_hash, variables")
             .eq("id", campaign_id)
             .execute()
         )
         if not response.data:
             return {"success": False, "message": "No campaign found"}
-        return {"success": True, "html": response.data[0]["html"]}
+        rendered = render_campaign_body(response.data[0])
+        if rendered is None:
+            return {"success": False, "message": "Campaign body not found"}
+        html = rendered["html"] or ""
     except Exception as e:
         return {"success": False, "message": str(e)}
 
+    with _PREVIEW_CACHE_LOCK:
+        _PREVIEW_CACHE[campaign_id] = html
+        _PREVIEW_CACHE.move_to_end(campaign_id)
+        while len(_PREVIEW_CACHE) > EMAIL_PREVIEW_CACHE_SIZE:
+            _PREVIEW_CACHE.popitem(last=False)
+    return {"success": True, "html": html}
+
 
 def hotel_kind(hotel: str) -> str:
     h = (hotel or "").lower()
@@ -610,16 +1248,7 @@ def build_history_context(history: Dict[str, Any]) -> str:
     if not history:
         return "No prior booking context available."
 
-    amenities_used = [
-        label for label, used in {
-            "Spa": history.get("is_spa_used"),
-            "Gym": history.get("is_gym_used"),
-            "Swimming Pool": history.get("is_swimming_pool_used"),
-            "Bar": history.get("is_bar_used"),
-            "Kids Club": history.get("is_kids_club_used"),
-            "Meeting Room": history.get("is_meeting_room_used"),
-        }.items() if used
-    ]
+    amenities_used = used_amenity_labels(history)
     amenities_str = ", ".join(amenities_used) if amenities_used else "none"
 
     return f"""
@@ -631,9 +1260,6 @@ def build_history_context(history: Dict[str, Any]) -> str:
     High spender: {"yes" if history.get("is_high_spender") else "no"}.
     """
     
-def name_in(s: str,first_name) -> str:
-    return (s or "").replace("{{first_name}}", first_name).replace("{first_name}", first_name)
-
      
 def humanize_perks(perk_slugs):
     # turn ["kids_club","bar_credit","gym"] into "Kids Club, Bar Credit and Gym"
@@ -0,0 +1,194 @@
+import hashlib
+import json
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from app.config import AMENITY_USED_NAMES, MONTH_TO_NUM, SAFE_KEYS_HISTORY
+from app.db.supabase_client import supabase
+
+# Last-stay fields kept on the profile for email context
+LAST_STAY_KEYS = SAFE_KEYS_HISTORY + ["hotel", "reserved_room_type"]
+PROFILE_PAGE_SIZE = 1000
+EMAIL_CHUNK_SIZE = 200
+
+# Tenants whose profiles are known to be backfilled (a sync is never undone)
+_SYNCED_USERS: set = set()
+
+
+def _json_safe(value):
+    return json.loads(json.dumps(value, default=lambda v: v.item() if isinstance(v, np.generic) else str(v)))
+
+
+def amenity_names(flags: pd.DataFrame) -> list[list[str]]:
+    """Names of the amenities flagged 1 on each row (AMENITY_USED_NAMES order)."""
+    cols = [c for c in AMENITY_USED_NAMES if c in flags.columns]
+    if not cols:
+        return [[] for _ in range(len(flags))]
+    used = np.column_stack([(pd.to_numeric(flags[c], errors="coerce") == 1).to_numpy() for c in cols])
+    # One list per distinct combination of flags instead of one per row
+    codes = used.astype(np.int64) @ (1 << np.arange(len(cols), dtype=np.int64))
+    combos = {c: [AMENITY_USED_NAMES[cols[j]] for j in range(len(cols)) if c >> j & 1] for c in np.unique(codes).tolist()}
+    return [list(combos[c]) for c in codes.tolist()]
+
+
+def build_guest_profiles(bookings: pd.DataFrame) -> list[dict]:
+    """
+    One profile per guest email: stays per room type, last stay year, mean lead
+    time, every amenity used on any stay and a summary of the latest stay.
+    """
+    df = bookings[bookings["email"].notna()].copy()
+    if df.empty:
+        return []
+    df["reserved_room_type"] = df["reserved_room_type"].astype(str).str.strip()
+    df["stay_month_num"] = df["arrival_date_month"].astype(str).str.lower().map(MONTH_TO_NUM)
+
+    room_counts = df.groupby(["email", "reserved_room_type"]).size()
+    room_type_stays = {}
+    for (email, room_type), n in room_counts.items():
+        room_type_stays.setdefault(email, {})[room_type] = int(n)
+
+    stats = df.groupby("email").agg(
+        total_stays=("email", "size"),
+        last_stay_year=("arrival_date_year", "max"),
+        avg_lead_time=("lead_time", "mean"),
+    )
+
+    flag_cols = [c for c in AMENITY_USED_NAMES if c in df.columns]
+    if flag_cols:
+        flags = df[flag_cols].apply(pd.to_numeric, errors="coerce").eq(1).groupby(df["email"]).any().astype(int)
+        amenities = dict(zip(flags.index, amenity_names(flags)))
+    else:
+        amenities = {}
+
+    sort_cols = ["arrival_date_year", "stay_month_num"] + (["id"] if "id" in df.columns else [])
+    last = df.sort_values(sort_cols, kind="stable").drop_duplicates("email", keep="last").set_index("email")
+    last_cols = [c for c in LAST_STAY_KEYS if c in last.columns]
+    last_stays = last[last_cols].astype(object).where(last[last_cols].notna(), None).to_dict(orient="index")
+
+    profiles = []
+    for email, row in zip(stats.index, stats.itertuples(index=False)):
+        profiles.append(_json_safe({
+            "email": email,
+            "total_stays": int(row.total_stays),
+            "room_type_stays": room_type_stays.get(email, {}),
+            "last_stay_year": int(row.last_stay_year) if pd.notnull(row.last_stay_year) else None,
+            "avg_lead_time": round(float(row.avg_lead_time), 2) if pd.notnull(row.avg_lead_time) else None,
+            "amenities_used": amenities.get(email, []),
+            "last_stay": last_stays.get(email, {}),
+        }))
+    return profiles
+
+
+def profile_hash(profile: dict) -> str:
+    payload = json.dumps(profile, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def fetch_guest_profiles(user_id, emails: list[str] | None = None, columns: str = "*") -> list[dict]:
+    """A tenant's profiles (optionally only for `emails`), read page by page."""
+    rows = []
+    if emails is not None:
+        emails = sorted(set(emails))
+        for i in range(0, len(emails), EMAIL_CHUNK_SIZE):
+            res = (
+                supabase.table("guest_profiles").select(columns)
+                .eq("user_id", user_id).in_("email", emails[i:i + EMAIL_CHUNK_SIZE]).execute()
+            )
+            rows.extend(res.data or [])
+        return rows
+
+    start = 0
+    while True:
+        res = (
+            supabase.table("guest_profiles").select(columns)
+            .eq("user_id", user_id).order("email").range(start, start + PROFILE_PAGE_SIZE - 1).execute()
+        )
+        page = res.data or []
+        rows.extend(page)
+        if len(page) < PROFILE_PAGE_SIZE:
+            return rows
+        start += PROFILE_PAGE_SIZE
+
+
+def sync_guest_profiles(user_id, bookings: pd.DataFrame) -> dict:
+    """
+    Bring the tenant's profiles in line with its active bookings: only guests whose
+    profile changed are written, and guests with no active booking are removed.
+    """
+    profiles = build_guest_profiles(bookings)
+    existing = {r["email"]: r.get("profile_hash") for r in fetch_guest_profiles(user_id, columns="email, profile_hash")}
+
+    now = datetime.now(timezone.utc).isoformat()
+    changed = []
+    for profile in profiles:
+        h = profile_hash(profile)
+        if existing.get(profile["email"]) != h:
+            changed.append({**profile, "user_id": user_id, "profile_hash": h, "updated_at": now})
+    for i in range(0, len(changed), PROFILE_PAGE_SIZE):
+        supabase.table("guest_profiles").upsert(changed[i:i + PROFILE_PAGE_SIZE], on_conflict="user_id,email").execute()
+
+    gone = sorted(set(existing) - {p["email"] for p in profiles})
+    for i in range(0, len(gone), EMAIL_CHUNK_SIZE):
+        supabase.table("guest_profiles").delete().eq("user_id", user_id).in_("email", gone[i:i + EMAIL_CHUNK_SIZE]).execute()
+
+    mark_profiles_synced(user_id)
+    return {"profiles": len(profiles), "updated": len(changed), "removed": len(gone)}
+
+
+def mark_profiles_synced(user_id) -> None:
+    """Record that the tenant's profiles cover its active bookings (see ensure_guest_profiles)."""
+    now = datetime.now(timezone.utc).isoformat()
+    supabase.table("guest_profile_syncs").upsert({"user_id": user_id, "synced_at": now}, on_conflict="user_id").execute()
+    _SYNCED_USERS.add(user_id)
+
+
+def fetch_active_bookings(user_id) -> pd.DataFrame:
+    """A tenant's active booking_history rows, read page by page."""
+    rows, start = [], 0
+    while True:
+        res = (
+            supabase.table("booking_history").select("*")
+            .eq("user_id", user_id).eq("is_active", True)
+            .order("id").range(start, start + PROFILE_PAGE_SIZE - 1).execute()
+        )
+        page = res.data or []
+        rows.extend(page)
+        if len(page) < PROFILE_PAGE_SIZE:
+            return pd.DataFrame(rows)
+        start += PROFILE_PAGE_SIZE
+
+
+def ensure_guest_profiles(user_id) -> None:
+    """
+    One-off backfill for tenants whose bookings were uploaded before profiles existed.
+    Only a completed sync is recorded, so a backfill that fails part way is retried.
+    """
+    if user_id in _SYNCED_USERS:
+        return
+    res = supabase.table("guest_profile_syncs").select("user_id").eq("user_id", user_id).execute()
+    if res.data:
+        _SYNCED_USERS.add(user_id)
+        return
+    bookings = fetch_active_bookings(user_id)
+    if bookings.empty:
+        mark_profiles_synced(user_id)
+    else:
+        sync_guest_profiles(user_id, bookings)
+
+
+def guest_histories(user_id, emails: list[str]) -> dict[str, dict]:
+    """
+    Email context per guest: the latest stay, with amenity flags covering every
+    amenity the guest used on any stay.
+    """
+    ensure_guest_profiles(user_id)
+    histories = {}
+    for p in fetch_guest_profiles(user_id, emails=emails, columns="email, amenities_used, last_stay"):
+        used = set(p.get("amenities_used") or [])
+        histories[p["email"]] = {
+            **(p.get("last_stay") or {}),
+            **{col: int(name in used) for col, name in AMENITY_USED_NAMES.items()},
+        }
+    return histories
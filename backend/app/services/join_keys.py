@@ -0,0 +1,106 @@
+"""
+Shared dictionary of the discount pipeline's join keys.
+
+Hotel, room type and month are coded as small integers once, when the inputs are
+loaded, so matching, merging and deduplication compare int arrays instead of
+Python strings. Normalisation (lower/strip) runs once per distinct label, and
+labels are decoded from the dictionary only where output needs them.
+
+Codes are numbered in sorted label order, so they don't depend on row order, but
+they do shift when a label is added; content hashes leave out JOIN_KEY_CODES.
+"""
+import numpy as np
+import pandas as pd
+
+from app.config import MONTH_TO_NUM
+
+HOTEL_CODE = "hotel_code"
+ROOM_CODE = "room_code"
+MONTH_CODE = "month_code"
+MISSING = -1
+# Derived columns, excluded from content hashes (see discount_runs / discount_policy)
+JOIN_KEY_CODES = (HOTEL_CODE, ROOM_CODE, MONTH_CODE)
+
+# month code (1-12) -> lower-case month name; 0 is unused
+MONTH_LABELS = np.array([None] + list(MONTH_TO_NUM), dtype=object)
+
+
+def _factorize_normalized(columns: list[pd.Series], normalize) -> tuple[list[np.ndarray], np.ndarray]:
+    """
+    Codes shared by all `columns`, where raw values that normalise to the same
+    label get the same code, numbered in sorted label order. Missing values (before
+    or after normalising) are MISSING.
+    """
+    raw_codes, uniques = pd.factorize(pd.concat(columns, ignore_index=True))
+    norm_codes, labels = pd.factorize(normalize(pd.Index(uniques, dtype=object)), sort=True)
+    codes = np.append(norm_codes, MISSING)[raw_codes]  # raw MISSING (-1) picks the appended MISSING
+    bounds = np.cumsum([len(c) for c in columns])[:-1]
+    return np.split(codes, bounds), np.asarray(labels, dtype=object)
+
+
+def month_codes(values: pd.Series) -> np.ndarray:
+    """Month names (any case) -> 1-12, MISSING when not a month name."""
+    raw_codes, uniques = pd.factorize(values)
+    lookup = np.array(
+        [MONTH_TO_NUM.get(str(u).lower(), MISSING) for u in uniques] + [MISSING], dtype=np.int64
+    )
+    return lookup[raw_codes]
+
+
+class JoinKeyDictionary:
+    """code -> label for hotels (normalised names) and room types (trimmed)."""
+
+    def __init__(self, hotels: np.ndarray, room_types: np.ndarray):
+        self.hotels = hotels
+        self.room_types = room_types
+
+    @staticmethod
+    def _decode(labels: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        return np.append(labels, np.nan)[codes]  # MISSING decodes to NaN
+
+    def decode_hotels(self, codes: np.ndarray) -> np.ndarray:
+        return self._decode(self.hotels, codes)
+
+    def decode_room_types(self, codes: np.ndarray) -> np.ndarray:
+        return self._decode(self.room_types, codes)
+
+
+def encode_join_keys(bookings: pd.DataFrame, financials: pd.DataFrame) -> JoinKeyDictionary:
+    """
+    Add `hotel_code`, `room_code` and `month_code` to both frames (in place), coded
+    against one dictionary, and set the normalised label columns (`hotel_norm`,
+    `reserved_room_type` / `room_type`, `arrival_date_month_lc`) from it.
+    """
+    (b_hotels, f_hotels), hotels = _factorize_normalized(
+        [bookings["hotel"], financials["hotel_name"]],
+        lambda u: u.str.lower().str.strip(),
+    )
+    (b_rooms, f_rooms), room_types = _factorize_normalized(
+        [bookings["reserved_room_type"], financials["room_type"]],
+        lambda u: u.astype(str).str.strip(),
+    )
+    keys = JoinKeyDictionary(hotels, room_types)
+
+    bookings[HOTEL_CODE], financials[HOTEL_CODE] = b_hotels, f_hotels
+    bookings[ROOM_CODE], financials[ROOM_CODE] = b_rooms, f_rooms
+    bookings[MONTH_CODE] = month_codes(bookings["arrival_date_month"])
+    financials[MONTH_CODE] = month_codes(financials["month"])
+
+    bookings["hotel_norm"] = keys.decode_hotels(b_hotels)
+    financials["hotel_norm"] = keys.decode_hotels(f_hotels)
+    bookings["reserved_room_type"] = keys.decode_room_types(b_rooms)
+    financials["room_type"] = keys.decode_room_types(f_rooms)
+    bookings["arrival_date_month_lc"] = np.append(MONTH_LABELS, None)[bookings[MONTH_CODE].to_numpy()]
+    return keys
+
+
+def period_codes(frame: pd.DataFrame) -> np.ndarray:
+    """
+    One int64 per (hotel, room type, month) of each row; MISSING where the hotel
+    or month is unknown. A missing room type is a value of its own, as in a merge.
+    """
+    hotel = frame[HOTEL_CODE].to_numpy(dtype=np.int64)
+    room = frame[ROOM_CODE].to_numpy(dtype=np.int64)
+    month = frame[MONTH_CODE].to_numpy(dtype=np.int64)
+    code = (hotel << 32) | ((room + 1) << 4) | np.maximum(month, 0)
+    return np.where((hotel < 0) | (month < 1), MISSING, code)
@@ -3,6 +3,9 @@ from uuid import uuid4
 from datetime import datetime, timezone
 from typing import Dict, Any, List
 from app.db.supabase_client import supabase
+from app.services.offer_cube import refresh_offer_cube
+from app.services.campaign_stats import bump_campaign_stats, period_of
+from app.services.email_bodies import render_campaign_body
 
 
 def launch_campaign(
@@ -17,7 +20,7 @@ def launch_campaign(
     Orchestrates the full launch flow:
       1. Create marketing campaign
       2. Create campaign batch
-      3. Attach selected emails
+      3. Attach selected emails (rendering their shared bodies)
       4. Queue send job
     """
     try:
@@ -62,8 +65,31 @@ def launch_campaign(
             if not res.data:
                 return {"success": False, "message": f"Failed to attach emails: {res.error}"}
 
-            # 3b. Mark those email_campaigns as launched
+            # 3b. Mark those email_campaigns as launched (and count the ones newly launched)
+            ec_res = (
+                supabase.table("email_campaigns")
+                .select("id, status, html, body_hash, variables, discount_offers (target_year, target_month)")
+                .in_("id", email_campaign_ids)
+                .execute()
+            )
+            # The sender reads html/plain_text off the row, so write back the personalised
+            # body for rows that only reference a shared one
+            for ec in ec_res.data or []:
+                if ec.get("html") or not ec.get("body_hash"):
+                    continue
+                rendered = render_campaign_body(ec)
+                if rendered is None:
+                    return {"success": False, "message": f"Email body missing for campaign {ec['id']}"}
+                supabase.table("email_campaigns").update(rendered).eq("id", ec["id"]).execute()
             supabase.table("email_campaigns").update({"status": "launched"}).in_("id", email_campaign_ids).execute()
+            deltas = {}
+            for ec in ec_res.data or []:
+                offer = ec.get("discount_offers") or {}
+                if ec.get("status") != "launched":
+                    period = period_of(offer.get("target_year"), offer.get("target_month"))
+                    deltas.setdefault(period, {"launched": 0})["launched"] += 1
+            bump_campaign_stats(user_id, deltas)
+            refresh_offer_cube(user_id)
 
         # 4. Queue send job
         queue_record = {
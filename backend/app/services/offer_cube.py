@@ -0,0 +1,237 @@
+import threading
+import time
+from datetime import datetime, timezone
+from uuid import uuid4
+
+import numpy as np
+import pandas as pd
+from fastapi.encoders import jsonable_encoder
+
+from app.config import OFFER_CUBE_PAGE_SIZE, OFFER_CUBE_REVALIDATE_S
+from app.db.supabase_client import supabase
+from app.services.discount_summary import prepare_offer_prices
+from app.services.offer_sets import get_active_offer_set_id
+
+CUBE_DIMENSIONS = (
+    "booking_segment", "business_label", "hotel", "room_type",
+    "target_year", "target_month", "offer_type", "campaign_status",
+)
+INTEGER_DIMENSIONS = ("booking_segment", "target_year")
+# Sums (and non-null counts) so any roll-up can be re-averaged exactly
+CUBE_MEASURES = (
+    "offers", "discount_pct_sum", "base_adr_sum", "base_adr_count",
+    "post_discount_adr_sum", "post_discount_adr_count",
+)
+
+
+def _coerce_dimensions(df: pd.DataFrame) -> pd.DataFrame:
+    """Integer dimensions as nullable ints, so 3 and 3.0 (after a NaN or JSON) are one member."""
+    for dim in INTEGER_DIMENSIONS:
+        df[dim] = pd.to_numeric(df[dim], errors="coerce").astype("Int64")
+    return df
+
+
+def build_cube_cells(offers_adr: pd.DataFrame) -> pd.DataFrame:
+    """Aggregate priced offers to the finest grain of the cube, one row per cell."""
+    df = pd.DataFrame({d: offers_adr[d] if d in offers_adr.columns else None for d in CUBE_DIMENSIONS})
+    df["hotel"] = offers_adr["hotel_norm"]
+    df = _coerce_dimensions(df)
+    df["offers"] = 1
+    df["discount_pct_sum"] = offers_adr["discount_pct"].to_numpy(dtype=float)
+    for col in ("base_adr", "post_discount_adr"):
+        values = offers_adr[col].to_numpy(dtype=float)
+        df[f"{col}_sum"] = np.nan_to_num(values)
+        df[f"{col}_count"] = (~np.isnan(values)).astype(int)
+    return df.groupby(list(CUBE_DIMENSIONS), dropna=False, sort=True)[list(CUBE_MEASURES)].sum().reset_index()
+
+
+def _native(v):
+    if isinstance(v, np.generic):
+        v = v.item()
+    if pd.api.types.is_scalar(v) and pd.isna(v):
+        return None
+    return v
+
+
+class OfferCube:
+    """
+    In-memory cube of one offer set. Dimensions are held as integer codes so a
+    roll-up is a filter mask plus one bincount per measure over the cells.
+    """
+
+    def __init__(self, cells: pd.DataFrame, offer_set_id: str | None = None, version: str | None = None):
+        self.offer_set_id = offer_set_id
+        self.version = version
+        self.codes = {}
+        self.labels = {}
+        cells = _coerce_dimensions(cells.copy())
+        for dim in CUBE_DIMENSIONS:
+            codes, labels = pd.factorize(cells[dim], use_na_sentinel=False)
+            self.codes[dim] = codes
+            self.labels[dim] = np.array([_native(v) for v in labels], dtype=object)
+        self.measures = cells[list(CUBE_MEASURES)].to_numpy(dtype=float)
+
+    def rollup(self, by: list[str] | None = None, filters: dict | None = None) -> list[dict]:
+        """
+        Measures grouped by `by` (no dimensions = grand total), restricted to cells
+        whose dimension values are in `filters` ({dimension: value or [values]}).
+        """
+        by = list(by or [])
+        for dim in by + list(filters or {}):
+            if dim not in self.codes:
+                raise ValueError(f"Unknown cube dimension: {dim}")
+
+        mask = np.ones(len(self.measures), dtype=bool)
+        for dim, values in (filters or {}).items():
+            values = values if isinstance(values, (list, tuple, set)) else [values]
+            wanted = {str(v).lower() for v in values}
+            allowed = np.array([str(v).lower() in wanted for v in self.labels[dim]], dtype=bool)
+            mask &= allowed[self.codes[dim]] if len(allowed) else False
+
+        measures = self.measures[mask]
+        if by:
+            shape = [len(self.labels[d]) for d in by]
+            flat = np.ravel_multi_index([self.codes[d][mask] for d in by], shape)
+            groups, inverse = np.unique(flat, return_inverse=True)
+            keys = np.unravel_index(groups, shape)
+        else:
+            groups, inverse, keys = np.zeros(1, dtype=int), np.zeros(len(measures), dtype=int), []
+        totals = np.stack([
+            np.bincount(inverse, weights=measures[:, j], minlength=len(groups)) for j in range(len(CUBE_MEASURES))
+        ], axis=1) if len(measures) else np.zeros((0, len(CUBE_MEASURES)))
+
+        rows = []
+        for g in range(len(totals)):
+            m = dict(zip(CUBE_MEASURES, totals[g].tolist()))
+            row = {d: self.labels[d][keys[i][g]] for i, d in enumerate(by)}
+            row.update({
+                "offers_count": int(m["offers"]),
+                "discount_pct_sum": m["discount_pct_sum"],
+                "avg_discount_pct": round(m["discount_pct_sum"] / m["offers"], 2) if m["offers"] else 0.0,
+                "avg_base_adr": round(m["base_adr_sum"] / m["base_adr_count"], 2) if m["base_adr_count"] else None,
+                "avg_post_discount_adr": round(m["post_discount_adr_sum"] / m["post_discount_adr_count"], 2) if m["post_discount_adr_count"] else None,
+            })
+            rows.append(row)
+        return rows
+
+
+# (offer_set_id, version) -> OfferCube, and user_id -> (offer_set_id, version, checked_at)
+_CUBES: dict = {}
+_CURRENT: dict = {}
+_CUBES_LOCK = threading.Lock()
+
+
+def _remember(user_id, cube: OfferCube) -> None:
+    key = (cube.offer_set_id, cube.version)
+    with _CUBES_LOCK:
+        previous = _CURRENT.get(user_id)
+        if previous and previous[:2] != key:
+            _CUBES.pop(previous[:2], None)
+        _CUBES[key] = cube
+        _CURRENT[user_id] = (*key, time.monotonic())
+
+
+def fetch_cube_offers(offer_set_id: str, page_size: int = OFFER_CUBE_PAGE_SIZE) -> pd.DataFrame:
+    """The offer set's rows with their campaign status, read in keyset-paginated pages."""
+    frames, last_id = [], None
+    while True:
+        query = supabase.from_("discount_offers").select("*, email_campaigns!left (status)").eq("offer_set_id", offer_set_id)
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        rows = query.order("id").limit(page_size).execute().data or []
+        if rows:
+            frames.append(pd.DataFrame(rows))
+        if len(rows) < page_size:
+            return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        last_id = rows[-1]["id"]
+
+
+def materialize_offer_cube(user_id) -> OfferCube | None:
+    """Rebuild and store the tenant's cube from the active offer set and its campaigns."""
+    offer_set_id = get_active_offer_set_id(user_id)
+    if not offer_set_id:
+        return None
+
+    offers_raw = fetch_cube_offers(offer_set_id)
+    if offers_raw.empty:
+        cells = pd.DataFrame(columns=list(CUBE_DIMENSIONS) + list(CUBE_MEASURES))
+    else:
+        campaigns = offers_raw.pop("email_campaigns").tolist() if "email_campaigns" in offers_raw.columns else []
+        offers_raw["campaign_status"] = [
+            (ec[0].get("status") if ec else None) or "pending"
+            for ec in campaigns or [None] * len(offers_raw)
+        ]
+        fin_res = supabase.table("financials").select("*").eq("user_id", user_id).execute()
+        fin_df = pd.DataFrame(fin_res.data) if fin_res.data else pd.DataFrame()
+        cells = build_cube_cells(prepare_offer_prices(offers_raw, fin_df))
+
+    version = str(uuid4())
+    records = jsonable_encoder(
+        cells.astype(object).where(cells.notna(), None).to_dict(orient="records"),
+        custom_encoder={
+            np.int64: int,
+            np.int32: int,
+            np.float64: float,
+            np.float32: float
+        }
+    )
+    supabase.table("offer_cubes").upsert({
+        "user_id": user_id,
+        "offer_set_id": offer_set_id,
+        "version": version,
+        "cells": records,
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }, on_conflict="user_id").execute()
+
+    cube = OfferCube(cells, offer_set_id, version)
+    _remember(user_id, cube)
+    return cube
+
+
+def refresh_offer_cube(user_id) -> None:
+    """Write-time hook: a failed refresh must not fail the write that triggered it."""
+    try:
+        materialize_offer_cube(user_id)
+    except Exception as e:
+        print(f"[WARN] Offer cube refresh failed for {user_id}: {e}")
+
+
+def get_offer_cube(user_id) -> OfferCube | None:
+    """
+    The tenant's cube, served from memory for OFFER_CUBE_REVALIDATE_S after its
+    version was last confirmed. Then the version row (and the active set) is read,
+    and cells are loaded (or rebuilt) only when the version changed.
+    """
+    with _CUBES_LOCK:
+        current = _CURRENT.get(user_id)
+        cube = _CUBES.get(current[:2]) if current else None
+    if cube is not None and time.monotonic() - current[2] < OFFER_CUBE_REVALIDATE_S:
+        return cube
+
+    res = supabase.table("offer_cubes").select("offer_set_id, version").eq("user_id", user_id).limit(1).execute()
+    stored = res.data[0] if res.data else None
+    if stored is None or stored["offer_set_id"] != get_active_offer_set_id(user_id):
+        return materialize_offer_cube(user_id)
+
+    if cube is None or (cube.offer_set_id, cube.version) != (stored["offer_set_id"], stored["version"]):
+        res = supabase.table("offer_cubes").select("cells").eq("user_id", user_id).limit(1).execute()
+        cells = pd.DataFrame(res.data[0]["cells"] if res.data else [], columns=list(CUBE_DIMENSIONS) + list(CUBE_MEASURES))
+        cube = OfferCube(cells, stored["offer_set_id"], stored["version"])
+    _remember(user_id, cube)
+    return cube
+
+
+def query_offer_cube(email: str, by: list[str] | None = None, filters: dict | None = None) -> dict:
+    user_res = supabase.table("users").select("user_id").eq("email", email).execute()
+    if not user_res.data:
+        return {"success": False, "message": f"No user found with email: {email}"}
+    user_id = user_res.data[0]["user_id"]
+
+    cube = get_offer_cube(user_id)
+    if cube is None:
+        return {"success": False, "message": "No active discount offers found."}
+    try:
+        rows = cube.rollup(by, filters)
+    except ValueError as e:
+        return {"success": False, "message": str(e)}
+    return {"success": True, "offer_set_id": cube.offer_set_id, "dimensions": list(by or []), "rows": rows}
@@ -0,0 +1,180 @@
+"""
+Streaming exports of a tenant's active offer set (CSV, NDJSON, Parquet).
+
+Offers are read from the database in keyset-paginated pages and encoded page by
+page, so memory stays constant whatever the size of the set.
+"""
+import csv
+import io
+import json
+
+from app.config import OFFER_EXPORT_PAGE_SIZE
+from app.db.supabase_client import supabase
+from app.services.offer_sets import get_active_offer_set_id
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional, only needed for Parquet exports
+    pa = pq = None
+
+EXPORT_COLUMNS = [
+    "id", "booking_id", "booking_segment_record_id", "name", "email", "phone_number",
+    "hotel", "room_type", "meal", "country", "booking_segment", "business_label",
+    "target_month", "target_year", "discount_pct", "offer_type", "perks", "amenities_used_before",
+]
+LIST_COLUMNS = {"perks", "amenities_used_before"}
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+def iter_offer_pages(offer_set_id: str, page_size: int = OFFER_EXPORT_PAGE_SIZE):
+    """Yield the offer set's rows page by page, ordered by id (keyset pagination)."""
+    last_id = None
+    while True:
+        query = (
+            supabase.table("discount_offers")
+            .select(",".join(EXPORT_COLUMNS))
+            .eq("offer_set_id", offer_set_id)
+        )
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        rows = query.order("id").limit(page_size).execute().data or []
+        if not rows:
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1]["id"]
+
+
+def _as_list(value) -> list | None:
+    if value is None or isinstance(value, list):
+        return value
+    try:
+        value = json.loads(value)
+    except (TypeError, ValueError):
+        pass
+    return value if isinstance(value, list) else [value]
+
+
+def iter_csv(pages):
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=EXPORT_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    for rows in pages:
+        for row in rows:
+            writer.writerow({
+                k: json.dumps(v) if k in LIST_COLUMNS and v is not None else v
+                for k, v in row.items()
+            })
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate(0)
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def iter_ndjson(pages):
+    for rows in pages:
+        yield "".join(json.dumps(row, default=str) + "\n" for row in rows)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands out what was written so far, keeping the absolute position."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _parquet_schema():
+    return pa.schema([
+        ("id", pa.string()), ("booking_id", pa.string()), ("booking_segment_record_id", pa.string()),
+        ("name", pa.string()), ("email", pa.string()), ("phone_number", pa.string()),
+        ("hotel", pa.string()), ("room_type", pa.string()), ("meal", pa.string()), ("country", pa.string()),
+        ("booking_segment", pa.int64()), ("business_label", pa.string()),
+        ("target_month", pa.string()), ("target_year", pa.int64()), ("discount_pct", pa.float64()),
+        ("offer_type", pa.string()),
+        ("perks", pa.list_(pa.string())), ("amenities_used_before", pa.list_(pa.string())),
+    ])
+
+
+def _parquet_value(field, value):
+    if value is None:
+        return None
+    if pa.types.is_list(field.type):
+        return [str(v) for v in _as_list(value)]
+    if pa.types.is_integer(field.type):
+        return int(value)
+    if pa.types.is_floating(field.type):
+        return float(value)
+    return str(value)
+
+
+def iter_parquet(pages):
+    """One row group per page; bytes are yielded as soon as each group is written."""
+    schema = _parquet_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="snappy")
+    try:
+        for rows in pages:
+            columns = {
+                f.name: [_parquet_value(f, row.get(f.name)) for row in rows]
+                for f in schema
+            }
+            writer.write_table(pa.table(columns, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def export_active_offers(email: str, fmt: str) -> dict:
+    """
+    Resolve the tenant's active offer set and return a lazy byte/str stream for it:
+    {"success": True, "stream", "media_type", "filename"}. Nothing is read until iterated.
+    """
+    fmt = (fmt or "csv").lower()
+    if fmt not in EXPORT_FORMATS:
+        return {"success": False, "message": f"Unsupported export format: {fmt}. Use one of {sorted(EXPORT_FORMATS)}."}
+    if fmt == "parquet" and pq is None:
+        return {"success": False, "message": "Parquet exports require the 'pyarrow' package to be installed."}
+
+    user_res = supabase.table("users").select("user_id").eq("email", email).execute()
+    if not user_res.data:
+        return {"success": False, "message": f"No user found with email: {email}"}
+    user_id = user_res.data[0]["user_id"]
+
+    offer_set_id = get_active_offer_set_id(user_id)
+    if not offer_set_id:
+        return {"success": False, "message": "No active discount offers found."}
+
+    encoders = {"csv": iter_csv, "ndjson": iter_ndjson, "parquet": iter_parquet}
+    media_type, extension = EXPORT_FORMATS[fmt]
+    return {
+        "success": True,
+        "stream": encoders[fmt](iter_offer_pages(offer_set_id)),
+        "media_type": media_type,
+        "filename": f"discount_offers_{offer_set_id}.{extension}",
+    }
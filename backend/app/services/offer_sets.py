@@ -0,0 +1,111 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from uuid import uuid4
+
+from app.config import OFFER_INSERT_CHUNK_SIZE, OFFER_INSERT_WORKERS
+from app.db.supabase_client import supabase
+
+
+def get_active_offer_set_id(user_id) -> str | None:
+    """Id of the offer set readers should see for this user (None before the first run)."""
+    res = supabase.table("active_offer_sets").select("offer_set_id").eq("user_id", user_id).limit(1).execute()
+    return res.data[0]["offer_set_id"] if res.data else None
+
+
+def create_offer_set(user_id, source_offer_set_id: str | None = None) -> str:
+    offer_set_id = str(uuid4())
+    supabase.table("discount_offer_sets").insert({
+        "id": offer_set_id,
+        "user_id": user_id,
+        "source_offer_set_id": source_offer_set_id,
+        "status": "building",
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }).execute()
+    return offer_set_id
+
+
+def insert_offer_rows(offer_set_id: str, records: list[dict]) -> int:
+    """
+    Insert offer rows into a (not yet active) offer set in bounded chunks, a few in parallel.
+    Raises if any chunk fails.
+    """
+    chunks = [
+        [{**r, "offer_set_id": offer_set_id} for r in records[i:i + OFFER_INSERT_CHUNK_SIZE]]
+        for i in range(0, len(records), OFFER_INSERT_CHUNK_SIZE)
+    ]
+
+    def _insert(chunk):
+        res = supabase.table("discount_offers").insert(chunk).execute()
+        if not res.data:
+            raise RuntimeError(f"Insert failed: {res.error}")
+        return len(res.data)
+
+    if not chunks:
+        return 0
+    with ThreadPoolExecutor(max_workers=min(OFFER_INSERT_WORKERS, len(chunks))) as pool:
+        return sum(pool.map(_insert, chunks))
+
+
+def clone_offer_rows(source_offer_set_id: str, offer_set_id: str, exclude_ids: list) -> None:
+    """
+    Copy a set's offers into a new set inside the database, skipping `exclude_ids`.
+    Copies get new ids and remember theirs in `source_offer_id`, so activation can move
+    their email campaigns over (see migrations/002_clone_offer_sets.sql).
+    """
+    supabase.rpc("clone_discount_offers", {
+        "p_source_offer_set_id": source_offer_set_id,
+        "p_target_offer_set_id": offer_set_id,
+        "p_exclude_ids": exclude_ids,
+    }).execute()
+
+
+def activate_offer_set(user_id, offer_set_id: str, row_count: int) -> None:
+    """
+    Point readers at the new set, then retire the previous set. Raises only
+    if the set did not go live; once the pointer is swapped, status bookkeeping failures
+    are logged (the set must not be discarded then).
+    """
+    previous_id = get_active_offer_set_id(user_id)
+    supabase.table("discount_offer_sets").update({"status": "ready", "row_count": row_count}).eq("id", offer_set_id).execute()
+    # Swaps the pointer and moves cloned offers' campaigns over in one transaction
+    supabase.rpc("activate_discount_offer_set", {"p_user_id": user_id, "p_offer_set_id": offer_set_id}).execute()
+    try:
+        supabase.table("discount_offer_sets").update({"status": "active"}).eq("id", offer_set_id).execute()
+        if previous_id and previous_id != offer_set_id:
+            supabase.table("discount_offer_sets").update({"status": "superseded"}).eq("id", previous_id).execute()
+    except Exception as e:
+        print(f"[WARN] Offer set {offer_set_id} is live but its status update failed: {e}")
+
+
+def discard_offer_set(offer_set_id: str) -> None:
+    """Drop a set that never became active; the active set is untouched."""
+    supabase.table("discount_offers").delete().eq("offer_set_id", offer_set_id).execute()
+    supabase.table("discount_offer_sets").update({"status": "failed"}).eq("id", offer_set_id).execute()
+
+
+def write_offer_set(user_id, records: list[dict], source_offer_set_id: str | None = None,
+                    exclude_ids: list | None = None) -> dict:
+    """
+    Write offers as a new version and activate it. With `source_offer_set_id`, the source
+    set's rows (minus `exclude_ids`) are carried over in the database and `records` are
+    only the new rows. On failure the previous version stays active.
+    """
+    offer_set_id = create_offer_set(user_id, source_offer_set_id)
+    swapped = False
+    try:
+        carried = 0
+        if source_offer_set_id:
+            clone_offer_rows(source_offer_set_id, offer_set_id, exclude_ids or [])
+            carried = (
+                supabase.table("discount_offers").select("id", count="exact")
+                .eq("offer_set_id", offer_set_id).limit(1).execute().count or 0
+            )
+        inserted = insert_offer_rows(offer_set_id, records)
+        activate_offer_set(user_id, offer_set_id, carried + inserted)
+        swapped = True
+        return {"success": True, "offer_set_id": offer_set_id, "inserted_rows": inserted, "carried_rows": carried}
+    except Exception as e:
+        # Only a set readers never saw can be dropped; a live one is the tenant's offers
+        if not swapped:
+            discard_offer_set(offer_set_id)
+        return {"success": False, "message": f"Error writing offer set: {str(e)}"}
@@ -0,0 +1,48 @@
+-- Versioned offer sets: discount_offers rows belong to a discount_offer_sets version and
+-- readers follow the per-tenant active_offer_sets pointer (see app/services/offer_sets.py).
+-- Run once, in order with the other files in this directory.
+
+begin;
+
+create table if not exists discount_offer_sets (
+    id uuid primary key,
+    user_id uuid not null,
+    source_offer_set_id uuid,
+    status text not null default 'building',  -- building | ready | active | superseded | failed
+    row_count integer,
+    created_at timestamptz not null default now()
+);
+
+create table if not exists active_offer_sets (
+    user_id uuid primary key,
+    offer_set_id uuid not null references discount_offer_sets (id),
+    updated_at timestamptz not null default now()
+);
+
+alter table discount_offers add column if not exists offer_set_id uuid references discount_offer_sets (id);
+create index if not exists discount_offers_offer_set_id_id on discount_offers (offer_set_id, id);
+
+-- Backfill: offers written before offer sets existed are the tenant's is_active rows.
+-- Wrap each such tenant's rows in one active set and point readers at it, so existing
+-- tenants keep their offers, campaigns and stats without regenerating.
+with legacy as (
+    select user_id, gen_random_uuid() as offer_set_id, count(*) as row_count
+    from discount_offers
+    where is_active and offer_set_id is null
+      and user_id not in (select user_id from active_offer_sets)
+    group by user_id
+), sets as (
+    insert into discount_offer_sets (id, user_id, status, row_count)
+    select offer_set_id, user_id, 'active', row_count from legacy
+    returning id, user_id
+), tagged as (
+    update discount_offers o
+    set offer_set_id = s.id
+    from sets s
+    where o.user_id = s.user_id and o.is_active and o.offer_set_id is null
+)
+insert into active_offer_sets (user_id, offer_set_id)
+select user_id, id from sets
+on conflict (user_id) do nothing;
+
+commit;
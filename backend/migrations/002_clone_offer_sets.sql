@@ -0,0 +1,59 @@
+-- Incremental offer set versions: unchanged offers are cloned server-side, and their
+-- email campaigns follow them to the new version when it goes live.
+
+begin;
+
+-- The offer a cloned row was copied from (null for freshly generated rows)
+alter table discount_offers add column if not exists source_offer_id uuid;
+
+-- Copy a set's offers into a new (not yet active) set, skipping p_exclude_ids.
+create or replace function clone_discount_offers(
+    p_source_offer_set_id uuid,
+    p_target_offer_set_id uuid,
+    p_exclude_ids uuid[]
+) returns integer
+language sql
+as $$
+    with cloned as (
+        insert into discount_offers (
+            offer_set_id, source_offer_id, user_id, booking_id, booking_segment_record_id,
+            name, email, phone_number, hotel, room_type, meal, country,
+            booking_segment, business_label, target_month, target_year,
+            discount_pct, offer_type, perks, amenities_used_before
+        )
+        select
+            p_target_offer_set_id, id, user_id, booking_id, booking_segment_record_id,
+            name, email, phone_number, hotel, room_type, meal, country,
+            booking_segment, business_label, target_month, target_year,
+            discount_pct, offer_type, perks, amenities_used_before
+        from discount_offers
+        where offer_set_id = p_source_offer_set_id
+          and not (id = any (coalesce(p_exclude_ids, '{}')))
+        returning 1
+    )
+    select count(*)::integer from cloned;
+$$;
+
+-- Make a set live: move the campaigns of its cloned offers over from the rows they were
+-- copied from, then swap the tenant's pointer. One transaction, so readers never see the
+-- new set without its campaigns (or campaigns pointing at a set that never went live).
+create or replace function activate_discount_offer_set(p_user_id uuid, p_offer_set_id uuid)
+returns void
+language plpgsql
+as $$
+begin
+    update email_campaigns c
+    set offer_id = o.id
+    from discount_offers o
+    where o.offer_set_id = p_offer_set_id
+      and o.source_offer_id is not null
+      and c.offer_id = o.source_offer_id;
+
+    insert into active_offer_sets (user_id, offer_set_id, updated_at)
+    values (p_user_id, p_offer_set_id, now())
+    on conflict (user_id) do update
+        set offer_set_id = excluded.offer_set_id, updated_at = excluded.updated_at;
+end;
+$$;
+
+commit;
@@ -0,0 +1,14 @@
+-- One email campaign per offer: saves upsert on offer_id, so overlapping or repeated
+-- generation runs can't leave an offer with two campaigns.
+
+begin;
+
+-- Keep each offer's oldest campaign (the one stats and launches have seen)
+delete from email_campaigns c
+using email_campaigns older
+where c.offer_id = older.offer_id
+  and (older.created_at, older.id) < (c.created_at, c.id);
+
+create unique index if not exists email_campaigns_offer_id_key on email_campaigns (offer_id);
+
+commit;
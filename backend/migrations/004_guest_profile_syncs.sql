@@ -0,0 +1,14 @@
+-- Tenants whose guest_profiles cover their active bookings. A row is written only after
+-- a full sync, so the read-time backfill (ensure_guest_profiles) retries one that failed.
+
+begin;
+
+create table if not exists guest_profile_syncs (
+    user_id uuid primary key,
+    synced_at timestamptz not null default now()
+);
+
+-- No rows are seeded: existing profiles may come from a partial backfill, and the first
+-- read resyncs each tenant once (only profiles whose hash changed are written).
+
+commit;
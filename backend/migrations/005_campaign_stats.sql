@@ -0,0 +1,85 @@
+-- Write-time campaign counters (see app/services/campaign_stats.py). Every writer of a
+-- tenant's counters takes the same transaction-scoped advisory lock, so a recount and
+-- an increment never interleave and no delta is lost.
+
+begin;
+
+create table if not exists campaign_stats (
+    user_id uuid not null,
+    offer_set_id uuid not null,
+    year integer not null,
+    month integer not null,
+    total integer not null default 0,
+    generated integer not null default 0,
+    launched integer not null default 0,
+    updated_at timestamptz not null default now(),
+    primary key (user_id, offer_set_id, year, month)
+);
+
+-- Recount an offer set and replace the tenant's counters with the result, in one
+-- transaction. With p_only_if_missing, counters that already exist are kept.
+create or replace function reseed_campaign_stats(
+    p_user_id uuid,
+    p_offer_set_id uuid,
+    p_only_if_missing boolean default false
+) returns setof campaign_stats
+language plpgsql
+as $$
+begin
+    perform pg_advisory_xact_lock(hashtext('campaign_stats:' || p_user_id::text));
+
+    if not (p_only_if_missing and exists (
+        select 1 from campaign_stats where user_id = p_user_id and offer_set_id = p_offer_set_id
+    )) then
+        delete from campaign_stats where user_id = p_user_id;
+
+        insert into campaign_stats (user_id, offer_set_id, year, month, total, generated, launched, updated_at)
+        select p_user_id, p_offer_set_id, o.target_year::integer, m.month,
+               count(*), count(c.offer_id), count(*) filter (where c.status = 'launched'), now()
+        from discount_offers o
+        cross join lateral (
+            select array_position(array[
+                'january', 'february', 'march', 'april', 'may', 'june',
+                'july', 'august', 'september', 'october', 'november', 'december'
+            ], lower(o.target_month)) as month
+        ) m
+        left join email_campaigns c on c.offer_id = o.id
+        where o.offer_set_id = p_offer_set_id
+          and o.target_year is not null
+          and m.month is not null
+        group by o.target_year::integer, m.month;
+    end if;
+
+    return query
+        select * from campaign_stats where user_id = p_user_id and offer_set_id = p_offer_set_id;
+end;
+$$;
+
+-- Add per-period {year, month, generated, launched} deltas to the set's counters. A set
+-- that was never counted is recounted instead (the recount already sees these campaigns).
+create or replace function increment_campaign_stats(p_user_id uuid, p_offer_set_id uuid, p_deltas jsonb)
+returns void
+language plpgsql
+as $$
+begin
+    perform pg_advisory_xact_lock(hashtext('campaign_stats:' || p_user_id::text));
+
+    if not exists (
+        select 1 from campaign_stats where user_id = p_user_id and offer_set_id = p_offer_set_id
+    ) then
+        perform reseed_campaign_stats(p_user_id, p_offer_set_id);
+        return;
+    end if;
+
+    insert into campaign_stats (user_id, offer_set_id, year, month, generated, launched, updated_at)
+    select p_user_id, p_offer_set_id, (d ->> 'year')::integer, (d ->> 'month')::integer,
+           coalesce((d ->> 'generated')::integer, 0), coalesce((d ->> 'launched')::integer, 0), now()
+    from jsonb_array_elements(p_deltas) d
+    on conflict (user_id, offer_set_id, year, month) do update
+        set generated = campaign_stats.generated + excluded.generated,
+            launched = campaign_stats.launched + excluded.launched,
+            updated_at = excluded.updated_at;
+end;
+$$;
+
+commit;
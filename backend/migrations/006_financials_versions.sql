@@ -0,0 +1,12 @@
+-- Per-tenant version of the uploaded financials. Each upload writes a new version, and
+-- cached discount summaries are keyed on it (see app/services/discount_summary.py).
+
+begin;
+
+create table if not exists financials_versions (
+    user_id uuid primary key,
+    version uuid not null,
+    updated_at timestamptz not null default now()
+);
+
+commit;
@@ -0,0 +1,21 @@
+-- Shared, compressed email bodies (see app/services/email_bodies.py): each distinct
+-- rendered body is stored once, and email_campaigns rows keep its hash plus the
+-- recipient's placeholder values.
+
+begin;
+
+create table if not exists email_bodies (
+    hash text primary key,                            -- SHA-256 of the uncompressed body
+    encoding text not null default 'zlib+base64',
+    content text not null,
+    size_bytes integer,
+    stored_bytes integer,
+    created_at timestamptz not null default now()
+);
+
+-- No foreign key: campaign rows are saved before their bodies (save_email_campaigns)
+alter table email_campaigns add column if not exists body_hash text;
+alter table email_campaigns add column if not exists variables jsonb;
+create index if not exists email_campaigns_body_hash on email_campaigns (body_hash);
+
+commit;
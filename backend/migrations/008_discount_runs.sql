@@ -0,0 +1,17 @@
+-- Last discount run per tenant (see app/services/discount_runs.py). The next run diffs its
+-- config and financials against these hashes and regenerates only the affected offers.
+-- Offer signatures are not stored: they are recomputed from the active set's
+-- discount_offers rows, which stay the source of truth.
+
+begin;
+
+create table if not exists discount_runs (
+    user_id uuid primary key,
+    config jsonb not null,                            -- segment config the offers were built from
+    cluster_hashes jsonb not null,                    -- cluster_id -> hash of its segment config
+    period_hashes jsonb not null,                     -- hotel|room_type|month|year -> hash of its financials
+    bookings_version text not null,
+    updated_at timestamptz not null default now()
+);
+
+commit;
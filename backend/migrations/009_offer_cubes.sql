@@ -0,0 +1,15 @@
+-- Per-tenant materialised offer cube (see app/services/offer_cube.py): aggregated cells
+-- of the active offer set, rebuilt when the set or its campaigns change. `version` is
+-- new on every rebuild, so workers reload their in-memory copy when it moves.
+
+begin;
+
+create table if not exists offer_cubes (
+    user_id uuid primary key,
+    offer_set_id uuid not null references discount_offer_sets (id),
+    version uuid not null,
+    cells jsonb not null default '[]'::jsonb,         -- one object per cube cell (dimensions + measures)
+    updated_at timestamptz not null default now()
+);
+
+commit;
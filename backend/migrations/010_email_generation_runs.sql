@@ -0,0 +1,28 @@
+-- Email generation runs and their checkpoints (see app/services/email_runs.py). A run that
+-- stops before completing is reopened by the next request for the same offer set, year
+-- and months, which skips every offer that already has a campaign.
+
+begin;
+
+create table if not exists email_generation_runs (
+    id uuid primary key,
+    user_id uuid not null,
+    offer_set_id uuid references discount_offer_sets (id),
+    year integer not null,
+    months integer[] not null default '{}',           -- sorted; empty = every month
+    status text not null default 'running',           -- running | completed | failed | interrupted
+    total integer not null default 0,
+    skipped integer not null default 0,                -- offers that already had a campaign
+    done integer not null default 0,
+    failed integer not null default 0,
+    saved integer not null default 0,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
+
+-- start_email_run: latest unfinished runs of a tenant for one offer set and year
+create index if not exists email_generation_runs_resume
+    on email_generation_runs (user_id, offer_set_id, year, created_at desc)
+    where status <> 'completed';
+
+commit;
@@ -0,0 +1,24 @@
+-- One profile per (tenant, guest email), kept in line with the active bookings (see
+-- app/services/guest_profiles.py). sync_guest_profiles upserts on (user_id, email) and
+-- writes only the profiles whose profile_hash changed.
+
+begin;
+
+create table if not exists guest_profiles (
+    id bigint generated always as identity primary key,
+    user_id uuid not null,
+    email text not null,
+    total_stays integer not null default 0,
+    room_type_stays jsonb not null default '{}'::jsonb,   -- room type -> number of stays
+    last_stay_year integer,
+    avg_lead_time numeric,
+    amenities_used jsonb not null default '[]'::jsonb,    -- amenity names used on any stay
+    last_stay jsonb not null default '{}'::jsonb,         -- summary of the latest stay
+    profile_hash text,
+    updated_at timestamptz not null default now()
+);
+
+-- Conflict target of the upsert; also serves the per-tenant email lookups and paging
+create unique index if not exists guest_profiles_user_id_email on guest_profiles (user_id, email);
+
+commit;
@@ -0,0 +1,59 @@
+"""Run-state and policy hashes must not depend on row order or on the join key codes."""
+import numpy as np
+import pandas as pd
+
+from app.services.discount_policy import financials_version
+from app.services.discount_runs import bookings_version, period_hashes
+from app.services.join_keys import encode_join_keys
+
+
+def _inputs():
+    bookings = pd.DataFrame({
+        "id": [1, 2, 3, 4, 5],
+        "email": ["a@x", "b@x", "a@x", "c@x", "d@x"],
+        "hotel": ["City Hotel", "Resort Hotel", " city hotel", "Resort Hotel", "Airport Inn"],
+        "reserved_room_type": ["A", "B", "A ", "C", "A"],
+        "arrival_date_month": ["May", "June", "may", "July", "May"],
+        "arrival_date_year": [2024, 2024, 2025, 2025, 2025],
+        "adr": [120.0, 210.5, 99.0, np.nan, 80.0],
+    })
+    financials = pd.DataFrame({
+        "hotel_name": ["City Hotel", "Resort Hotel", "Resort Hotel", "Airport Inn"],
+        "room_type": ["A", "B", "C", "A"],
+        "month": ["May", "June", "July", "May"],
+        "year": [2026, 2026, 2026, 2026],
+        "adr": [150.0, 240.0, 260.0, 90.0],
+        "target_booking_percent": [80.0, 70.0, 90.0, 60.0],
+        "forecast_booking_percent": [60.0, 65.0, 50.0, 55.0],
+    })
+    return bookings, financials
+
+
+def _hashes(bookings, financials):
+    bookings, financials = bookings.copy(), financials.copy()
+    encode_join_keys(bookings, financials)
+    return bookings_version(bookings), period_hashes(financials), financials_version(financials)
+
+
+def test_shuffled_bookings_keep_every_hash():
+    bookings, financials = _inputs()
+    expected = _hashes(bookings, financials)
+    for seed in range(5):
+        shuffled = bookings.sample(frac=1, random_state=seed).reset_index(drop=True)
+        assert _hashes(shuffled, financials) == expected
+
+
+def test_shuffled_financials_keep_run_state_hashes():
+    bookings, financials = _inputs()
+    version, periods, _ = _hashes(bookings, financials)
+    for seed in range(5):
+        shuffled = financials.sample(frac=1, random_state=seed).reset_index(drop=True)
+        assert _hashes(bookings, shuffled)[:2] == (version, periods)
+
+
+def test_new_hotel_keeps_other_period_hashes():
+    bookings, financials = _inputs()
+    _, periods, _ = _hashes(bookings, financials)
+    extra = pd.DataFrame([{**financials.iloc[0].to_dict(), "hotel_name": "Abbey Hotel"}])
+    _, grown, _ = _hashes(bookings, pd.concat([extra, financials], ignore_index=True))
+    assert {k: v for k, v in grown.items() if not k.startswith("abbey hotel|")} == periods
@@ -5,14 +5,17 @@ import apiUtils from "../../utils/apiUtils";
 import { usePersistentState } from "../../hooks/usePersistanceStorage";
 import { ChevronDown, ChevronRight } from "lucide-react";
 
-type MonthCounts = { total: number; generated: number; pending: number };
+type MonthCounts = { total: number; generated: number; pending: number; launched?: number };
 
 type CampaignStatsResponse = {
   years: Record<string, Record<string, MonthCounts>>;
   month_labels: Record<string, string>;
-  campaigns: Record<string, Record<string, any[]>>;
 };
 
+// Cards per page and the card fields the month list renders
+const CARD_PAGE_SIZE = 24;
+const CARD_FIELDS = ["offer_id", "campaign_id", "hotel", "business_label", "discount_pct", "status", "subject"];
+
 export default function EmailCampaign({
   step,
   setStep,
@@ -30,7 +33,7 @@ export default function EmailCampaign({
   // NEW: spinner while generating emails
   const [isGenerating, setIsGenerating] = useState(false);
 
-  const { getEmailCampaign, generateEmailsAPI, getEmailPreview } = apiUtils();
+  const { getCampaignStats, generateEmailsAPI, getEmailPreview } = apiUtils();
 
   const currentYear = new Date().getFullYear();
   const [year, setYear] = useState<number>(currentYear);
@@ -38,6 +41,8 @@ export default function EmailCampaign({
 
   // Track which months are expanded
   const [openMonths, setOpenMonths] = useState<Record<string, boolean>>({});
+  // Bumped after a generation so open months reload their cards
+  const [cardsVersion, setCardsVersion] = useState(0);
 
   // Initialize open months whenever year/summary changes
   useEffect(() => {
@@ -92,7 +97,7 @@ export default function EmailCampaign({
     (async () => {
       try {
         setLoading(true);
-        const data = await getEmailCampaign(email);
+        const data = await getCampaignStats(email);
         setSummary(data);
         const years = Object.keys(data.years).map(Number).sort((a, b) => a - b);
         if (years.length && !years.includes(year)) setYear(years[0]);
@@ -109,6 +114,7 @@ export default function EmailCampaign({
       setIsGenerating(true); // NEW: start spinner
       const data = await generateEmailsAPI(email, months, year);
       setSummary(data);
+      setCardsVersion((v) => v + 1);
       setMode("Summary");
     } catch (e) {
       console.error(e);
@@ -214,20 +220,21 @@ export default function EmailCampaign({
             <div className="text-sm text-gray-600">Loading…</div>
           ) : (
             <div className="space-y-4">
-              {Object.entries(summary?.campaigns[String(year)] || {})
+              {Object.entries(summary.years?.[String(year)] || {})
                 .filter(([m]) => months.length === 0 || months.includes(Number(m)))
-                .map(([m, cards]) => {
-                  const counts = summary.years[String(year)]?.[m] || { total: 0, generated: 0, pending: 0 };
+                .map(([m, counts]) => {
                   const isOpen = !!openMonths[m];
                   return (
                     <MonthSection
                       key={m}
                       monthKey={m}
-                      title={`${summary.month_labels[m]} ${year}`}
+                      title={`${monthLabels[m]} ${year}`}
                       counts={counts}
                       isOpen={isOpen}
                       onToggle={() => toggleMonth(m)}
-                      cards={cards as any[]}
+                      email={email}
+                      year={year}
+                      cardsVersion={cardsVersion}
                       onPreview={handlePreview}
                       onGoGenerate={() => setMode("Generate")}
                     />
@@ -282,7 +289,9 @@ function MonthSection({
   counts,
   isOpen,
   onToggle,
-  cards,
+  email,
+  year,
+  cardsVersion,
   onPreview,
   onGoGenerate,
 }: {
@@ -291,11 +300,48 @@ function MonthSection({
   counts: MonthCounts;
   isOpen: boolean;
   onToggle: () => void;
-  cards: any[];
+  email: string;
+  year: number;
+  cardsVersion: number;
   onPreview: (id: string) => void;
   onGoGenerate: () => void;
 }) {
   const hasOffers = (counts?.total || 0) > 0;
+  const { listCampaigns } = apiUtils();
+  const [cards, setCards] = useState<any[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [loadingCards, setLoadingCards] = useState(false);
+
+  async function loadPage(cursor: string | null) {
+    try {
+      setLoadingCards(true);
+      const page = await listCampaigns(email, {
+        year,
+        month: Number(monthKey),
+        fields: CARD_FIELDS,
+        cursor,
+        limit: CARD_PAGE_SIZE,
+      });
+      if (!page.success) {
+        console.error("Failed to load campaigns:", page.message);
+        return;
+      }
+      setCards((prev) => (cursor ? [...prev, ...page.items] : page.items));
+      setNextCursor(page.next_cursor);
+    } catch (e) {
+      console.error("Failed to load campaigns", e);
+    } finally {
+      setLoadingCards(false);
+    }
+  }
+
+  // Fetch only the first page of an open month; more on demand
+  useEffect(() => {
+    if (!isOpen || !hasOffers) return;
+    setCards([]);
+    setNextCursor(null);
+    loadPage(null);
+  }, [isOpen, hasOffers, email, year, monthKey, cardsVersion]);
   return (
     <div className="border rounded-lg bg-white shadow-sm">
       <button
@@ -323,7 +369,9 @@ function MonthSection({
               <span>No offers this month.</span>
               <Button type="normal" label="Generate Offers" onClick={onGoGenerate} />
             </div>
-          ) : cards.length === 0 || !cards[0].subject ? (
+          ) : cards.length === 0 && loadingCards ? (
+            <div className="text-sm text-gray-600">Loading…</div>
+          ) : counts.generated === 0 || cards.length === 0 ? (
             <div className="rounded-md border border-dashed p-4 bg-gray-50 text-sm text-gray-600">
               No campaigns found for this month yet.
             </div>
@@ -344,6 +392,16 @@ function MonthSection({
                   </div>
                 </div>
               ))}
+              {nextCursor && (
+                <div className="md:col-span-2 flex justify-center">
+                  <Button
+                    type="normal"
+                    label={loadingCards ? "Loading…" : "Load more"}
+                    onClick={() => loadPage(nextCursor)}
+                    disabled={loadingCards}
+                  />
+                </div>
+              )}
             </div>
           )}
         </div>
@@ -114,6 +114,36 @@ const apiUtils = () => {
     return result
   }
 
+  const getCampaignStats = async (email:string)=>{
+    const formData = new FormData()
+    formData.append("email", email)
+    const response = await fetch(`${apiUrl}/email/get-campaign-stats`,
+      {
+        method: "POST",
+        body: formData
+      }
+    )
+    const result = await response.json()
+
+    return result
+  }
+
+  // One page of campaign cards; pass the returned next_cursor back as `cursor` for the next page
+  const listCampaigns = async (email:string, params: {
+    year?: number; month?: number; status?: string; hotel?: string; segment?: string;
+    fields?: string[]; cursor?: string | null; limit?: number;
+  } = {})=>{
+    const query = new URLSearchParams({ email })
+    Object.entries(params).forEach(([key, value]) => {
+      if (value === undefined || value === null || value === "") return
+      query.append(key, Array.isArray(value) ? value.join(",") : String(value))
+    })
+    const response = await fetch(`${apiUrl}/email/campaigns?${query.toString()}`)
+    const result = await response.json()
+
+    return result
+  }
+
   const getEmailPreview = async (id:string)=>{
     const body = { campaign_id: id };
     const response = await fetch(`${apiUrl}/email/get-email-preview`,
@@ -153,6 +183,7 @@ const apiUtils = () => {
      getDiscountSummary,
      generateEmailsAPI,
      getEmailCampaign,getEmailPreview,
+     getCampaignStats,listCampaigns,
      launchEmailCampaign
       }
 }